@@ -0,0 +1,194 @@
+"""
+Ingest-side rollups of one second sound levels.
+
+For every device, energetic Leq (10·log10 of mean 10^(L/10)), Lmax, Lmin and
+percentile levels L10, L50 and L90 (level exceeded 10 %, 50 % and 90 % of the
+time) are aggregated over 1 minute, 15 minute and 1 hour windows. A window
+is a compact histogram of 0.1 dB bins plus energy sum, so it takes constant
+memory however many seconds it has. Finished windows are written to
+measurement ACOUSTIC_ROLLUP_MEASUREMENT (default 'noise_rollup') with tags
+'dev-id' and 'window' (e.g. '15m'), time is the start of the window:
+
+    SELECT "Leq", "L90" FROM "noise_rollup" WHERE "dev-id" = 'TA120-T246177' AND "window" = '1h'
+
+Levels are picked from measurements passing through endpoints.sinks, by
+ACOUSTIC_ROLLUP_SOURCES setting: {measurement: field}, default
+{'LAeq1s': 'dBA'} (Sentilo TA120 sensors). Noise sensor v1 `raw_pp` values
+are not calibrated dB, so they are not included by default.
+
+A window is finished ACOUSTIC_ROLLUP_GRACE seconds (default 120) after its
+end. Levels for finished windows are dropped. Windows are kept in
+endpoints.windows store, so nothing is aggregated unless ROLLUP_REDIS_URL
+is set, see there.
+"""
+import logging
+import math
+import time
+from collections import defaultdict
+
+from endpoints.lineprotocol import time_to_us
+from endpoints.utils import get_setting
+from endpoints.windows import get_window_store, is_enabled
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE = 'acoustic'
+WINDOWS = (('1m', 60), ('15m', 15 * 60), ('1h', 60 * 60))
+PERCENTILES = (10, 50, 90)
+SECOND_US = 1000000
+late_levels = 0  # number of dropped levels, which arrived after their window was finished
+
+
+def get_sources():
+    """:return: dict measurement -> level field, empty if windows can't be shared"""
+    if not is_enabled():
+        return {}
+    return get_setting('ACOUSTIC_ROLLUP_SOURCES', {'LAeq1s': 'dBA'}) or {}
+
+
+class LevelWindow:
+    """Constant-memory aggregate of sound levels: 0.1 dB histogram, energy sum, min and max."""
+
+    def __init__(self):
+        self.bins = defaultdict(int)
+        self.energy = 0.0
+        self.count = 0
+        self.lmin = None
+        self.lmax = None
+
+    def add(self, level):
+        self.bins[int(round(level * 10))] += 1
+        self.energy += 10 ** (level / 10.0)
+        self.count += 1
+        if self.lmin is None or level < self.lmin:
+            self.lmin = level
+        if self.lmax is None or level > self.lmax:
+            self.lmax = level
+
+    def to_aggregate(self):
+        """Return (counters, mins, maxs) for endpoints.windows store."""
+        counters = {'b{}'.format(b): n for b, n in self.bins.items()}
+        counters['n'] = self.count
+        counters['e'] = self.energy
+        return counters, {'L': self.lmin}, {'L': self.lmax}
+
+    @staticmethod
+    def from_aggregate(counters, mins, maxs):
+        w = LevelWindow()
+        for k, v in counters.items():
+            if k.startswith('b'):
+                w.bins[int(k[1:])] = int(v)
+        w.count = int(counters.get('n', 0))
+        w.energy = counters.get('e', 0.0)
+        w.lmin = mins.get('L')
+        w.lmax = maxs.get('L')
+        return w
+
+    def leq(self):
+        return 10 * math.log10(self.energy / self.count)
+
+    def exceeded(self, pct):
+        """Return level exceeded `pct` percent of the time, e.g. 90 -> L90."""
+        target = self.count * (100 - pct) / 100.0
+        cumulative = 0
+        for b in sorted(self.bins):
+            cumulative += self.bins[b]
+            if cumulative >= target:
+                return b / 10.0
+        return self.lmax
+
+    def fields(self):
+        fields = {
+            'Leq': round(self.leq(), 2),
+            'Lmax': self.lmax,
+            'Lmin': self.lmin,
+            'count': self.count,
+        }
+        for pct in PERCENTILES:
+            fields['L{}'.format(pct)] = self.exceeded(pct)
+        return fields
+
+
+def add_levels(dbname, devid, samples, now=None):
+    """
+    Add one second levels of a device to open windows.
+
+    :param str dbname: database of the source measurements, rollups are written there too
+    :param str devid: device id
+    :param samples: iterable of (epoch microseconds, level in dB)
+    :param float now: current epoch seconds, for tests
+    """
+    global late_levels
+    if now is None:
+        now = time.time()
+    grace = float(get_setting('ACOUSTIC_ROLLUP_GRACE', 120))
+    windows = {}
+    for ts_us, level in samples:
+        if level is None:
+            continue
+        ts = ts_us // SECOND_US
+        for name, length in WINDOWS:
+            start = ts - ts % length
+            key = (NAMESPACE, dbname, devid, name, start)
+            w = windows.get(key)
+            if w is None:
+                if start + length + grace <= now:
+                    late_levels += 1
+                    continue
+                w = windows[key] = LevelWindow()
+            w.add(float(level))
+    store = get_window_store()
+    for key, w in windows.items():
+        length = dict(WINDOWS)[key[3]]
+        store.merge(key, key[4] + length + grace, *w.to_aggregate())
+
+
+def finished_windows(now=None):
+    """
+    Pop finished windows from the store.
+
+    :return: dict dbname -> list of InfluxDB measurement dicts
+    """
+    if now is None:
+        now = time.time()
+    measurement = get_setting('ACOUSTIC_ROLLUP_MEASUREMENT', 'noise_rollup')
+    result = defaultdict(list)
+    for key, counters, mins, maxs in get_window_store().pop_due(NAMESPACE, now):
+        _, dbname, devid, name, start = key
+        w = LevelWindow.from_aggregate(counters, mins, maxs)
+        if w.count == 0:
+            continue
+        result[dbname].append({
+            'measurement': measurement,
+            'tags': {'dev-id': devid, 'window': name},
+            'time': int(start) * SECOND_US,
+            'fields': w.fields(),
+        })
+    return result
+
+
+def observe(dbname, measurements):
+    """Add levels of source measurements, which are InfluxDB measurement dicts."""
+    sources = get_sources()
+    by_device = defaultdict(list)
+    for m in measurements:
+        field = sources.get(m['measurement'])
+        if field is not None and field in m['fields']:
+            by_device[m['tags'].get('dev-id')].append((time_to_us(m['time']), m['fields'][field]))
+    for devid, samples in by_device.items():
+        add_levels(dbname, devid, samples)
+
+
+def observe_packed(dbname, packed):
+    """Add levels of source measurements, which are packed with endpoints.lineprotocol.pack_measurements()."""
+    sources = get_sources()
+    for measurement, tags, keys, deltas, columns in packed['series']:
+        field = sources.get(measurement)
+        if field is None or field not in keys:
+            continue
+        ts = 0
+        times = []
+        for delta in deltas:
+            ts += delta
+            times.append(ts)
+        add_levels(dbname, tags.get('dev-id'), zip(times, columns[keys.index(field)]))
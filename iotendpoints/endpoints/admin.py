@@ -1,21 +1,55 @@
 from django.contrib.gis import admin
-from endpoints.models import Request, Datalogger
+from django.utils import timezone
+from endpoints.deadletter import HELD, PENDING
+from endpoints.models import Request, Datalogger, FailedWrite
+from endpoints.retention import purge_queryset
 
 
 class RequestAdmin(admin.ModelAdmin):
     search_fields = ('method', 'status', 'user')
-    list_display = ('method', 'status', 'user', 'created', 'filecount',)
+    list_display = ('method', 'status', 'user', 'created', 'filecount', 'body_size',)
+    list_filter = ('status',)
     ordering = ('created',)
 
+    def delete_queryset(self, request, queryset):
+        purge_queryset(queryset)
+
 
 admin.site.register(Request, RequestAdmin)
 
 
 class DataloggerAdmin(admin.OSMGeoAdmin):
     search_fields = ('name', 'description', 'devid')
-    list_display = ('devid', 'activity_at', 'lat', 'lon', 'name', 'description', 'created_at',)
+    list_display = ('devid', 'activity_at', 'lat', 'lon', 'name', 'description', 'decoder', 'database',
+                    'created_at',)
+    list_filter = ('decoder', 'database',)
     ordering = ('-activity_at',)
     readonly_fields = ('location',)
 
 
 admin.site.register(Datalogger, DataloggerAdmin)
+
+
+def retry_now(modeladmin, request, queryset):
+    # RETRYING rows are claimed by a running retry (see deadletter.claim()), resetting them would send them twice
+    updated = queryset.filter(status__in=[PENDING, HELD]).update(status=PENDING, next_attempt_at=timezone.now())
+    skipped = queryset.count() - updated
+    if skipped:
+        modeladmin.message_user(request, '{} writes are being retried right now and were skipped.'.format(skipped))
+
+
+retry_now.short_description = 'Retry selected writes now'
+
+
+class FailedWriteAdmin(admin.ModelAdmin):
+    search_fields = ('target', 'error')
+    list_display = ('sink', 'target', 'kind', 'status', 'error_class', 'attempts', 'point_count',
+                    'next_attempt_at', 'created_at',)
+    list_filter = ('sink', 'kind', 'status', 'target',)
+    ordering = ('-created_at',)
+    exclude = ('payload',)
+    readonly_fields = ('sink', 'target', 'kind', 'error_class', 'error', 'attempts', 'point_count',)
+    actions = [retry_now]
+
+
+admin.site.register(FailedWrite, FailedWriteAdmin)
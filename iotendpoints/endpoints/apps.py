@@ -1,5 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class EndpointsConfig(AppConfig):
     name = 'endpoints'
+
+    def ready(self):
+        from .bindings import datalogger_deleted, datalogger_saved
+        from .models import Datalogger
+        post_save.connect(datalogger_saved, sender=Datalogger, dispatch_uid='datalogger_binding_saved')
+        post_delete.connect(datalogger_deleted, sender=Datalogger, dispatch_uid='datalogger_binding_deleted')
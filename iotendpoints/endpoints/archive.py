@@ -0,0 +1,298 @@
+"""
+Parquet archive of all ingested measurements, for analytics without load on InfluxDB.
+
+Enable it as a secondary sink (see endpoints.outputs):
+
+    SINKS = {
+        'archive': {'class': 'endpoints.archive.ArchiveSink', 'path': '/var/lib/iotendpoints/archive'},
+    }
+
+Files are partitioned by database, measurement and UTC day:
+
+    <path>/<database>/<measurement>/date=2018-05-22/part-20180522T191631-1234-0.parquet
+
+Every file has columns `time` (timestamp, UTC, microseconds), `devid` and one
+column per tag (dictionary encoded strings) and one typed column per field.
+Rows are sorted by devid and time, so row group statistics let readers skip
+data of other devices and times.
+
+Points are buffered per partition in Arrow record batches of `batch_rows`
+rows and written to a new file when the partition has `rows_per_file` rows
+(default 100000) or is `file_interval` seconds old (default 900). If writing
+a file fails, the partition is kept and retried after `file_interval` seconds,
+up to `write_attempts` times (default 3) before its points are dropped.
+
+Every written file is appended as one JSON line to `_manifest.ndjson` in the
+measurement directory, with row count, time range and device ids, so
+`scan()` opens only the files which may contain the requested devices and
+time range. Requires pyarrow.
+"""
+import datetime
+import json
+import logging
+import os
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+
+from endpoints.outputs import Sink
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pc = pq = None
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = '_manifest.ndjson'
+SECOND_US = 1000000
+
+
+def column_array(values):
+    """Return Arrow array of a field column, mixed int and float values become float."""
+    types = {type(v) for v in values if v is not None}
+    if types <= {bool}:
+        return pa.array(values, type=pa.bool_())
+    if types <= {int}:
+        return pa.array(values, type=pa.int64())
+    if types <= {int, float}:
+        return pa.array([float(v) if v is not None else None for v in values], type=pa.float64())
+    return pa.array([str(v) if v is not None else None for v in values], type=pa.string())
+
+
+def common_type(types):
+    """Return Arrow type of a field column which has `types` in different batches, like column_array()."""
+    if len(types) == 1:
+        return next(iter(types))
+    if types <= {pa.int64(), pa.float64()}:
+        return pa.float64()
+    return pa.string()
+
+
+class Partition:
+    """Buffered points of one database, measurement and day."""
+
+    def __init__(self, batch_rows):
+        self.batch_rows = batch_rows
+        self.batches = []  # Arrow record batches
+        self.rows = []  # points not in a record batch yet: (devid, time, tags, fields)
+        self.row_count = 0
+        self.tag_keys = set()
+        self.created = time.monotonic()
+        self.failures = 0  # failed file writes
+
+    def add(self, devid, ts, tags, fields):
+        self.rows.append((devid, ts, tags, fields))
+        self.row_count += 1
+        if len(self.rows) >= self.batch_rows:
+            self.seal()
+
+    def seal(self):
+        """Convert buffered rows to a record batch."""
+        if not self.rows:
+            return
+        rows = self.rows
+        self.rows = []
+        tag_keys = sorted({k for r in rows for k in r[2]} - {'time', 'devid'})
+        field_keys = sorted({k for r in rows for k in r[3]})
+        names = ['time', 'devid']
+        arrays = [
+            pa.array([r[1] for r in rows], type=pa.timestamp('us', tz='UTC')),
+            pa.array([r[0] for r in rows], type=pa.string()),
+        ]
+        for k in tag_keys:
+            names.append(k)
+            arrays.append(pa.array([r[2].get(k) for r in rows], type=pa.string()))
+        for k in field_keys:
+            # a field with the same name as a tag or the time column gets a prefix
+            names.append('field_' + k if k in names else k)
+            arrays.append(column_array([r[3].get(k) for r in rows]))
+        self.tag_keys.update(tag_keys)
+        self.batches.append(pa.RecordBatch.from_arrays(arrays, names=names))
+
+    def to_table(self):
+        """
+        :return: all points as one table sorted by devid and time, devid and tags dictionary encoded
+        """
+        self.seal()
+        tables = [pa.Table.from_batches([b]) for b in self.batches]
+        # a field may be int in one batch and float or string in another, give it one type
+        types = {}
+        for t in tables:
+            for i, field in enumerate(t.schema):
+                if t.column(i).null_count < t.num_rows:  # all-null columns take the type of the others
+                    types.setdefault(field.name, set()).add(field.type)
+        for n, t in enumerate(tables):
+            for i, field in enumerate(t.schema):
+                if field.name in types:
+                    target = common_type(types[field.name])
+                    if field.type != target:
+                        t = t.set_column(i, field.name, t.column(i).cast(target))
+            tables[n] = t
+        # batches differ if tags or fields changed, missing columns become nulls
+        table = pa.concat_tables(tables, promote_options='default')
+        table = table.sort_by([('devid', 'ascending'), ('time', 'ascending')])
+        for i, name in enumerate(table.column_names):
+            if name == 'devid' or name in self.tag_keys:
+                table = table.set_column(i, name, pc.dictionary_encode(table.column(i)))
+        return table
+
+
+class ArchiveSink(Sink):
+    """
+    Daily partitioned Parquet archive in directory `path`, see module docstring. Requires pyarrow.
+    """
+
+    def __init__(self, name, path, rows_per_file=100000, file_interval=900, batch_rows=10000,
+                 row_group_rows=50000, write_attempts=3, **kwargs):
+        kwargs.setdefault('flush_interval', 10)
+        super().__init__(name, **kwargs)
+        if pa is None:
+            raise ImproperlyConfigured('ArchiveSink requires pyarrow package')
+        self.path = path
+        self.rows_per_file = int(rows_per_file)
+        self.file_interval = float(file_interval)
+        self.batch_rows = int(batch_rows)
+        self.row_group_rows = int(row_group_rows)
+        self.write_attempts = int(write_attempts)
+        self.partitions = {}  # (database, measurement, day) -> Partition
+        self.sequence = 0
+        self.files = 0
+
+    def write(self, points):
+        for dbname, measurement, tags, fields, ts in points:
+            day = datetime.datetime.utcfromtimestamp(ts // SECOND_US).strftime('%Y-%m-%d')
+            key = (dbname, measurement, day)
+            partition = self.partitions.get(key)
+            if partition is None:
+                partition = self.partitions[key] = Partition(self.batch_rows)
+            tags = dict(tags)
+            devid = tags.pop('dev-id', None)
+            partition.add(devid, ts, tags, fields)
+            if partition.row_count >= self.rows_per_file and not partition.failures:
+                self.write_file(key)
+
+    def flush(self, batch):
+        """Write points of `batch` to partitions and files of partitions older than `file_interval`."""
+        super().flush(batch)
+        now = time.monotonic()
+        for key, partition in list(self.partitions.items()):
+            if now - partition.created >= self.file_interval:
+                self.write_file(key)
+
+    def close(self):
+        for key in list(self.partitions):
+            self.write_file(key)
+
+    def write_file(self, key):
+        """
+        Write buffered points of a partition to a new file and add it to the manifest.
+        A partition which could not be written is kept for the next attempt.
+        """
+        partition = self.partitions[key]
+        dbname, measurement, day = key
+        directory = os.path.join(self.path, safe_name(dbname), safe_name(measurement))
+        self.sequence += 1
+        fname = os.path.join('date={}'.format(day), 'part-{}-{}-{}.parquet'.format(
+            datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S'), os.getpid(), self.sequence))
+        fpath = os.path.join(directory, fname)
+        try:
+            table = partition.to_table()
+            os.makedirs(os.path.dirname(fpath), exist_ok=True)
+            pq.write_table(table, fpath + '.tmp', compression='zstd', row_group_size=self.row_group_rows)
+            os.rename(fpath + '.tmp', fpath)
+            time_range = pc.min_max(table.column('time').cast(pa.int64())).as_py()
+            devids = table.column('devid').unique().to_pylist()
+            entry = {
+                'file': fname,
+                'rows': table.num_rows,
+                'time_min': time_range['min'],
+                'time_max': time_range['max'],
+                'devids': sorted(d for d in devids if d is not None),
+            }
+            # one short append per file, so processes sharing the archive do not mix lines
+            with open(os.path.join(directory, MANIFEST), 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+        except Exception as err:
+            partition.failures += 1
+            partition.created = time.monotonic()  # retry after file_interval
+            with self._stats_lock:
+                self.errors += 1
+                self.last_error = '{}: {}'.format(type(err).__name__, err)
+            logger.error('[SINK] {} failed to write {} points to {} (attempt {}/{}): {}'.format(
+                self.name, partition.row_count, fpath, partition.failures, self.write_attempts, err))
+            if partition.failures < self.write_attempts:
+                return
+            with self._stats_lock:
+                self.dropped += partition.row_count
+        else:
+            with self._stats_lock:
+                self.files += 1
+        del self.partitions[key]
+
+    def stats(self):
+        stats = super().stats()
+        partitions = list(self.partitions.values())
+        stats['open_partitions'] = len(partitions)
+        stats['buffered_rows'] = sum(p.row_count for p in partitions)
+        stats['files'] = self.files
+        return stats
+
+
+def safe_name(name):
+    """Database or measurement name as a single directory name."""
+    return str(name).replace('/', '_').replace('\\', '_').lstrip('.') or '_'
+
+
+def read_manifest(path, dbname, measurement):
+    """
+    :return: list of manifest entries of a measurement, with absolute file path in 'path'
+    """
+    directory = os.path.join(path, safe_name(dbname), safe_name(measurement))
+    entries = []
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entry['path'] = os.path.join(directory, entry['file'])
+                    entries.append(entry)
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def scan(path, dbname, measurement, devids=None, start=None, end=None, columns=None):
+    """
+    Iterate archived points. Files are picked by the manifest and rows are
+    filtered with Parquet row group statistics.
+
+    :param str path: archive directory
+    :param list devids: device ids, default all
+    :param int start: epoch microseconds, inclusive
+    :param int end: epoch microseconds, exclusive
+    :param list columns: columns to read, default all
+    :return: iterator of pyarrow.RecordBatch
+    """
+    wanted = set(devids) if devids else None
+    ts_type = pa.timestamp('us', tz='UTC')
+    filters = []
+    if wanted is not None:
+        filters.append(('devid', 'in', sorted(wanted)))
+    if start is not None:
+        filters.append(('time', '>=', pa.scalar(start, type=ts_type)))
+    if end is not None:
+        filters.append(('time', '<', pa.scalar(end, type=ts_type)))
+    for entry in read_manifest(path, dbname, measurement):
+        if start is not None and entry['time_max'] < start:
+            continue
+        if end is not None and entry['time_min'] >= end:
+            continue
+        if wanted is not None and wanted.isdisjoint(entry['devids']):
+            continue
+        table = pq.read_table(entry['path'], columns=columns, filters=filters or None)
+        for batch in table.to_batches():
+            if batch.num_rows:
+                yield batch
@@ -0,0 +1,82 @@
+"""
+In-memory map from device id to payload decoder and target database.
+
+Bindings are read from Datalogger.decoder and Datalogger.database fields. The
+whole map is loaded with one query at worker start (see iotendpoints/wsgi.py)
+and then reloaded every DECODER_BINDINGS_TTL seconds (default 300), so changes
+made in other processes are picked up. Changes saved in this process are
+applied immediately by post_save and post_delete signals (see endpoints.apps).
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from endpoints.models import Datalogger
+from endpoints.utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+Binding = namedtuple('Binding', ['decoder', 'database'])
+
+
+class DecoderBindings:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bindings = {}
+        self.loaded_at = None
+
+    def load(self):
+        bindings = {}
+        qs = Datalogger.objects.exclude(decoder='', database='').values_list('devid', 'decoder', 'database')
+        for devid, decoder, database in qs:
+            bindings[devid] = Binding(decoder or None, database or None)
+        with self.lock:
+            self.bindings = bindings
+            self.loaded_at = time.monotonic()
+        logger.info('Loaded {} decoder bindings'.format(len(bindings)))
+
+    def get(self, devid):
+        ttl = float(get_setting('DECODER_BINDINGS_TTL', 300))
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > ttl:
+            self.load()
+        return self.bindings.get(devid)
+
+    def update(self, datalogger):
+        with self.lock:
+            if datalogger.decoder or datalogger.database:
+                self.bindings[datalogger.devid] = Binding(datalogger.decoder or None, datalogger.database or None)
+            else:
+                self.bindings.pop(datalogger.devid, None)
+
+    def remove(self, devid):
+        with self.lock:
+            self.bindings.pop(devid, None)
+
+
+bindings = DecoderBindings()
+
+
+def get_binding(devid):
+    """
+    :param str devid: device id
+    :return: Binding(decoder, database) or None, if the device has no binding
+    """
+    return bindings.get(devid)
+
+
+def preload():
+    """Load bindings at worker start, don't fail start up if database is not ready."""
+    try:
+        bindings.load()
+    except Exception as err:
+        logger.error('Could not preload decoder bindings: {}'.format(err))
+
+
+def datalogger_saved(sender, instance, **kwargs):
+    bindings.update(instance)
+
+
+def datalogger_deleted(sender, instance, **kwargs):
+    bindings.remove(instance.devid)
@@ -0,0 +1,180 @@
+"""
+Request body decoding shared by the plugins.
+
+`parse_body()` returns the same Python structure whether the sender used JSON,
+CBOR (Content-Type: application/cbor) or MessagePack (application/msgpack), and
+whether the body was compressed with `Content-Encoding: gzip` or `deflate` or not.
+Any other Content-Type is parsed as UTF-8 JSON, because many devices don't set it.
+
+Decompression is done in READ_SIZE steps and stops as soon as the decompressed
+size exceeds REQUEST_BODY_MAX_BYTES (default 10 MB), so a small compressed
+body can't expand to gigabytes in memory.
+
+`iter_body_chunks()` streams the body for plugins which parse it incrementally,
+see endpoints.plugins.batchupload.
+
+CBOR support requires `cbor2` package.
+"""
+import io
+import json
+import zlib
+
+import msgpack
+
+from endpoints.utils import get_setting
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+READ_SIZE = 64 * 1024
+CBOR_TYPES = ('application/cbor',)
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+
+
+class BodyError(ValueError):
+    """Invalid request body. `status` is the HTTP status code to respond with."""
+    status = 400
+
+
+class BodyTooLarge(BodyError):
+    status = 413
+
+
+class UnsupportedMediaType(BodyError):
+    status = 415
+
+
+def get_max_bytes():
+    return int(get_setting('REQUEST_BODY_MAX_BYTES', 10 * 1024 * 1024))
+
+
+def get_content_type(request):
+    return request.META.get('CONTENT_TYPE', '').split(';')[0].strip().lower()
+
+
+def get_decompressor(request):
+    """
+    :return: tuple (encoding, zlib decompress object or None for identity)
+    :raises UnsupportedMediaType: if Content-Encoding is not supported
+    """
+    encoding = request.META.get('HTTP_CONTENT_ENCODING', '').lower().strip()
+    if encoding in ('gzip', 'x-gzip'):
+        return encoding, zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return encoding, zlib.decompressobj()
+    if encoding in ('', 'identity'):
+        return encoding, None
+    raise UnsupportedMediaType('Unsupported Content-Encoding {}'.format(encoding))
+
+
+def _decompress(decompressor, chunk, encoding):
+    """Decompress chunk in READ_SIZE parts, so a zip bomb never expands in memory at once."""
+    if decompressor is None:
+        yield chunk
+        return
+    try:
+        part = decompressor.decompress(chunk, READ_SIZE)
+        while True:
+            if part:
+                yield part
+            if not decompressor.unconsumed_tail:
+                break
+            part = decompressor.decompress(decompressor.unconsumed_tail, READ_SIZE)
+    except zlib.error as err:
+        raise BodyError('Invalid {} data: {}'.format(encoding, err))
+
+
+def _iter_decoded(request, stream, max_bytes):
+    encoding, decompressor = get_decompressor(request)
+    if max_bytes is None:
+        max_bytes = get_max_bytes()
+    total = 0
+    while True:
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            break
+        for part in _decompress(decompressor, chunk, encoding):
+            total += len(part)
+            if total > max_bytes:
+                raise BodyTooLarge('Body is larger than {} bytes'.format(max_bytes))
+            yield part
+
+
+def iter_body_chunks(request, max_bytes=None):
+    """
+    Read request body from the stream in chunks, decompress it on the fly.
+    Note that request.body can't be accessed after this.
+
+    :raises BodyError: if Content-Encoding is not supported or body is invalid
+    :raises BodyTooLarge: if decompressed body is larger than max_bytes
+    """
+    return _iter_decoded(request, request, max_bytes)
+
+
+def read_body(request, max_bytes=None, stream=None):
+    """
+    Return decompressed request body. Raw body stays available in request.body,
+    e.g. for endpoints.views.dump_request().
+
+    :param stream: file-like object to read the raw body from instead of request.body
+    :raises BodyError: if Content-Encoding is not supported or body is invalid
+    :raises BodyTooLarge: if decompressed body is larger than max_bytes
+    """
+    if stream is not None:
+        return b''.join(_iter_decoded(request, stream, max_bytes))
+    if 'HTTP_CONTENT_ENCODING' not in request.META:
+        body = request.body
+        if max_bytes is None:
+            max_bytes = get_max_bytes()
+        if len(body) > max_bytes:
+            raise BodyTooLarge('Body is larger than {} bytes'.format(max_bytes))
+        return body
+    return b''.join(_iter_decoded(request, io.BytesIO(request.body), max_bytes))
+
+
+def decode_json(body):
+    return json.loads(body.decode('utf-8'))
+
+
+def decode_msgpack(body):
+    return msgpack.unpackb(body, raw=False)
+
+
+def decode_cbor(body):
+    if cbor2 is None:
+        raise UnsupportedMediaType('CBOR is not supported, cbor2 package is not installed')
+    return cbor2.loads(body)
+
+
+def get_body_decoder(content_type):
+    """
+    :param str content_type: media type without parameters
+    :return: function which decodes bytes to Python structure
+    """
+    if content_type in CBOR_TYPES:
+        return decode_cbor
+    if content_type in MSGPACK_TYPES:
+        return decode_msgpack
+    return decode_json
+
+
+def parse_body(request, max_bytes=None, stream=None):
+    """
+    Decompress and decode request body according to Content-Encoding and Content-Type.
+
+    :param request: HttpRequest
+    :param int max_bytes: max decompressed size, default REQUEST_BODY_MAX_BYTES setting
+    :param stream: file-like object to read the raw body from instead of request.body, e.g. a dump file
+    :return: decoded body, e.g. dict
+    :raises BodyError: if body can't be decoded, see BodyError.status
+    """
+    decoder = get_body_decoder(get_content_type(request))
+    body = read_body(request, max_bytes, stream)
+    try:
+        return decoder(body)
+    except BodyError:
+        raise
+    except Exception as err:  # json, msgpack and cbor2 raise various errors for invalid data
+        raise BodyError('Invalid {} body: {}'.format(decoder.__name__[len('decode_'):], err))
@@ -0,0 +1,141 @@
+"""
+Circuit breaker for synchronous sink calls.
+
+A breaker is closed while calls succeed. After CIRCUIT_BREAKER_FAILURE_THRESHOLD
+consecutive failures it opens and calls are rejected immediately with
+CircuitOpenError, so callers can fall back without waiting for timeouts. After
+CIRCUIT_BREAKER_RESET_TIMEOUT seconds it becomes half-open and lets
+CIRCUIT_BREAKER_HALF_OPEN_CALLS trial calls through: a success closes it,
+a failure opens it again.
+
+Breakers live in process memory, so every gunicorn worker has its own.
+"""
+import logging
+import threading
+import time
+
+from endpoints.utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the breaker is open."""
+
+    def __init__(self, name):
+        super().__init__('Circuit breaker "{}" is open'.format(name))
+        self.name = name
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, half_open_calls=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0  # consecutive
+        self.opened_at = None
+        self.trial_calls = 0
+        self.trips = 0
+        self.total_calls = 0
+        self.total_failures = 0
+        self.rejected = 0
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = HALF_OPEN
+                self.trial_calls = 0
+                logger.info('Circuit breaker "{}" is half-open'.format(self.name))
+            if self.state == HALF_OPEN:
+                if self.trial_calls >= self.half_open_calls:
+                    self.rejected += 1
+                    return False
+                self.trial_calls += 1
+            self.total_calls += 1
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self.state = CLOSED
+                logger.info('Circuit breaker "{}" closed'.format(self.name))
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.total_failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.trips += 1
+                    logger.warning('Circuit breaker "{}" opened after {} failures'.format(self.name, self.failures))
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def call(self, func, *args, is_failure=None, **kwargs):
+        """
+        Call `func(*args, **kwargs)` through the breaker.
+
+        :param is_failure: function which returns True if raised exception means
+                           the backend is unhealthy. By default every exception does.
+        :raises CircuitOpenError: if the breaker is open
+        """
+        if not self.allow_request():
+            raise CircuitOpenError(self.name)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as err:
+            if is_failure is None or is_failure(err):
+                self.record_failure()
+            else:
+                self.record_success()  # backend answered, e.g. rejected the data
+            raise
+        self.record_success()
+        return result
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'name': self.name,
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'trips': self.trips,
+                'calls': self.total_calls,
+                'failures': self.total_failures,
+                'rejected': self.rejected,
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """Return process wide CircuitBreaker `name`, create it from settings if needed."""
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=int(get_setting('CIRCUIT_BREAKER_FAILURE_THRESHOLD', 5)),
+                reset_timeout=float(get_setting('CIRCUIT_BREAKER_RESET_TIMEOUT', 30)),
+                half_open_calls=int(get_setting('CIRCUIT_BREAKER_HALF_OPEN_CALLS', 1)),
+            )
+        return breaker
+
+
+def breaker_states():
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return [b.as_dict() for b in breakers]
@@ -0,0 +1,229 @@
+"""
+Dead-letter store for failed sink writes.
+
+Failed InfluxDB and Orion writes are stored as msgpack payloads in
+`FailedWrite` table instead of being dropped. Transient failures are retried
+in bulk by `retry_due()` (run periodically by `endpoints.tasks.retry_failed_writes`)
+with exponential backoff and jitter. Field type conflicts and other permanent
+errors are held for inspection, see `python manage.py deadletters`.
+
+Settings:
+
+- DEADLETTER_RETRY_BASE: first retry delay in seconds (default 30)
+- DEADLETTER_RETRY_MAX: max retry delay in seconds (default 3600)
+- DEADLETTER_MAX_ATTEMPTS: hold the write after this many attempts (default 20)
+- DEADLETTER_BATCH_SIZE: max number of failed writes retried per run (default 500)
+- DEADLETTER_CLAIM_TIMEOUT: seconds a claimed write stays RETRYING before another
+  run may take it over, if the claiming process died (default 600)
+
+Rows are claimed (locked with SKIP LOCKED and marked RETRYING) before they are
+retried, so the periodic task and the management command never replay the
+same points concurrently.
+"""
+import datetime
+import logging
+import random
+from collections import defaultdict
+
+import msgpack
+import requests
+from django.db import transaction
+from django.utils import timezone
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+
+from endpoints.influxwrite import write_packed
+from endpoints.lineprotocol import PACK_VERSION
+from endpoints.models import FailedWrite
+from endpoints.utils import get_influxdb_client, get_setting
+
+logger = logging.getLogger(__name__)
+
+TRANSIENT = 'TRANSIENT'
+CONFLICT = 'CONFLICT'
+PERMANENT = 'PERMANENT'
+
+PENDING = 'PENDING'
+RETRYING = 'RETRYING'
+HELD = 'HELD'
+
+
+def get_retry_settings():
+    return {
+        'base': float(get_setting('DEADLETTER_RETRY_BASE', 30)),
+        'max': float(get_setting('DEADLETTER_RETRY_MAX', 3600)),
+        'max_attempts': int(get_setting('DEADLETTER_MAX_ATTEMPTS', 20)),
+        'batch_size': int(get_setting('DEADLETTER_BATCH_SIZE', 500)),
+        'claim_timeout': float(get_setting('DEADLETTER_CLAIM_TIMEOUT', 600)),
+    }
+
+
+def classify_error(err):
+    """
+    Return TRANSIENT, CONFLICT or PERMANENT for exception raised by a sink write.
+    """
+    if isinstance(err, InfluxDBClientError):
+        if 'field type conflict' in str(err):
+            return CONFLICT
+        if err.code == 400:
+            return PERMANENT
+        return TRANSIENT
+    if isinstance(err, (InfluxDBServerError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return TRANSIENT
+    if isinstance(err, requests.exceptions.HTTPError) and err.response is not None:
+        return TRANSIENT if err.response.status_code >= 500 or err.response.status_code == 429 else PERMANENT
+    return TRANSIENT
+
+
+def backoff_delay(attempts, base, max_delay):
+    """
+    Exponential backoff with jitter: random delay between half and full
+    of min(max_delay, base * 2 ** (attempts - 1)) seconds.
+    """
+    delay = min(max_delay, base * 2 ** max(attempts - 1, 0))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def store_failed_write(sink, target, payload, err, point_count=0):
+    """
+    Store failed write to dead-letter table.
+
+    :param str sink: 'influxdb' or 'orion'
+    :param str target: database name or Orion URL root
+    :param payload: msgpack serializable payload, e.g. output of pack_measurements()
+    :param Exception err: exception raised by the write
+    :param int point_count: number of points in payload
+    :return: FailedWrite
+    """
+    conf = get_retry_settings()
+    kind = classify_error(err)
+    now = timezone.now()
+    failed = FailedWrite.objects.create(
+        sink=sink, target=target, kind=kind,
+        status=PENDING if kind == TRANSIENT else HELD,
+        error_class=type(err).__name__, error=str(err)[:2000],
+        payload=msgpack.packb(payload, use_bin_type=True), point_count=point_count,
+        next_attempt_at=now + datetime.timedelta(seconds=backoff_delay(1, conf['base'], conf['max'])),
+        created_at=now, updated_at=now,
+    )
+    logger.warning('[DEADLETTER] Stored failed {} write to {}: {} {}'.format(sink, target, kind, err))
+    return failed
+
+
+def load_payload(failed):
+    return msgpack.unpackb(bytes(failed.payload), raw=False)
+
+
+def _write_influxdb(dbname, packed):
+    iclient = get_influxdb_client(database=dbname)
+    iclient.create_database(dbname)
+    write_packed(iclient, dbname, packed)
+
+
+def _write_orion(url_root, entities):
+    """Create or update `entities` with one NGSI v2 batch update request."""
+    resp = requests.post('{}/op/update?options=keyValues'.format(url_root),
+                         auth=(get_setting('ORION_USERNAME'), get_setting('ORION_PASSWORD')),
+                         json={'actionType': 'append', 'entities': entities})
+    resp.raise_for_status()
+
+
+def _write_group(sink, target, rows):
+    if sink == 'influxdb':
+        series = []
+        for row in rows:
+            series += load_payload(row)['series']
+        _write_influxdb(target, {'v': PACK_VERSION, 'series': series})
+    else:
+        _write_orion(target, [load_payload(row)['data'] for row in rows])
+
+
+def _reschedule(rows, err, conf, now):
+    kind = classify_error(err)
+    for row in rows:
+        row.attempts += 1
+        row.kind = kind
+        row.error_class = type(err).__name__
+        row.error = str(err)[:2000]
+        row.updated_at = now
+        row.status = PENDING if kind == TRANSIENT and row.attempts < conf['max_attempts'] else HELD
+        row.next_attempt_at = now + datetime.timedelta(
+            seconds=backoff_delay(row.attempts, conf['base'], conf['max']))
+        row.save(update_fields=['attempts', 'kind', 'error_class', 'error', 'status',
+                                'next_attempt_at', 'updated_at'])
+
+
+def claim(queryset, limit=None):
+    """
+    Claim failed writes for retrying. Rows locked by another transaction are
+    skipped, claimed rows are marked RETRYING until DEADLETTER_CLAIM_TIMEOUT.
+
+    :param queryset: FailedWrite queryset to claim from
+    :param int limit: max number of rows to claim, None for all
+    :return: list of claimed FailedWrite
+    """
+    now = timezone.now()
+    lease_until = now + datetime.timedelta(seconds=get_retry_settings()['claim_timeout'])
+    with transaction.atomic():
+        rows = list(queryset.select_for_update(skip_locked=True).order_by('next_attempt_at')[:limit])
+        FailedWrite.objects.filter(id__in=[row.id for row in rows]).update(
+            status=RETRYING, next_attempt_at=lease_until, updated_at=now)
+    for row in rows:
+        row.status = RETRYING
+        row.next_attempt_at = lease_until
+    return rows
+
+
+def retry_failed(rows):
+    """
+    Retry claimed failed writes (see claim()) grouped by sink and target, one bulk write per group.
+    Successfully written rows are deleted. If bulk write fails with a conflict,
+    rows are retried one by one to isolate the conflicting ones.
+
+    :param rows: iterable of FailedWrite
+    :return: (number of written rows, number of failed rows)
+    """
+    conf = get_retry_settings()
+    groups = defaultdict(list)
+    for row in rows:
+        groups[(row.sink, row.target)].append(row)
+    written = failed = 0
+    for (sink, target), group in groups.items():
+        now = timezone.now()
+        try:
+            _write_group(sink, target, group)
+        except Exception as err:
+            if len(group) > 1 and classify_error(err) != TRANSIENT:
+                for row in group:
+                    w, f = retry_failed([row])
+                    written += w
+                    failed += f
+                continue
+            logger.warning('[DEADLETTER] Retry of {} {} writes to {} failed: {}'.format(len(group), sink, target, err))
+            _reschedule(group, err, conf, now)
+            failed += len(group)
+        else:
+            FailedWrite.objects.filter(id__in=[row.id for row in group]).delete()
+            written += len(group)
+    return written, failed
+
+
+def retry_due(limit=None, due_only=True):
+    """
+    Claim and retry pending failed writes whose next attempt time has passed.
+    Rows left RETRYING by a died process are taken over after their claim has expired.
+
+    :param int limit: max number of rows to retry, defaults to DEADLETTER_BATCH_SIZE if `due_only`
+    :param bool due_only: if False, retry all pending writes now
+    :return: (number of written rows, number of failed rows)
+    """
+    now = timezone.now()
+    if due_only:
+        if limit is None:
+            limit = get_retry_settings()['batch_size']
+        queryset = FailedWrite.objects.filter(status__in=[PENDING, RETRYING], next_attempt_at__lte=now)
+    else:
+        queryset = FailedWrite.objects.filter(status=PENDING)
+    rows = claim(queryset, limit)
+    if not rows:
+        return 0, 0
+    return retry_failed(rows)
@@ -0,0 +1,240 @@
+"""
+Table-driven binary payload decoders for LoRaWAN devices.
+
+A decoder is declared with a format spec. Every field has a name, byte offset,
+`struct` format code, scale and offset, and its value is `raw * scale + offset`,
+optionally rounded. Scale can be given as a [numerator, denominator] pair to avoid
+float artefacts, e.g. [1, 10] gives 3.3 instead of 33 * 0.1 = 3.3000000000000003:
+
+    'aqburk': {
+        'description': 'FVH AQ burk',
+        'measurement': 'aqburk',
+        'database': 'aqburk',
+        'fields': [
+            ['pm25min', 2, 'H', [1, 10]],
+            ['temp', 18, 'H', [1, 10], -100, 1],  # name, offset, code, scale, offset, round digits
+            ...
+        ],
+    }
+
+Only decoders with 'db_param': True let the caller override the database with
+?db= request parameter (AQ burks are written to per-project databases).
+
+Specs are compiled to `struct.Struct` objects, so decoding a payload is a
+single C-level unpack. Payloads may be shorter than the full spec, then only
+the fields which fit are decoded (e.g. AQ burk without BME680). New device
+types can be added without code in PAYLOAD_DECODERS setting, which has the same
+format as DECODER_SPECS below.
+
+`decode_batch()` decodes many payloads of one device type with one
+`struct.iter_unpack()` per payload length, for backfills.
+"""
+import binascii
+import struct
+from collections import defaultdict
+
+from endpoints.utils import get_setting
+
+DECODER_SPECS = {
+    'paxcounter': {
+        'description': 'paxcounter',
+        'measurement': 'wifi-ble',
+        'database': 'paxcounter',
+        'fields': [
+            ['wifi', 0, 'H'],
+            ['ble', 2, 'H'],
+        ],
+    },
+    'clickey_tempsens': {
+        'description': 'Clickey Tempsens PRO',
+        'measurement': 'tempsens',
+        'database': 'digita',
+        'fields': [
+            ['temp1', 1, 'H', [300, 4095], -50],
+            ['temp2', 3, 'H', [300, 4095], -50],
+            ['volt', 5, 'B', [1, 230], 2.4],
+        ],
+    },
+    'aqburk': {
+        'description': 'FVH AQ burk',
+        'measurement': 'aqburk',
+        'database': 'aqburk',
+        'db_param': True,
+        'fields': [
+            ['pm25min', 2, 'H', [1, 10]],
+            ['pm25max', 4, 'H', [1, 10]],
+            ['pm25avg', 6, 'H', [1, 10]],
+            ['pm25med', 8, 'H', [1, 10]],
+            ['pm10min', 10, 'H', [1, 10]],
+            ['pm10max', 12, 'H', [1, 10]],
+            ['pm10avg', 14, 'H', [1, 10]],
+            ['pm10med', 16, 'H', [1, 10]],
+            ['temp', 18, 'H', [1, 10], -100, 1],
+            ['humi', 20, 'H', [1, 10]],
+            ['pres', 22, 'H', [1, 10]],
+            ['gas', 24, 'H', [1, 10]],
+        ],
+    },
+}
+
+
+class DecodeError(ValueError):
+    pass
+
+
+class StructDecoder:
+    """
+    Decoder compiled from a format spec, see module docstring.
+    """
+
+    def __init__(self, name, spec):
+        self.name = name
+        self.description = spec.get('description', name)
+        self.measurement = spec.get('measurement', name)
+        self.database = spec.get('database')
+        self.db_param = spec.get('db_param', False)
+        self.byteorder = spec.get('byteorder', '>')
+        self.fields = []
+        for f in spec['fields']:
+            fname, offset, code = f[0], int(f[1]), f[2]
+            scale = f[3] if len(f) > 3 else 1
+            num, den = scale if isinstance(scale, (list, tuple)) else (scale, 1)
+            add = f[4] if len(f) > 4 else 0
+            digits = f[5] if len(f) > 5 else None
+            self.fields.append((fname, offset, code, num, den, add, digits))
+        self.fields.sort(key=lambda x: x[1])
+        self._compiled = {}  # payload length -> (Struct, fields which fit)
+
+    def _compile(self, length):
+        compiled = self._compiled.get(length)
+        if compiled is None:
+            fmt = self.byteorder
+            pos = 0
+            fields = []
+            for f in self.fields:
+                size = struct.calcsize(self.byteorder + f[2])
+                if f[1] < pos:
+                    raise DecodeError('Overlapping fields in decoder {}'.format(self.name))
+                if f[1] + size > length:
+                    break
+                if f[1] > pos:
+                    fmt += '{}x'.format(f[1] - pos)
+                fmt += f[2]
+                pos = f[1] + size
+                fields.append(f)
+            if not fields:
+                raise DecodeError('Payload of {} bytes is too short for decoder {}'.format(length, self.name))
+            compiled = self._compiled[length] = (struct.Struct(fmt), fields)
+        return compiled
+
+    @staticmethod
+    def _convert(fields, raw):
+        data = {}
+        for f, value in zip(fields, raw):
+            if f[3] != 1 or f[4] != 1 or f[5] != 0:
+                value = value * f[3] / f[4] + f[5]
+            if f[6] is not None:
+                value = round(value, f[6])
+            data[f[0]] = value
+        return data
+
+    def decode(self, payload):
+        """
+        :param bytes payload: raw payload
+        :return: dict of decoded values
+        :raises DecodeError: if payload is too short
+        """
+        s, fields = self._compile(len(payload))
+        return self._convert(fields, s.unpack_from(payload))
+
+    def decode_hex(self, payload_hex):
+        try:
+            return self.decode(bytes.fromhex(payload_hex))
+        except ValueError as err:
+            raise DecodeError(str(err))
+
+    def decode_batch(self, payloads):
+        """
+        Decode list of raw payloads, one struct.iter_unpack() per payload length.
+
+        :param list payloads: bytes
+        :return: list of dicts in the same order as payloads
+        """
+        by_length = defaultdict(list)
+        for i, payload in enumerate(payloads):
+            by_length[len(payload)].append(i)
+        result = [None] * len(payloads)
+        for length, indexes in by_length.items():
+            s, fields = self._compile(length)
+            if s.size != length:  # trailing bytes are ignored, cut them off for iter_unpack
+                buf = b''.join(payloads[i][:s.size] for i in indexes)
+            else:
+                buf = b''.join(payloads[i] for i in indexes)
+            for i, raw in zip(indexes, s.iter_unpack(buf)):
+                result[i] = self._convert(fields, raw)
+        return result
+
+
+class KeyValDecoder:
+    """
+    Decoder for UTF-8 "key=val,key2=val2" payloads. Measurement is the sorted keys joined with '_'.
+    """
+    name = 'keyval'
+    description = 'LoRaWAN device'
+    measurement = None
+    database = 'digita'
+    db_param = False
+
+    def decode(self, payload):
+        try:
+            keyvals = [x.split('=') for x in payload.decode().split(',')]  # --> [['temp', '24.61'], ...]
+            return {x[0]: float(x[1]) for x in keyvals}
+        except (UnicodeDecodeError, IndexError, ValueError) as err:
+            raise DecodeError(str(err))
+
+    def decode_hex(self, payload_hex):
+        try:
+            return self.decode(binascii.unhexlify(payload_hex))
+        except binascii.Error as err:
+            raise DecodeError(str(err))
+
+    def decode_batch(self, payloads):
+        return [self.decode(p) for p in payloads]
+
+
+_decoders = None
+
+
+def get_decoders():
+    """Return dict of all decoders, built-in and PAYLOAD_DECODERS setting."""
+    global _decoders
+    if _decoders is None:
+        specs = dict(DECODER_SPECS)
+        specs.update(get_setting('PAYLOAD_DECODERS', {}) or {})
+        decoders = {name: StructDecoder(name, spec) for name, spec in specs.items()}
+        decoders['keyval'] = KeyValDecoder()
+        _decoders = decoders
+    return _decoders
+
+
+def get_decoder(name):
+    """
+    :param str name: device type
+    :return: decoder or None
+    """
+    return get_decoders().get(name)
+
+
+def guess_decoder(payload_hex):
+    """
+    Guess device type from payload length and prefix, for devices which have no decoder set.
+    """
+    if len(payload_hex) == 8:
+        return 'paxcounter'
+    if payload_hex[:2] == '13':
+        return 'clickey_tempsens'
+    if payload_hex[:2].lower() == '2a':
+        return 'aqburk'
+    if len(payload_hex) >= 2:
+        return 'keyval'
+    return None
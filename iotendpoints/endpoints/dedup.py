@@ -0,0 +1,131 @@
+"""
+Deduplication of LoRaWAN uplinks heard by several gateways.
+
+`is_duplicate()` remembers uplink keys, (DevEUI, FCnt) or a payload hash,
+for DEDUP_TTL seconds in a bounded LRU. Plugins acknowledge duplicates
+immediately without any I/O. If handling an uplink fails, plugins call
+`forget()`, so the gateway's retry is handled instead of acknowledged.
+
+Set DEDUP_CACHE to a Django cache alias (see CACHES setting, e.g. memcached or
+file based cache) to share seen keys between gunicorn workers. By default
+every worker process remembers only the uplinks it has handled itself.
+
+Settings:
+
+- DEDUP_TTL: seconds to remember an uplink (default 60)
+- DEDUP_MAX_KEYS: max number of keys in the in-process LRU (default 100000)
+- DEDUP_CACHE: optional Django cache alias
+"""
+import hashlib
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.core.cache import caches
+
+from endpoints.utils import get_setting
+
+
+class SeenKeys:
+    """Time and size bounded LRU of seen keys."""
+
+    def __init__(self, ttl=60.0, max_keys=100000):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.keys = OrderedDict()  # key -> expiry time, oldest first
+
+    def add(self, key, now=None):
+        """
+        Remember `key`. Return False if it was already seen within ttl.
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            expires = self.keys.get(key)
+            if expires is not None and expires > now:
+                return False
+            self.keys[key] = now + self.ttl
+            self.keys.move_to_end(key)
+            # Expire old keys from the head, they were added first
+            while self.keys:
+                oldest_key, oldest_expires = next(iter(self.keys.items()))
+                if oldest_expires > now and len(self.keys) <= self.max_keys:
+                    break
+                self.keys.popitem(last=False)
+            return True
+
+    def discard(self, key):
+        with self.lock:
+            self.keys.pop(key, None)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+_seen = None
+_seen_lock = threading.Lock()
+suppressed = Counter()  # devid -> number of suppressed duplicates
+_suppressed_lock = threading.Lock()
+
+
+def get_seen_keys():
+    global _seen
+    if _seen is None:
+        with _seen_lock:
+            if _seen is None:
+                _seen = SeenKeys(ttl=float(get_setting('DEDUP_TTL', 60)),
+                                 max_keys=int(get_setting('DEDUP_MAX_KEYS', 100000)))
+    return _seen
+
+
+def uplink_key(plugin, devid, fcnt=None, payload=None):
+    """
+    Return dedup key of an uplink: frame counter if available, otherwise hash of payload.
+    """
+    if fcnt is not None:
+        return 'dedup:{}:{}:{}'.format(plugin, devid, fcnt)
+    digest = hashlib.sha1(str(payload).encode()).hexdigest()
+    return 'dedup:{}:{}:h{}'.format(plugin, devid, digest)
+
+
+def is_duplicate(plugin, devid, fcnt=None, payload=None):
+    """
+    Return True if the same uplink has been seen within DEDUP_TTL seconds.
+
+    :param str plugin: plugin name, keeps keys of different networks apart
+    :param str devid: DevEUI
+    :param fcnt: uplink frame counter, if available
+    :param payload: used for content hash if fcnt is not available, include time in it
+    """
+    key = uplink_key(plugin, devid, fcnt, payload)
+    cache_alias = get_setting('DEDUP_CACHE')
+    if cache_alias:
+        first = caches[cache_alias].add(key, 1, timeout=float(get_setting('DEDUP_TTL', 60)))
+    else:
+        first = get_seen_keys().add(key)
+    if not first:
+        with _suppressed_lock:
+            suppressed[devid] += 1
+    return not first
+
+
+def forget(plugin, devid, fcnt=None, payload=None):
+    """
+    Forget an uplink remembered by is_duplicate(), after handling it has failed.
+    Takes the same arguments as is_duplicate().
+    """
+    key = uplink_key(plugin, devid, fcnt, payload)
+    cache_alias = get_setting('DEDUP_CACHE')
+    if cache_alias:
+        caches[cache_alias].delete(key)
+    else:
+        get_seen_keys().discard(key)
+
+
+def stats():
+    return {
+        'seen_keys': len(get_seen_keys()),
+        'suppressed': sum(suppressed.values()),
+        'suppressed_by_device': dict(suppressed.most_common()),
+    }
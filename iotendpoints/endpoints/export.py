@@ -0,0 +1,225 @@
+"""
+Bulk export of device time ranges from InfluxDB as CSV, NDJSON or Parquet.
+
+The time range is read in EXPORT_CHUNK_HOURS (default 24) long queries and
+every query is read as a stream of InfluxDB result chunks, so memory use
+does not depend on the length of the range. Output columns are fixed before
+the first row from SHOW TAG KEYS and SHOW FIELD KEYS of the measurements:
+
+    time, measurement, dev-id, <other tags>, <fields>
+
+Used by /export view and `manage.py exportdata` command.
+"""
+import csv
+import datetime
+import io
+import json
+import zlib
+
+from endpoints.lineprotocol import time_to_us
+from endpoints.utils import get_influxdb_client, get_setting
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+FIELD_TYPES = {'float': 'float', 'integer': 'integer', 'boolean': 'boolean', 'string': 'string'}
+SECOND_US = 1000000
+
+
+class ExportError(ValueError):
+    pass
+
+
+def quote_identifier(name):
+    return '"{}"'.format(name.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def quote_string(value):
+    return "'{}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def us_to_iso(ts):
+    return (datetime.datetime(1970, 1, 1) + datetime.timedelta(microseconds=ts)).isoformat() + 'Z'
+
+
+class Export:
+    """
+    Export of one database.
+
+    :param str dbname: InfluxDB database
+    :param list measurements: measurement names
+    :param list devids: device ids, empty list exports all devices
+    :param start: start time, inclusive, see endpoints.lineprotocol.time_to_us()
+    :param end: end time, exclusive
+    """
+
+    def __init__(self, dbname, measurements, devids, start, end, chunk_hours=None, chunk_size=None):
+        if not measurements:
+            raise ExportError('measurement is missing')
+        self.dbname = dbname
+        self.measurements = list(measurements)
+        self.devids = list(devids or [])
+        self.start = time_to_us(start)
+        self.end = time_to_us(end)
+        if self.start >= self.end:
+            raise ExportError('start must be before end')
+        self.chunk_us = int(float(chunk_hours or get_setting('EXPORT_CHUNK_HOURS', 24)) * 3600 * SECOND_US)
+        self.chunk_size = int(chunk_size or get_setting('EXPORT_QUERY_CHUNK_SIZE', 10000))
+        self.iclient = get_influxdb_client(database=dbname, timeout=300)
+        self.tags, self.fields = self.get_columns()
+        self.rows = 0
+
+    def get_columns(self):
+        """
+        :return: tuple (tag keys, {field key: type}), 'dev-id' first in tags
+        """
+        names = ', '.join(quote_identifier(m) for m in self.measurements)
+        tags = set()
+        for series in self.iclient.query('SHOW TAG KEYS FROM {}'.format(names)).raw.get('series', []):
+            tags.update(v[0] for v in series['values'])
+        fields = {}
+        for series in self.iclient.query('SHOW FIELD KEYS FROM {}'.format(names)).raw.get('series', []):
+            for key, ftype in series['values']:
+                if key in tags:
+                    continue  # SELECT * returns the tag, field is available as "key"::field only
+                if fields.get(key, ftype) != ftype:
+                    ftype = 'string'  # different types in different measurements
+                fields[key] = FIELD_TYPES.get(ftype, 'string')
+        tags.discard('dev-id')
+        return ['dev-id'] + sorted(tags), dict(sorted(fields.items()))
+
+    @property
+    def columns(self):
+        return ['time', 'measurement'] + self.tags + list(self.fields)
+
+    def queries(self):
+        """Yield (measurement, InfluxQL query) of every time chunk."""
+        where = ''
+        if self.devids:
+            where = ' AND ({})'.format(' OR '.join('"dev-id" = {}'.format(quote_string(d)) for d in self.devids))
+        for chunk_start in range(self.start, self.end, self.chunk_us):
+            chunk_end = min(chunk_start + self.chunk_us, self.end)
+            for measurement in self.measurements:
+                yield measurement, 'SELECT * FROM {} WHERE time >= {}u AND time < {}u{} ORDER BY time'.format(
+                    quote_identifier(measurement), chunk_start, chunk_end, where)
+
+    def iter_rows(self):
+        """
+        Yield rows as lists in the order of self.columns, time is epoch microseconds.
+        """
+        columns = self.columns
+        for measurement, query in self.queries():
+            result = self.iclient.query(query, epoch='u', chunked=True, chunk_size=self.chunk_size)
+            for resultset in result:
+                for series in resultset.raw.get('series', []):
+                    index = [columns.index(c) if c in columns else None for c in series['columns']]
+                    for values in series['values']:
+                        row = [None] * len(columns)
+                        row[1] = measurement
+                        for i, v in zip(index, values):
+                            if i is not None:
+                                row[i] = v
+                        self.rows += 1
+                        yield row
+
+    def iter_csv(self):
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(self.columns)
+        for n, row in enumerate(self.iter_rows()):
+            row[0] = us_to_iso(row[0])
+            writer.writerow(row)
+            if n % 1000 == 999:
+                yield buf.getvalue().encode('utf-8')
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue().encode('utf-8')
+
+    def iter_ndjson(self):
+        columns = self.columns
+        lines = []
+        for row in self.iter_rows():
+            row[0] = us_to_iso(row[0])
+            lines.append(json.dumps({k: v for k, v in zip(columns, row) if v is not None}))
+            if len(lines) >= 1000:
+                yield ('\n'.join(lines) + '\n').encode('utf-8')
+                lines = []
+        if lines:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def iter_parquet(self, row_group_rows=50000):
+        """Yield Parquet file in pieces, one row group per `row_group_rows` rows."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        types = {'float': pa.float64(), 'integer': pa.int64(), 'boolean': pa.bool_(), 'string': pa.string()}
+        schema = pa.schema(
+            [('time', pa.timestamp('us', tz='UTC')), ('measurement', pa.dictionary(pa.int32(), pa.string()))] +
+            [(t, pa.dictionary(pa.int32(), pa.string())) for t in self.tags] +
+            [(f, types[ftype]) for f, ftype in self.fields.items()])
+        out = _ByteQueue()
+        writer = pq.ParquetWriter(out, schema, compression='zstd')
+        rows = []
+
+        def write_rows():
+            columns = list(zip(*rows))
+            arrays = []
+            for field, values in zip(schema, columns):
+                if field.type == pa.string():
+                    values = [None if v is None else str(v) for v in values]
+                elif field.type == pa.float64():
+                    values = [None if v is None else float(v) for v in values]
+                arrays.append(pa.array(values, type=field.type))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+        for row in self.iter_rows():
+            rows.append(row)
+            if len(rows) >= row_group_rows:
+                write_rows()
+                rows = []
+                yield out.pop()
+        if rows:
+            write_rows()
+        writer.close()
+        yield out.pop()
+
+    def iter_bytes(self, fmt):
+        if fmt not in FORMATS:
+            raise ExportError('Unsupported format "{}", use one of {}'.format(fmt, ', '.join(FORMATS)))
+        return getattr(self, 'iter_' + fmt)()
+
+
+class _ByteQueue(io.RawIOBase):
+    """Write-only file object for pyarrow, pop() returns bytes written since previous pop()."""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def gzip_stream(chunks, level=6):
+    """Compress iterator of bytes to gzip format."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
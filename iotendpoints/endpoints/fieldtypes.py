@@ -0,0 +1,209 @@
+"""
+Field type registry, which prevents InfluxDB field type conflicts.
+
+InfluxDB rejects a whole write if one field value has a different type than
+the field already has in the shard (e.g. integer 21 to a float field). Before
+packed measurements are written, every field value is checked against the
+field types of the database, learned with SHOW FIELD KEYS and cached for
+FIELD_TYPES_TTL seconds (default 3600) per process:
+
+- values which convert without loss are coerced, e.g. integer to float,
+  21.0 to integer, numeric string to float and anything to string
+- other values are quarantined: they are removed from the write and stored
+  to the dead-letter table as held CONFLICT writes, see `manage.py deadletters`
+
+Values of a new field decide its type: float if they are integers and
+floats, otherwise the type of the first value. Coerced and quarantined
+values are counted per database, measurement, field and type change in
+`drift`, see /status/fieldtypes.
+"""
+import logging
+import math
+import threading
+import time
+from collections import Counter
+
+from influxdb.exceptions import InfluxDBClientError
+
+from endpoints.deadletter import store_failed_write
+from endpoints.lineprotocol import iter_packed, pack_measurements
+from endpoints.utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+drift = Counter()  # (dbname, measurement, field, expected type, value type, 'coerced' or 'quarantined') -> count
+_drift_lock = threading.Lock()
+
+
+def value_type(value):
+    """Return InfluxDB field type of Python value."""
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'integer'
+    if isinstance(value, float):
+        return 'float'
+    return 'string'
+
+
+def coerce(value, expected):
+    """
+    Convert `value` to InfluxDB field type `expected` without loss.
+
+    :return: converted value
+    :raises ValueError: if the value can not be converted without loss
+    """
+    actual = value_type(value)
+    if actual == expected:
+        return value
+    if expected == 'string':
+        return str(value).lower() if actual == 'boolean' else str(value)
+    if expected == 'float' and actual in ('integer', 'string'):
+        converted = float(value)
+        if math.isfinite(converted):
+            return converted
+    elif expected == 'integer':
+        if actual == 'float' and value.is_integer():
+            return int(value)
+        if actual == 'string':
+            return int(value)
+    elif expected == 'boolean':
+        if actual == 'string' and value.lower() in ('true', 'false'):
+            return value.lower() == 'true'
+        if actual == 'integer' and value in (0, 1):
+            return bool(value)
+    raise ValueError('{} value {!r} to {} field'.format(actual, value, expected))
+
+
+class FieldTypeRegistry:
+    """Field types by database and measurement: {dbname: (loaded at, {measurement: {field: type}})}"""
+
+    def __init__(self, ttl=3600.0):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.databases = {}
+
+    def get(self, iclient, dbname):
+        """
+        :return: {measurement: {field: type}} of database `dbname`, query it from InfluxDB if not cached
+        """
+        now = time.monotonic()
+        with self.lock:
+            cached = self.databases.get(dbname)
+        if cached is not None and now - cached[0] < self.ttl:
+            return cached[1]
+        schema = {}
+        try:
+            result = iclient.query('SHOW FIELD KEYS', database=dbname)
+            for series in result.raw.get('series', []):
+                schema[series['name']] = {key: ftype for key, ftype in series.get('values', [])}
+        except InfluxDBClientError as err:
+            if 'database not found' not in str(err):
+                raise
+        with self.lock:
+            self.databases[dbname] = (now, schema)
+        return schema
+
+    def learn(self, dbname, measurement, fields):
+        """Remember types of new fields which are about to be written."""
+        with self.lock:
+            cached = self.databases.get(dbname)
+            if cached is not None:
+                known = cached[1].setdefault(measurement, {})
+                for k, ftype in fields.items():
+                    known.setdefault(k, ftype)
+
+    def invalidate(self, dbname):
+        with self.lock:
+            self.databases.pop(dbname, None)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = FieldTypeRegistry(ttl=float(get_setting('FIELD_TYPES_TTL', 3600)))
+    return _registry
+
+
+def _count(key):
+    with _drift_lock:
+        if key not in drift:
+            logger.warning('[FIELDTYPES] {}.{} field {}: {} expected, got {}, {}'.format(*key))
+        drift[key] += 1
+
+
+def new_field_type(values):
+    """Return type of a new field: float if values are integers and floats, otherwise type of the first value."""
+    types = {value_type(v) for v in values}
+    if types == {'integer', 'float'}:
+        return 'float'
+    return value_type(values[0])
+
+
+def check_packed(iclient, dbname, packed):
+    """
+    Coerce field values of packed measurements to the field types of database `dbname`.
+
+    :param iclient: InfluxDBClient used to query field types
+    :param dict packed: see endpoints.lineprotocol.pack_measurements()
+    :return: tuple (packed measurements to write, quarantined packed measurements or None)
+    """
+    registry = get_registry()
+    schema = registry.get(iclient, dbname)
+    series_ok = []
+    rows_ok = []  # measurement dicts of series which had quarantined values
+    rows_quarantined = []
+    for measurement, tags, keys, deltas, columns in packed['series']:
+        bad = {}  # row -> {field: value}
+        for i, k in enumerate(keys):
+            column = columns[i]
+            expected = schema.get(measurement, {}).get(k)
+            if expected is None:
+                expected = new_field_type(column)
+                registry.learn(dbname, measurement, {k: expected})
+            for row, value in enumerate(column):
+                try:
+                    converted = coerce(value, expected)
+                except (ValueError, TypeError):
+                    bad.setdefault(row, {})[k] = value
+                    _count((dbname, measurement, k, expected, value_type(value), 'quarantined'))
+                    continue
+                if converted is not value:
+                    column[row] = converted
+                    _count((dbname, measurement, k, expected, value_type(value), 'coerced'))
+        if not bad:
+            series_ok.append([measurement, tags, keys, deltas, columns])
+            continue
+        series = {'v': packed['v'], 'series': [[measurement, tags, keys, deltas, columns]]}
+        for row, (_, _, fields, ts) in enumerate(iter_packed(series)):
+            for k, value in bad.get(row, {}).items():
+                del fields[k]
+                rows_quarantined.append({'measurement': measurement, 'tags': tags, 'time': ts, 'fields': {k: value}})
+            if fields:
+                rows_ok.append({'measurement': measurement, 'tags': tags, 'time': ts, 'fields': fields})
+    if rows_ok:
+        series_ok += pack_measurements(rows_ok)['series']
+    quarantined = pack_measurements(rows_quarantined) if rows_quarantined else None
+    return {'v': packed['v'], 'series': series_ok}, quarantined
+
+
+def quarantine(dbname, quarantined):
+    """Store quarantined measurements to dead-letter table as a held field type conflict."""
+    count = sum(len(s[3]) for s in quarantined['series'])
+    err = InfluxDBClientError('field type conflict: {} values do not match field types of {}'.format(count, dbname),
+                              code=400)
+    store_failed_write('influxdb', dbname, quarantined, err, point_count=count)
+
+
+def stats():
+    with _drift_lock:
+        return [
+            {'db': k[0], 'measurement': k[1], 'field': k[2], 'expected': k[3], 'got': k[4], 'action': k[5],
+             'count': n} for k, n in sorted(drift.items())
+        ]
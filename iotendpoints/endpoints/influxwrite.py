@@ -0,0 +1,96 @@
+"""
+Compact InfluxDB writes: line protocol with the coarsest lossless timestamp
+precision, gzip compressed.
+
+Most devices report at second resolution, so a batch whose timestamps are
+all whole seconds is written with precision 's', which saves up to 9 digits
+per line. Bodies of at least INFLUXDB_GZIP_MIN_BYTES (default 1024) are sent
+with Content-Encoding: gzip at level INFLUXDB_GZIP_LEVEL (default 5), set
+INFLUXDB_GZIP = False to disable it.
+
+Written points and bytes before and after compression are counted per process
+in `stats`, see /status/influxdb.
+"""
+import threading
+import zlib
+from collections import Counter
+
+from endpoints.lineprotocol import packed_times, packed_to_lines
+from endpoints.utils import get_setting
+
+# InfluxDB precisions from the coarsest to the finest, in microseconds
+PRECISIONS = (('h', 3600000000), ('m', 60000000), ('s', 1000000), ('ms', 1000), ('u', 1))
+
+stats = Counter()  # writes, points, lines_bytes, wire_bytes, gzipped, precision_<p>
+_stats_lock = threading.Lock()
+
+
+def coarsest_precision(timestamps):
+    """
+    :param timestamps: iterable of epoch microseconds
+    :return: tuple (InfluxDB precision name, precision in microseconds) which keeps all timestamps exact
+    """
+    candidates = list(PRECISIONS)
+    for ts in timestamps:
+        while candidates[0][1] > 1 and ts % candidates[0][1]:
+            candidates.pop(0)
+        if candidates[0][1] == 1:
+            break
+    return candidates[0]
+
+
+def gzip_body(body, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def write_lines(iclient, dbname, lines, precision='u'):
+    """
+    Write line protocol lines to InfluxDB, gzip compressed if they are long enough.
+
+    :param iclient: InfluxDBClient
+    :param str dbname: database name
+    :param list lines: line protocol strings with timestamps in `precision`
+    :param str precision: InfluxDB precision of the timestamps
+    :raises InfluxDBClientError: if InfluxDB rejects the write
+    """
+    if not lines:
+        return
+    body = ('\n'.join(lines) + '\n').encode('utf-8')
+    headers = {'Content-Type': 'application/octet-stream', 'Accept': 'text/plain'}
+    data = body
+    gzipped = False
+    if get_setting('INFLUXDB_GZIP', True) and len(body) >= int(get_setting('INFLUXDB_GZIP_MIN_BYTES', 1024)):
+        data = gzip_body(body, int(get_setting('INFLUXDB_GZIP_LEVEL', 5)))
+        headers['Content-Encoding'] = 'gzip'
+        gzipped = True
+    iclient.request(url='write', method='POST', params={'db': dbname, 'precision': precision}, data=data,
+                    expected_response_code=204, headers=headers)
+    with _stats_lock:
+        stats['writes'] += 1
+        stats['points'] += len(lines)
+        stats['lines_bytes'] += len(body)
+        stats['wire_bytes'] += len(data)
+        stats['gzipped'] += gzipped
+        stats['precision_' + precision] += 1
+
+
+def write_packed(iclient, dbname, packed):
+    """
+    Write packed measurements with the coarsest lossless precision.
+
+    :param dict packed: see endpoints.lineprotocol.pack_measurements()
+    :return: number of written points
+    """
+    precision, precision_us = coarsest_precision(packed_times(packed))
+    lines = packed_to_lines(packed, precision_us)
+    write_lines(iclient, dbname, lines, precision)
+    return len(lines)
+
+
+def get_stats():
+    with _stats_lock:
+        data = dict(stats)
+    if data.get('lines_bytes'):
+        data['compression_ratio'] = round(data['wire_bytes'] / data['lines_bytes'], 3)
+    return data
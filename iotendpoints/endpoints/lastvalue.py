@@ -0,0 +1,150 @@
+"""
+Last-value cache: the latest reading of every device and measurement.
+
+The cache is updated with `update_packed()` by endpoints.sinks and
+endpoints.tasks after raw readings have been written to InfluxDB successfully
+(rollups and dead-letter retries are skipped) and served by
+`endpoints.views.latest`, so latest value queries never touch InfluxDB.
+An older reading (e.g. a backfill) never overwrites a newer one.
+
+By default values are kept in process memory. Set LASTVALUE_REDIS_URL
+(e.g. redis://localhost:6379/1) to share the cache between gunicorn workers
+and Celery workers. Without it only synchronous and UDP writes of the same
+web worker are seen, because queued writes are done in the Celery worker.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import threading
+
+from endpoints.lineprotocol import EPOCH, TIME_FORMAT
+from endpoints.utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryLastValueStore:
+    """Last values in process memory: {devid: {measurement: value}}"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def update(self, devid, measurement, value):
+        with self.lock:
+            device = self.values.setdefault(devid, {})
+            current = device.get(measurement)
+            if current is None or current['time'] <= value['time']:
+                device[measurement] = value
+
+    def get_many(self, devids, measurements=None):
+        result = {}
+        with self.lock:
+            for devid in devids:
+                device = self.values.get(devid)
+                if device is None:
+                    continue
+                result[devid] = {m: v for m, v in device.items() if measurements is None or m in measurements}
+        return result
+
+
+class RedisLastValueStore:
+    """Last values in Redis hashes: key 'lastvalue:<devid>', field measurement, value JSON."""
+
+    # Set only if the new value is not older than the stored one
+    UPDATE_SCRIPT = """
+local cur = redis.call('HGET', KEYS[1], ARGV[1])
+if cur and cjson.decode(cur)['time'] > ARGV[2] then return 0 end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+return 1
+"""
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.update_script = self.redis.register_script(self.UPDATE_SCRIPT)
+
+    @staticmethod
+    def key(devid):
+        return 'lastvalue:{}'.format(devid)
+
+    def update(self, devid, measurement, value):
+        import redis
+        try:
+            self.update_script(keys=[self.key(devid)], args=[measurement, value['time'], json.dumps(value)])
+        except redis.exceptions.RedisError as err:  # never fail ingest because of the cache
+            logger.warning('[LASTVALUE] Redis error: {}'.format(err))
+
+    def get_many(self, devids, measurements=None):
+        pipe = self.redis.pipeline(transaction=False)
+        for devid in devids:
+            pipe.hgetall(self.key(devid))
+        result = {}
+        for devid, device in zip(devids, pipe.execute()):
+            if not device:
+                continue
+            result[devid] = {m.decode(): json.loads(v) for m, v in device.items()
+                             if measurements is None or m.decode() in measurements}
+        return result
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                redis_url = get_setting('LASTVALUE_REDIS_URL')
+                _store = RedisLastValueStore(redis_url) if redis_url else MemoryLastValueStore()
+    return _store
+
+
+def update_packed(packed):
+    """
+    Update cache with the newest reading of every series of packed measurements,
+    which have been written successfully. Cache errors are logged, never raised.
+
+    :param dict packed: see endpoints.lineprotocol.pack_measurements()
+    """
+    try:
+        store = get_store()
+        for measurement, tags, keys, deltas, columns in packed['series']:
+            tags = dict(tags)
+            devid = tags.pop('dev-id', None)
+            if devid is None or not deltas:
+                continue
+            ts = newest = newest_row = None
+            for row, delta in enumerate(deltas):
+                ts = delta if ts is None else ts + delta
+                if newest is None or ts >= newest:
+                    newest, newest_row = ts, row
+            value = {
+                'time': (EPOCH + datetime.timedelta(microseconds=newest)).strftime(TIME_FORMAT),
+                'fields': {k: columns[i][newest_row] for i, k in enumerate(keys)},
+                'tags': tags,
+            }
+            store.update(devid, measurement, value)
+    except Exception as err:
+        logger.warning('[LASTVALUE] Update failed: {}'.format(err))
+
+
+def get_last_values(devids, measurements=None):
+    """
+    :param list devids: device ids
+    :param measurements: optional set of measurement names to return
+    :return: {devid: {measurement: {'time': ..., 'fields': {...}, 'tags': {...}}}}
+    """
+    return get_store().get_many(devids, measurements)
+
+
+def make_etag(values):
+    """Return ETag which changes whenever any returned reading changes."""
+    h = hashlib.md5()
+    for devid in sorted(values):
+        for measurement in sorted(values[devid]):
+            h.update('{}|{}|{}\n'.format(devid, measurement, values[devid][measurement]['time']).encode())
+    return '"{}"'.format(h.hexdigest())
@@ -0,0 +1,172 @@
+"""
+InfluxDB line protocol helpers and compact columnar measurement packing.
+
+`pack_measurements()` turns a list of InfluxDB measurement dicts (see
+`endpoints.utils.create_influxdb_obj`) into a columnar structure, where every
+series (measurement + tags + field keys) is stored once, followed by delta
+encoded epoch timestamps in microseconds and one value array per field:
+
+    {'v': 1, 'series': [
+        ['LAeq1s', {'dev-id': 'TA120-T246177'}, ['dBA'], [1514885219000000, -1000000, ...], [[44.0, 43.9, ...]]],
+    ]}
+
+It is meant to be sent through Celery with msgpack serializer and
+decoded straight into line protocol in the worker with `packed_to_lines()`.
+"""
+import datetime
+
+import pytz
+
+PACK_VERSION = 1
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.UTC)
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def escape_measurement(value):
+    return value.replace(',', '\\,').replace(' ', '\\ ')
+
+
+def escape_key(value):
+    """Escape tag key, tag value or field key."""
+    return str(value).replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def format_field_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return '{}i'.format(value)
+    if isinstance(value, float):
+        return repr(value)
+    return '"{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def time_to_us(value):
+    """
+    Convert InfluxDB measurement time to epoch microseconds.
+
+    :param value: int (epoch microseconds), datetime or string formatted like create_influxdb_obj() does
+    :return: int epoch microseconds
+    """
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        try:
+            value = pytz.UTC.localize(datetime.datetime.strptime(value, TIME_FORMAT))
+        except ValueError:
+            from dateutil.parser import parse
+            value = parse(value)
+    if value.tzinfo is None:
+        value = pytz.UTC.localize(value)
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def make_line(measurement, tags, fields, timestamp=None):
+    """
+    Return one line protocol line. Tags are sorted as InfluxDB recommends, None field values are skipped.
+
+    :param str measurement: measurement name
+    :param dict tags: tag key-value pairs
+    :param dict fields: field key-value pairs
+    :param int timestamp: timestamp in the precision used for the write
+    :return: str line or None if there are no fields
+    """
+    field_str = ','.join('{}={}'.format(escape_key(k), format_field_value(v))
+                         for k, v in fields.items() if v is not None)
+    if not field_str:
+        return None
+    key = escape_measurement(measurement)
+    if tags:
+        key += ',' + ','.join('{}={}'.format(escape_key(k), escape_key(v))
+                              for k, v in sorted(tags.items()) if v is not None and v != '')
+    if timestamp is None:
+        return '{} {}'.format(key, field_str)
+    return '{} {} {}'.format(key, field_str, timestamp)
+
+
+def measurements_to_lines(measurements):
+    """Convert list of InfluxDB measurement dicts to line protocol lines with microsecond timestamps."""
+    lines = []
+    for m in measurements:
+        ts = time_to_us(m['time']) if m.get('time') is not None else None
+        line = make_line(m['measurement'], m.get('tags', {}), m['fields'], ts)
+        if line is not None:
+            lines.append(line)
+    return lines
+
+
+def pack_measurements(measurements):
+    """
+    Pack list of InfluxDB measurement dicts to compact columnar structure.
+
+    :param list measurements: InfluxDB measurement dicts
+    :return: dict, see module docstring
+    """
+    series = {}
+    for m in measurements:
+        fields = {k: v for k, v in m['fields'].items() if v is not None}
+        if not fields:
+            continue
+        tags = m.get('tags', {})
+        keys = sorted(fields.keys())
+        series_key = (m['measurement'], tuple(sorted(tags.items())), tuple(keys))
+        s = series.get(series_key)
+        if s is None:
+            s = series[series_key] = [m['measurement'], dict(tags), keys, [], [[] for _ in keys], 0]
+        ts = time_to_us(m['time'])
+        s[3].append(ts - s[5])  # delta to previous timestamp, first one is absolute
+        s[5] = ts
+        for i, k in enumerate(keys):
+            s[4][i].append(fields[k])
+    return {'v': PACK_VERSION, 'series': [s[:5] for s in series.values()]}
+
+
+def iter_packed(packed):
+    """
+    Iterate packed measurements.
+
+    :return: Iterator of (measurement, tags, fields, epoch microseconds) tuples
+    """
+    if packed.get('v') != PACK_VERSION:
+        raise ValueError('Unsupported packed measurement version {}'.format(packed.get('v')))
+    for measurement, tags, keys, deltas, columns in packed['series']:
+        ts = 0
+        for row, delta in enumerate(deltas):
+            ts += delta
+            yield measurement, tags, {k: columns[i][row] for i, k in enumerate(keys)}, ts
+
+
+def packed_times(packed):
+    """Iterate epoch microsecond timestamps of packed measurements."""
+    for series in packed['series']:
+        ts = 0
+        for delta in series[3]:
+            ts += delta
+            yield ts
+
+
+def packed_to_lines(packed, precision_us=1):
+    """
+    Decode packed measurements straight to line protocol lines.
+
+    :param dict packed: output of pack_measurements()
+    :param int precision_us: timestamp precision in microseconds, default 1 (microsecond precision)
+    :return: list of line protocol strings
+    """
+    lines = []
+    if packed.get('v') != PACK_VERSION:
+        raise ValueError('Unsupported packed measurement version {}'.format(packed.get('v')))
+    for measurement, tags, keys, deltas, columns in packed['series']:
+        key = escape_measurement(measurement)
+        if tags:
+            key += ',' + ','.join('{}={}'.format(escape_key(k), escape_key(v))
+                                  for k, v in sorted(tags.items()) if v is not None and v != '')
+        ekeys = [escape_key(k) for k in keys]
+        ts = 0
+        for row, delta in enumerate(deltas):
+            ts += delta
+            field_str = ','.join('{}={}'.format(ekeys[i], format_field_value(columns[i][row]))
+                                 for i in range(len(ekeys)))
+            lines.append('{} {} {}'.format(key, field_str, ts // precision_us))
+    return lines
@@ -0,0 +1,259 @@
+"""
+In-process pub/sub of ingested measurements for live displays.
+
+Sinks publish every ingested point with `publish()`. Subscribers (see
+`endpoints.views.stream`) get points matching their device, measurement and
+database filters as server-sent events. Every subscriber has a bounded buffer.
+A subscriber which doesn't keep up is dropped instead of slowing down ingest
+or growing memory.
+
+Streams are long-lived requests, so gunicorn must run with threaded or async
+workers (e.g. `--worker-class gthread --threads 100`, see
+etc/supervisor/conf.d), otherwise every stream ties up a whole sync worker.
+
+Every worker process has its own subscribers and points are published in
+the worker which handled the request. Set LIVESTREAM_REDIS_URL (e.g.
+redis://localhost:6379/3) to relay points through a Redis pub/sub channel to
+subscribers of all workers. Then a process with subscribers listens to the
+channel in a background thread, and points are published to Redis only
+while some process listens (checked at most once a second). Without it a
+subscriber sees only points ingested by its own worker.
+
+Settings:
+
+- LIVESTREAM_BUFFER_SIZE: max buffered events per subscriber (default 1000)
+- LIVESTREAM_MAX_SUBSCRIBERS: max concurrent subscribers per process (default 1000)
+- LIVESTREAM_KEEPALIVE: seconds between keepalive comments (default 15)
+"""
+import json
+import logging
+import queue
+import threading
+import time
+
+from endpoints.lineprotocol import iter_packed
+from endpoints.utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+DROPPED = object()
+CHANNEL = 'livestream'
+
+
+class Subscriber:
+
+    def __init__(self, devids=None, measurements=None, databases=None, buffer_size=1000):
+        self.devids = devids or None
+        self.measurements = measurements or None
+        self.databases = databases or None
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.dropped = False
+
+    def matches(self, dbname, measurement):
+        return ((self.databases is None or dbname in self.databases) and
+                (self.measurements is None or measurement['measurement'] in self.measurements) and
+                (self.devids is None or measurement['tags'].get('dev-id') in self.devids))
+
+
+class Broker:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def subscribe(self, subscriber, max_subscribers):
+        with self.lock:
+            if len(self.subscribers) >= max_subscribers:
+                return False
+            self.subscribers = self.subscribers + [subscriber]  # copy on write, publish() reads without lock
+            return True
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not subscriber]
+
+    def _drop(self, subscriber):
+        with self.lock:
+            if subscriber.dropped:  # another publishing thread dropped it already
+                return
+            subscriber.dropped = True
+            self.subscribers = [s for s in self.subscribers if s is not subscriber]
+            self.dropped += 1
+        try:  # wake up the consumer, there is room for one more after get()
+            subscriber.queue.get_nowait()
+            subscriber.queue.put_nowait(DROPPED)
+        except (queue.Empty, queue.Full):
+            pass
+
+    def publish(self, dbname, measurements):
+        subscribers = self.subscribers
+        if not subscribers:
+            return
+        delivered = 0
+        for m in measurements:
+            event = None  # serialize once, only if somebody wants it
+            for s in subscribers:
+                if s.dropped or not s.matches(dbname, m):
+                    continue
+                if event is None:
+                    event = 'data: {}\n\n'.format(json.dumps(dict(m, db=dbname)))
+                try:
+                    s.queue.put_nowait(event)
+                    delivered += 1
+                except queue.Full:
+                    self._drop(s)
+        with self.lock:  # publish() runs in many request threads
+            self.published += len(measurements)
+            self.delivered += delivered
+
+    def stats(self):
+        with self.lock:
+            return {
+                'subscribers': len(self.subscribers),
+                'published': self.published,
+                'delivered': self.delivered,
+                'dropped_subscribers': self.dropped,
+            }
+
+
+broker = Broker()
+
+
+class RedisRelay:
+    """Relay published measurements to brokers of all processes through a Redis pub/sub channel."""
+
+    def __init__(self, url=None, client=None, channel=CHANNEL):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.redis = client
+        self.channel = channel
+        self.lock = threading.Lock()
+        self.thread = None
+        self.listeners = 0
+        self.listeners_checked = None
+
+    def has_listeners(self):
+        """Return True if some process listens to the channel, the answer is cached for a second."""
+        now = time.monotonic()
+        if self.listeners_checked is None or now - self.listeners_checked >= 1.0:
+            self.listeners = dict(self.redis.pubsub_numsub(self.channel)).get(self.channel.encode(), 0)
+            self.listeners_checked = now
+        return self.listeners > 0
+
+    def send(self, dbname, measurements):
+        if self.has_listeners():
+            self.redis.publish(self.channel, json.dumps({'db': dbname, 'measurements': measurements}, default=str))
+
+    def start(self, broker):
+        """Listen to the channel in a background thread, until `broker` has no subscribers."""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.listen, args=(broker,), daemon=True)
+                self.thread.start()
+
+    def listen(self, broker):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(self.channel)
+            while True:
+                message = pubsub.get_message(timeout=1.0)
+                if message is not None:
+                    data = json.loads(message['data'])
+                    broker.publish(data['db'], data['measurements'])
+                with self.lock:
+                    if not broker.subscribers:
+                        self.thread = None
+                        return
+        except Exception as err:
+            logger.error('[LIVESTREAM] Redis relay failed: {}'.format(err))
+            with self.lock:
+                self.thread = None
+        finally:
+            pubsub.close()
+
+
+_relay = None
+_relay_lock = threading.Lock()
+
+
+def get_relay():
+    """Return RedisRelay if LIVESTREAM_REDIS_URL is set, otherwise None."""
+    global _relay
+    if _relay is None:
+        redis_url = get_setting('LIVESTREAM_REDIS_URL')
+        if not redis_url:
+            return None
+        with _relay_lock:
+            if _relay is None:
+                _relay = RedisRelay(redis_url)
+    return _relay
+
+
+def publish(dbname, measurements):
+    """Publish list of InfluxDB measurement dicts written to database `dbname`."""
+    relay = get_relay()
+    if relay is None:
+        broker.publish(dbname, measurements)
+        return
+    try:  # the relay delivers to this process too
+        relay.send(dbname, measurements)
+    except Exception as err:
+        logger.error('[LIVESTREAM] Could not publish to Redis: {}'.format(err))
+        broker.publish(dbname, measurements)
+
+
+def publish_packed(dbname, packed):
+    """Publish packed measurements (see endpoints.lineprotocol), unpacked only if somebody listens."""
+    relay = get_relay()
+    if relay is None:
+        if not broker.subscribers:
+            return
+    else:
+        try:
+            if not relay.has_listeners():
+                return
+        except Exception as err:
+            logger.error('[LIVESTREAM] Could not check Redis listeners: {}'.format(err))
+            return
+    measurements = [{'measurement': m, 'tags': tags, 'fields': fields, 'time': ts}
+                    for m, tags, fields, ts in iter_packed(packed)]
+    publish(dbname, measurements)
+
+
+def subscribe(devids=None, measurements=None, databases=None):
+    """
+    Return new Subscriber or None if there are too many subscribers.
+    """
+    subscriber = Subscriber(devids, measurements, databases,
+                            buffer_size=int(get_setting('LIVESTREAM_BUFFER_SIZE', 1000)))
+    if not broker.subscribe(subscriber, int(get_setting('LIVESTREAM_MAX_SUBSCRIBERS', 1000))):
+        return None
+    relay = get_relay()
+    if relay is not None:
+        relay.start(broker)
+    return subscriber
+
+
+def event_stream(subscriber):
+    """
+    Yield server-sent events for `subscriber` until it is dropped or the client goes away.
+    """
+    keepalive = float(get_setting('LIVESTREAM_KEEPALIVE', 15))
+    try:
+        yield 'retry: 5000\n\n'
+        while True:
+            try:
+                event = subscriber.queue.get(timeout=keepalive)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if event is DROPPED:
+                yield 'event: dropped\ndata: slow consumer\n\n'
+                return
+            yield event
+    finally:
+        broker.unsubscribe(subscriber)
@@ -0,0 +1,88 @@
+"""
+Benchmark noise sensor v1 parsing: the former dict based parser + pack_measurements()
+against parse_noisesensor_v1(), which builds packed series directly.
+
+    python manage.py benchnoisesensor --samples 60 --number 2000
+"""
+import datetime
+import random
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from endpoints.lineprotocol import TIME_FORMAT, pack_measurements, packed_to_lines, time_to_us
+from endpoints.plugins.noisesensor import parse_noisesensor_v1
+
+
+def legacy_parse_noisesensor_v1(params, now=None):
+    """
+    Former views.parse_noisesensorv1_data(): one measurement dict with a
+    formatted time string per sample, newest first.
+    """
+    json_body = []
+    ts = now or datetime.datetime.utcnow()
+    dev_id = params.get('mac')
+    rssi = int(params.get('rssi'))
+    uptime = int(params.get('uptime', 0))
+    svals = [int(x) for x in filter(None, params.get('1s', '').split(','))]
+    svals.reverse()
+    cnt = 0
+    json_body.append({
+        'measurement': 'rssi',
+        'tags': {'dev-id': dev_id},
+        'time': (ts - datetime.timedelta(seconds=cnt)).strftime(TIME_FORMAT),
+        'fields': {'rssi': rssi},
+    })
+    if uptime:
+        json_body.append({
+            'measurement': 'uptime',
+            'tags': {'dev-id': dev_id},
+            'time': (ts - datetime.timedelta(seconds=cnt)).strftime(TIME_FORMAT),
+            'fields': {'uptime': uptime / 1000.0},
+        })
+    for val in svals:
+        measurement = {
+            'measurement': 'raw_pp',
+            'tags': {'dev-id': dev_id},
+            'time': (ts - datetime.timedelta(seconds=cnt)).strftime(TIME_FORMAT),
+            'fields': {'raw': val},
+        }
+        cnt += 1
+        if val > 0:
+            json_body.append(measurement)
+    return pack_measurements(json_body)
+
+
+def sample_params(samples, seed=0):
+    rnd = random.Random(seed)
+    return {
+        'mac': '5C:CF:7F:00:00:01',
+        'rssi': str(rnd.randint(-90, -40)),
+        'uptime': str(rnd.randint(0, 10 ** 9)),
+        '1s': ','.join(str(rnd.choice([0, rnd.randint(50, 120)])) for _ in range(samples)),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Compare legacy and packed noise sensor v1 parsing speed and check that line protocol is identical'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', type=int, default=60, help='1s values per request')
+        parser.add_argument('--number', type=int, default=2000, help='Parses per timing run')
+        parser.add_argument('--repeat', type=int, default=5, help='Timing runs, the best one is reported')
+
+    def handle(self, *args, **options):
+        params = sample_params(options['samples'])
+        now = datetime.datetime.utcnow()
+        now_us = time_to_us(now)
+        legacy_lines = sorted(packed_to_lines(legacy_parse_noisesensor_v1(params, now)))
+        packed_lines = sorted(packed_to_lines(parse_noisesensor_v1(params, now_us)))
+        if legacy_lines != packed_lines:
+            raise CommandError('Line protocol differs:\n{}\n---\n{}'.format(
+                '\n'.join(legacy_lines), '\n'.join(packed_lines)))
+        self.stdout.write('{} samples, {} lines, line protocol identical'.format(
+            options['samples'], len(packed_lines)))
+        for name, func in [('legacy', lambda: legacy_parse_noisesensor_v1(params, now)),
+                           ('packed', lambda: parse_noisesensor_v1(params, now_us))]:
+            best = min(timeit.repeat(func, number=options['number'], repeat=options['repeat']))
+            self.stdout.write('{:<8} {:>10.1f} us per request'.format(name, best / options['number'] * 1e6))
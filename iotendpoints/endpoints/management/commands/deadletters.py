@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Min, Sum
+from django.utils import timezone
+
+from endpoints.deadletter import retry_due
+from endpoints.models import FailedWrite
+
+
+class Command(BaseCommand):
+    help = 'Show and retry failed sink writes stored in dead-letter table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry', action='store_true', help='Retry pending writes whose backoff has expired')
+        parser.add_argument('--retry-all', action='store_true', help='Retry all pending writes now')
+        parser.add_argument('--release', choices=['CONFLICT', 'PERMANENT', 'TRANSIENT'],
+                            help='Move held writes of this kind back to pending')
+        parser.add_argument('--purge', choices=['CONFLICT', 'PERMANENT', 'TRANSIENT'],
+                            help='Delete held writes of this kind')
+        parser.add_argument('--limit', type=int, default=None, help='Max number of writes to retry')
+
+    def handle(self, *args, **options):
+        if options['release']:
+            cnt = FailedWrite.objects.filter(status='HELD', kind=options['release']).update(
+                status='PENDING', next_attempt_at=timezone.now())
+            self.stdout.write('Released {} held writes'.format(cnt))
+        if options['purge']:
+            cnt, _ = FailedWrite.objects.filter(status='HELD', kind=options['purge']).delete()
+            self.stdout.write('Deleted {} held writes'.format(cnt))
+        if options['retry_all']:
+            written, failed = retry_due(options['limit'], due_only=False)
+            self.stdout.write('Retried: {} written, {} failed'.format(written, failed))
+        elif options['retry']:
+            written, failed = retry_due(options['limit'])
+            self.stdout.write('Retried: {} written, {} failed'.format(written, failed))
+        rows = (FailedWrite.objects.values('sink', 'target', 'kind', 'status')
+                .annotate(writes=Count('id'), points=Sum('point_count'), next_attempt=Min('next_attempt_at'))
+                .order_by('sink', 'target', 'kind', 'status'))
+        fmt = '{:<9} {:<30} {:<10} {:<8} {:>7} {:>9}  {}'
+        self.stdout.write(fmt.format('sink', 'target', 'kind', 'status', 'writes', 'points', 'next attempt'))
+        for r in rows:
+            self.stdout.write(fmt.format(r['sink'], r['target'][:30], r['kind'], r['status'], r['writes'],
+                                         r['points'] or 0, r['next_attempt'].strftime('%Y-%m-%d %H:%M:%S')))
@@ -0,0 +1,40 @@
+import sys
+
+from dateutil.parser import parse
+from django.core.management.base import BaseCommand, CommandError
+
+from endpoints.export import FORMATS, Export, ExportError, gzip_stream
+
+
+class Command(BaseCommand):
+    help = 'Export measurements of devices in a time range from InfluxDB as CSV, NDJSON or Parquet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--db', required=True, help='InfluxDB database')
+        parser.add_argument('--measurement', required=True, action='append',
+                            help='Measurement name, may be repeated')
+        parser.add_argument('--devid', action='append', default=[], help='Device id, may be repeated, default all')
+        parser.add_argument('--start', required=True, help='Start time (inclusive), e.g. 2018-01-01, UTC if no tz')
+        parser.add_argument('--end', required=True, help='End time (exclusive)')
+        parser.add_argument('--format', choices=list(FORMATS), default='csv')
+        parser.add_argument('--gzip', action='store_true', help='Gzip compress output')
+        parser.add_argument('--chunk-hours', type=float, default=None, help='Time range of one query')
+        parser.add_argument('--output', '-o', default='-', help='Output file, default stdout')
+
+    def handle(self, *args, **options):
+        try:
+            exporter = Export(options['db'], options['measurement'], options['devid'],
+                              parse(options['start']), parse(options['end']), chunk_hours=options['chunk_hours'])
+        except (ExportError, ValueError, OverflowError) as err:
+            raise CommandError(err)
+        chunks = exporter.iter_bytes(options['format'])
+        if options['gzip']:
+            chunks = gzip_stream(chunks)
+        out = sys.stdout.buffer if options['output'] == '-' else open(options['output'], 'wb')
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+        self.stderr.write('Exported {} rows'.format(exporter.rows))
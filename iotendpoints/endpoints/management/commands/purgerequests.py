@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from endpoints.retention import get_rules, purge_requests
+
+
+class Command(BaseCommand):
+    help = 'Delete dumped requests which are older than REQUEST_RETENTION_DAYS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only count requests which would be deleted')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows deleted per query')
+        parser.add_argument('--workers', type=int, default=8, help='Threads removing dump directories')
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        if not get_rules():
+            self.stdout.write('REQUEST_RETENTION_DAYS is not set, nothing to purge')
+            return
+        result = purge_requests(batch_size=options['batch_size'], workers=options['workers'],
+                                pause=options['pause'], dry_run=options['dry_run'])
+        fmt = '{:<20} {:<10} {:>6} {:>10}'
+        self.stdout.write(fmt.format('postfix', 'status', 'days', 'would delete' if options['dry_run'] else 'deleted'))
+        for (postfix, status, days), cnt in result.items():
+            self.stdout.write(fmt.format(postfix, status, days, cnt))
@@ -0,0 +1,36 @@
+# Generated by Django 2.2.28 on 2026-10-19 09:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('endpoints', '0004_plate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FailedWrite',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sink', models.CharField(choices=[('influxdb', 'InfluxDB'), ('orion', 'Orion')], max_length=20)),
+                ('target', models.CharField(max_length=200, verbose_name='Database or URL root')),
+                ('kind', models.CharField(choices=[('TRANSIENT', 'Transient'), ('CONFLICT', 'Field type conflict'), ('PERMANENT', 'Permanent')], default='TRANSIENT', max_length=20)),
+                ('status', models.CharField(choices=[('PENDING', 'Pending retry'), ('HELD', 'Held')], default='PENDING', max_length=20)),
+                ('error_class', models.CharField(blank=True, max_length=100)),
+                ('error', models.TextField(blank=True)),
+                ('attempts', models.IntegerField(default=1)),
+                ('point_count', models.IntegerField(default=0)),
+                ('payload', models.BinaryField()),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='failedwrite',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='endpoints_f_status_5a9aea_idx'),
+        ),
+    ]
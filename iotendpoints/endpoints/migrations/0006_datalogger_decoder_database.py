@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-19 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('endpoints', '0005_failedwrite'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datalogger',
+            name='database',
+            field=models.CharField(blank=True, help_text='InfluxDB database. Empty: plugin default', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='datalogger',
+            name='decoder',
+            field=models.CharField(blank=True, help_text='Payload decoder, see endpoints.decoders. Empty: guess from payload', max_length=50),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-19 12:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('endpoints', '0006_datalogger_decoder_database'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(fields=['created'], name='endpoints_r_created_73d11b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(fields=['status', 'created'], name='endpoints_r_status_cea689_idx'),
+        ),
+    ]
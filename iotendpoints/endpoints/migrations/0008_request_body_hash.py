@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-19 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('endpoints', '0007_request_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='request',
+            name='body_sha256',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='request',
+            name='body_size',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('endpoints', '0008_request_body_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='failedwrite',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending retry'), ('RETRYING', 'Retrying'), ('HELD', 'Held')], default='PENDING', max_length=20),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-19 13:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('endpoints', '0009_failedwrite_retrying'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='request',
+            name='body_sha256',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='request',
+            index=models.Index(fields=['body_sha256', 'created'], name='endpoints_r_body_sh_fdd6cb_idx'),
+        ),
+    ]
@@ -1,4 +1,3 @@
-import os
 import string
 import random
 from django.contrib.gis.db import models
@@ -6,7 +5,6 @@ from django.contrib.gis.geos import Point
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
-from django.conf import settings
 
 
 def get_uid(length=12):
@@ -34,8 +32,17 @@ class Request(models.Model):
     method = models.CharField(max_length=20, blank=False, editable=False)
     path = models.CharField(max_length=200, blank=False, editable=False)
     filecount = models.IntegerField(default=0)
+    body_size = models.BigIntegerField(default=0, editable=False)
+    body_sha256 = models.CharField(max_length=64, blank=True, editable=False)
     created = models.DateTimeField(default=timezone.now, editable=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['created']),
+            models.Index(fields=['status', 'created']),
+            models.Index(fields=['body_sha256', 'created']),
+        ]
+
     def __str__(self):
         return '{}'.format(self.created.strftime('%Y-%m-%d %H:%M:%S'))
 
@@ -43,14 +50,8 @@ class Request(models.Model):
         super(Request, self).save(*args, **kwargs)
 
     def delete(self, *args, **kwargs):
-        path = os.path.join(settings.MEDIA_ROOT, str(self.path))
-        # delete files
-        for fn in os.listdir(path):
-            full_path = os.path.join(path, fn)
-            print('Removing file {}'.format(full_path))
-            os.remove(full_path)
-        print('Removing directory {}'.format(path))
-        os.rmdir(path)
+        from endpoints.retention import remove_dump_dir  # retention imports this module
+        remove_dump_dir(self.path)
         super(Request, self).delete(*args, **kwargs)
 
 
@@ -63,6 +64,10 @@ class Datalogger(models.Model):
     lat = models.FloatField(null=True, blank=True)
     lon = models.FloatField(null=True, blank=True)
     location = models.PointField(null=True, blank=True)
+    decoder = models.CharField(max_length=50, blank=True,
+                               help_text=_('Payload decoder, see endpoints.decoders. Empty: guess from payload'))
+    database = models.CharField(max_length=64, blank=True,
+                                help_text=_('InfluxDB database. Empty: plugin default'))
     activity_at = models.DateTimeField(null=True, editable=True)
     created_at = models.DateTimeField(default=timezone.now, editable=False)
     updated_at = models.DateTimeField(default=timezone.now, editable=False)
@@ -87,3 +92,39 @@ class Plate(models.Model):
     direction = models.IntegerField(editable=False)
     ip = models.GenericIPAddressField(editable=False)
     created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+
+class FailedWrite(models.Model):
+    """
+    Dead-letter store for sink writes which failed. See endpoints.deadletter.
+    """
+    sink = models.CharField(max_length=20, choices=(("influxdb", "InfluxDB"),
+                                                    ("orion", "Orion"),
+                                                    ))
+    target = models.CharField(max_length=200, verbose_name=_('Database or URL root'))
+    kind = models.CharField(max_length=20, default="TRANSIENT",
+                            choices=(("TRANSIENT", "Transient"),
+                                     ("CONFLICT", "Field type conflict"),
+                                     ("PERMANENT", "Permanent"),
+                                     ))
+    status = models.CharField(max_length=20, default="PENDING",
+                              choices=(("PENDING", "Pending retry"),
+                                       ("RETRYING", "Retrying"),
+                                       ("HELD", "Held"),
+                                       ))
+    error_class = models.CharField(max_length=100, blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.IntegerField(default=1)
+    point_count = models.IntegerField(default=0)
+    payload = models.BinaryField()  # msgpack
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+    updated_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return '{} {} {} ({} attempts)'.format(self.sink, self.target, self.kind, self.attempts)
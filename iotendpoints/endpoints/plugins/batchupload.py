@@ -0,0 +1,185 @@
+"""
+Batch upload endpoint for gateways and stations which buffer readings.
+
+You must declare environment variable BATCHUPLOAD_URL to activate this plugin.
+
+Accepts many readings in one request as newline delimited JSON
+(Content-Type: application/x-ndjson), one reading per line:
+
+```
+{"devid": "ED:20:D0:FE:B0:9B", "measurement": "ruuvitag", "time": "2018-05-22T19:16:31Z", "fields": {"temperature": 5.18}}
+{"devid": "ED:20:D0:FE:B0:9B", "measurement": "ruuvitag", "time": 1527016651, "fields": {"temperature": 5.21}, "tags": {"name": "vetari 2"}}
+```
+
+or CSV (Content-Type: text/csv), where columns after devid, measurement and time are fields:
+
+```
+devid,measurement,time,temperature,humidity
+ED:20:D0:FE:B0:9B,ruuvitag,2018-05-22T19:16:31Z,5.18,83.0
+```
+
+Time is ISO 8601 or epoch seconds. Body may be compressed with
+`Content-Encoding: gzip` or `deflate`. The body is parsed incrementally from the
+request stream and saved with one batched write per BATCHUPLOAD_CHUNK_SIZE readings.
+Readings are saved to database `db` GET parameter, which defaults to user name.
+"""
+import csv
+import datetime
+import json
+import logging
+
+import dateutil.parser
+import pytz
+from django.conf.urls import url
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from endpoints.bodies import BodyError, BodyTooLarge, iter_body_chunks
+from endpoints.utils import BasePlugin
+from endpoints.utils import basicauth, create_influxdb_obj
+from endpoints.utils import get_setting
+from endpoints.sinks import queue_influxdb
+
+ENV_NAME = 'BATCHUPLOAD_URL'
+URL = get_setting(ENV_NAME)
+CHUNK_SIZE = int(get_setting('BATCHUPLOAD_CHUNK_SIZE', 5000))
+MAX_BYTES = int(get_setting('BATCHUPLOAD_MAX_BYTES', 100 * 1024 * 1024))
+MAX_ERRORS = 10
+logger = logging.getLogger(__name__)
+
+
+def iter_lines(chunks):
+    """Split byte chunks to decoded text lines without trailing newline."""
+    buf = b''
+    for chunk in chunks:
+        buf += chunk
+        lines = buf.split(b'\n')
+        buf = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8').rstrip('\r')
+    if buf:
+        yield buf.decode('utf-8').rstrip('\r')
+
+
+def parse_time(value):
+    if isinstance(value, (int, float)) or (isinstance(value, str) and value.replace('.', '', 1).isdigit()):
+        return pytz.UTC.localize(datetime.datetime.utcfromtimestamp(float(value)))
+    return dateutil.parser.parse(value)
+
+
+def iter_ndjson(lines):
+    """Yield (devid, measurement, fields, timestamp, tags) tuples or ValueErrors."""
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            r = json.loads(line)
+            yield r['devid'], r['measurement'], r['fields'], parse_time(r['time']), r.get('tags')
+        except (ValueError, KeyError, TypeError, OverflowError) as err:
+            yield ValueError('{}: {}'.format(type(err).__name__, err))
+
+
+def iter_csv(lines):
+    """Yield (devid, measurement, fields, timestamp, tags) tuples or ValueErrors."""
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+    if header[:3] != ['devid', 'measurement', 'time']:
+        yield ValueError('CSV header must start with devid,measurement,time')
+        return
+    field_names = header[3:]
+    for row in reader:
+        if not row:
+            continue
+        try:
+            fields = {k: v for k, v in zip(field_names, row[3:]) if v != ''}
+            yield row[0], row[1], fields, parse_time(row[2]), None
+        except (ValueError, IndexError, OverflowError) as err:
+            yield ValueError('{}: {}'.format(type(err).__name__, err))
+
+
+class Plugin(BasePlugin):
+    """
+    Batch upload plugin. Checks if endpoint's URL has been set in env.
+    """
+    name = 'batchupload'
+    viewname = 'batchuploadhandler'
+
+    def __init__(self):
+        """Check that `ENV_NAME` is in env variables."""
+        super().__init__()
+        if URL is not None:
+            self.in_use = True
+
+    def register(self):
+        print('Registering plugin "{}"'.format(self.name))
+
+    def get_urlpatterns(self):
+        if self.in_use is False:
+            print('{} environment variable is not set. {} endpoint is not in use.'.format(ENV_NAME, self.name))
+            urlpatterns = []
+        else:
+            url_pattern = r'^{}$'.format(URL)
+            urlpatterns = [
+                url(url_pattern, self.view_func, name=self.viewname),
+            ]
+        return urlpatterns
+
+    @csrf_exempt
+    def view_func(self, request):
+        """
+        Test like this:
+
+        export BATCHUPLOAD_URL=batch
+        gzip -c readings.ndjson | http -v --auth user:pass POST http://127.0.0.1:8000/batch \
+            Content-Type:application/x-ndjson Content-Encoding:gzip
+        """
+        uname, passwd, user = basicauth(request)
+        if user is None:
+            return HttpResponse("Authentication failure", status=401)
+        if request.method != 'POST':
+            return HttpResponse('Only POST method is allowed', status=405)
+        content_type = request.META.get('CONTENT_TYPE', '').split(';')[0].strip().lower()
+        if content_type in ('text/csv', 'application/csv'):
+            parser = iter_csv
+        elif content_type in ('application/x-ndjson', 'application/ndjson', 'application/jsonl', ''):
+            parser = iter_ndjson
+        else:
+            return HttpResponse('Unsupported Content-Type {}. Hint: use application/x-ndjson or text/csv'.format(
+                content_type), status=415)
+        dbname = request.GET.get('db', uname)
+        accepted = 0
+        errors = []
+        error_count = 0
+        measurements = []
+        try:
+            for lineno, item in enumerate(parser(iter_lines(iter_body_chunks(request, MAX_BYTES))), start=1):
+                if not isinstance(item, ValueError):
+                    devid, measurement_name, fields, ts, tags = item
+                    try:
+                        measurements.append(create_influxdb_obj(devid, measurement_name, fields, ts, tags))
+                    except (ValueError, TypeError, AttributeError) as err:
+                        item = ValueError('{}: {}'.format(type(err).__name__, err))
+                if isinstance(item, ValueError):
+                    error_count += 1
+                    if len(errors) < MAX_ERRORS:
+                        errors.append('Reading {}: {}'.format(lineno, item))
+                    continue
+                if len(measurements) >= CHUNK_SIZE:
+                    queue_influxdb(dbname, measurements)
+                    accepted += len(measurements)
+                    measurements = []
+        except BodyTooLarge as err:
+            return HttpResponse('{} Readings accepted before the limit: {}'.format(err, accepted), status=413)
+        except (BodyError, UnicodeDecodeError) as err:  # invalid compression or encoding
+            err_msg = '[BATCHUPLOAD] Invalid body: {}. Readings accepted before the error: {}'.format(err, accepted)
+            logger.error(err_msg)
+            return HttpResponse(err_msg, status=getattr(err, 'status', 400))
+        if measurements:
+            queue_influxdb(dbname, measurements)
+            accepted += len(measurements)
+        if error_count:
+            logger.warning('[BATCHUPLOAD] {} rejected readings from {}: {}'.format(error_count, uname, errors[0]))
+        status = 400 if accepted == 0 and error_count > 0 else 200
+        result = {'accepted': accepted, 'rejected': error_count, 'errors': errors}
+        return HttpResponse(json.dumps(result), content_type='application/json', status=status)
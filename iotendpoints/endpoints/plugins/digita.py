@@ -8,7 +8,6 @@ You must declare environment variable DIGITA_URL to activate this plugin.
 import os
 import json
 import logging
-import binascii
 import dateutil
 import pytz
 from django.conf import settings
@@ -18,7 +17,12 @@ from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
 from influxdb.exceptions import InfluxDBClientError
 from endpoints.utils import BasePlugin
-from endpoints.utils import get_influxdb_client, create_influxdb_obj
+from endpoints.utils import create_influxdb_obj
+from endpoints.bodies import BodyError, parse_body
+from endpoints.sinks import write_influxdb
+from endpoints.dedup import forget, is_duplicate
+from endpoints.decoders import DecodeError, get_decoder, guess_decoder
+from endpoints.bindings import get_binding
 from endpoints.utils import get_setting, get_datalogger
 from endpoints.views import dump_request
 
@@ -28,89 +32,6 @@ DIGITA_DB = get_setting('DIGITA_DB', 'digita')
 logger = logging.getLogger(__name__)
 
 
-def hex2int(hex_str):
-    """
-    Convert 2 hex characters (e.g. "23") to int (35)
-    :param hex_str: hex character string
-    :return: int integer
-    """
-    return int(hex_str, 16)
-
-
-def calc_temp(hex_str):
-    """
-    Convert 4 hex characters (e.g. "040b") to float temp (25.824175824175825)
-    :param hex_str: hex character string
-    :return: float temperature
-    """
-    adc = int(hex_str[0:2], 16) * 256 + int(hex_str[2:4], 16)
-    temp = (300 * adc / 4095) - 50
-    return temp
-
-
-def calc_volts(hex_str):
-    """
-    Convert 2 hex characters (e.g. "fe") to float volts (3.5043478260869567)
-    :param hex_str: hex character string
-    :return: float volts
-    """
-    volts = ((int(hex_str, 16) / 0.23) + 2400) / 1000
-    return volts
-
-
-def handle_clickey_tempsens(hex_str):
-    temp1 = calc_temp(hex_str[2:6])
-    temp2 = calc_temp(hex_str[6:10])
-    volts = calc_volts(hex_str[10:12])
-    return {
-        'temp1': temp1,
-        'temp2': temp2,
-        'volt': volts
-    }
-
-
-def hex2value10(hex_str):
-    return hex2int(hex_str) / 10.0
-
-
-def handle_aqburk(hex_str):
-    """
-    Parse payload like "2a2a0021002c002800300056003b0000" float values
-    :param hex_str: AQLoRaBurk hex payload
-    :return: dict containing float values
-    """
-    data = {
-        'pm25min': hex2value10(hex_str[4:8]),
-        'pm25max': hex2value10(hex_str[8:12]),
-        'pm25avg': hex2value10(hex_str[12:16]),
-        'pm25med': hex2value10(hex_str[16:20]),
-        'pm10min': hex2value10(hex_str[20:24]),
-        'pm10max': hex2value10(hex_str[24:28]),
-        'pm10avg': hex2value10(hex_str[28:32]),
-        'pm10med': hex2value10(hex_str[32:36]),
-    }
-    if len(hex_str) == 52:
-        data['temp'] = round(hex2value10(hex_str[36:40]) - 100, 1)
-        data['humi'] = hex2value10(hex_str[40:44])
-        data['pres'] = hex2value10(hex_str[44:48])
-        data['gas'] = hex2value10(hex_str[48:52])
-    return data
-
-
-def handle_keyval(hex_str):
-    """
-    :param hex_str: key-value hex payload
-    :return: dict containing parsed balues
-    :raises UnicodeDecodeError: if hex_str contains illegal bytes for utf8
-    """
-    _str = binascii.unhexlify(hex_str)  # --> b'temp=24.61,hum=28.69'
-    _str = _str.decode()  # --> 'temp=24.61,hum=28.69'
-    keyvals = [x.split('=') for x in _str.split(',')]  # --> [['temp', '24.61'], ['hum', '28.69']]
-    keyvals = [[x[0], float(x[1])] for x in keyvals]  # --> [['temp', 24.61], ['hum', 28.69]]
-    data = dict(keyvals)  # --> {'temp': 24.61, 'hum': 28.69}
-    return data
-
-
 class Plugin(BasePlugin):
     """
     Digita plugin. Checks if endpoint's URL has been set in env.
@@ -143,16 +64,14 @@ class Plugin(BasePlugin):
         """
         Endpoint requires valid Digita formatted JSON payload.
         """
-        err_msg = ''
-        status = 200
+        body_data = request.body
         try:
-            body_data = request.body
-            data = json.loads(body_data.decode('utf-8'))
-        except (json.decoder.JSONDecodeError, UnicodeDecodeError) as err:
-            log_msg = '[DIGITA] Invalid data: "{}". Hint: should be UTF-8 json.'.format(body_data[:50])
-            err_msg = 'Invalid data: "{}"... Hint: should be UTF-8 json.'.format(body_data[:50])
+            data = parse_body(request)
+        except BodyError as err:
+            log_msg = '[DIGITA] Invalid data: "{}". {}. Hint: should be UTF-8 json.'.format(body_data[:50], err)
+            err_msg = 'Invalid data: "{}"... {}. Hint: should be UTF-8 json.'.format(body_data[:50], err)
             logger.error(log_msg)
-            return HttpResponse(err_msg, status=400)
+            return HttpResponse(err_msg, status=err.status)
         # meta and type keys should be always in request json
         try:
             d = data['DevEUI_uplink']
@@ -165,6 +84,25 @@ class Plugin(BasePlugin):
             err_msg = 'Invalid json structure: "{}". Hint: missing key {}.'.format(body_data, err)
             logger.error(log_msg)
             return HttpResponse(err_msg, status=400)
+        # Same uplink may arrive via several gateways, acknowledge copies without any I/O
+        uplink = (self.name, device, d.get('FCntUp'), (times, payload_hex))
+        if is_duplicate(*uplink):
+            return HttpResponse("ok")
+        try:
+            response = self.handle_uplink(request, data, device, times, rssi, payload_hex)
+        except Exception:
+            forget(*uplink)  # let the gateway's retry through
+            raise
+        if response.status_code >= 500:
+            forget(*uplink)
+        return response
+
+    def handle_uplink(self, request, data, device, times, rssi, payload_hex):
+        """
+        Save, decode and write an uplink, which is not a duplicate.
+        """
+        err_msg = ''
+        status = 200
         now = timezone.now().astimezone(pytz.utc)
         path = os.path.join(settings.MEDIA_ROOT, 'digita', now.strftime('%Y-%m-%d'), device)
         os.makedirs(path, exist_ok=True)
@@ -172,66 +110,15 @@ class Plugin(BasePlugin):
         with open(fpath, 'wt') as destination:
             destination.write(json.dumps(data, indent=1))
         response = HttpResponse("ok")
-        # TODO: move this to a function
-        if len(payload_hex) == 8:
-            idata = {
-                'wifi': int(payload_hex[0:4], 16),
-                'ble': int(payload_hex[4:8], 16)
-            }
-            idata['rssi'] = rssi
-            keys_str = 'wifi-ble'
-            dl_descr = 'paxcounter'
-            datalogger, created = get_datalogger(device, description=dl_descr, update_activity=True)
-            ts = dateutil.parser.parse(times)
-            measurement = create_influxdb_obj(device, keys_str, idata, ts)
-            measurements = [measurement]
-            # dbname = request.GET.get('db', DIGITA_DB)
-            dbname = 'paxcounter'
-            iclient = get_influxdb_client(database=dbname)
-            iclient.create_database(dbname)
-            try:
-                iclient.write_points(measurements)
-            except InfluxDBClientError as err:
-                err_msg = '[DIGITA] InfluxDB error: {}'.format(err)
-                status = 500
-        elif payload_hex[:2] == '13':
-            idata = handle_clickey_tempsens(payload_hex)
-            idata['rssi'] = rssi
-            keys_str = 'tempsens'
-            datalogger, created = get_datalogger(device, description='Clickey Tempsens PRO', update_activity=True)
-            ts = dateutil.parser.parse(times)
-            measurement = create_influxdb_obj(device, keys_str, idata, ts)
-            measurements = [measurement]
-            # dbname = request.GET.get('db', DIGITA_DB)
-            dbname = 'digita'
-            iclient = get_influxdb_client(database=dbname)
-            iclient.create_database(dbname)
-            try:
-                iclient.write_points(measurements)
-            except InfluxDBClientError as err:
-                err_msg = '[DIGITA] InfluxDB error: {}'.format(err)
-                status = 500
-        elif payload_hex[:2].lower() == '2a':  # payload_hex[:4].lower() == '2a2a':
-            idata = handle_aqburk(payload_hex)
-            idata['rssi'] = rssi
-            keys_str = 'aqburk'
-            datalogger, created = get_datalogger(device, description='FVH AQ burk', update_activity=True)
-            ts = dateutil.parser.parse(times)
-            measurement = create_influxdb_obj(device, keys_str, idata, ts)
-            measurements = [measurement]
-            DIGITA_DB = 'aqburk'
-            dbname = request.GET.get('db', DIGITA_DB)
-            iclient = get_influxdb_client(database=dbname)
-            iclient.create_database(dbname)
-            try:
-                iclient.write_points(measurements)
-            except InfluxDBClientError as err:
-                err_msg = '[DIGITA] InfluxDB error: {}'.format(err)
-                status = 500
-        elif len(payload_hex) >= 2:  # Assume we have key-val data
+        binding = get_binding(device)
+        if binding is not None and binding.decoder:
+            decoder = get_decoder(binding.decoder)
+        else:
+            decoder = get_decoder(guess_decoder(payload_hex))
+        if decoder is not None:
             try:
-                idata = handle_keyval(payload_hex)
-            except (UnicodeDecodeError, IndexError) as err:
+                idata = decoder.decode_hex(payload_hex)
+            except DecodeError as err:
                 err_msg = '[DIGITA] Payload error: {}'.format(err)
                 status = 400
                 logger.error(err_msg)
@@ -239,19 +126,22 @@ class Plugin(BasePlugin):
                 response = HttpResponse(err_msg, status=status)
                 return response
             idata['rssi'] = rssi
-            ikeys = list(idata.keys())
-            ikeys.sort()
-            keys_str = '_'.join(ikeys)
-            datalogger, created = get_datalogger(device, description='LoRaWAN device', update_activity=True)
+            if decoder.measurement is not None:
+                keys_str = decoder.measurement
+            else:  # key-val data
+                keys_str = '_'.join(sorted(idata.keys()))
+            datalogger, created = get_datalogger(device, description=decoder.description, update_activity=True)
             ts = dateutil.parser.parse(times)
             measurement = create_influxdb_obj(device, keys_str, idata, ts)
             measurements = [measurement]
-            # dbname = request.GET.get('db', DIGITA_DB)
-            dbname = 'digita'
-            iclient = get_influxdb_client(database=dbname)
-            iclient.create_database(dbname)
+            if binding is not None and binding.database:
+                dbname = binding.database
+            elif decoder.db_param:
+                dbname = request.GET.get('db', decoder.database or DIGITA_DB)
+            else:
+                dbname = decoder.database or DIGITA_DB
             try:
-                iclient.write_points(measurements)
+                write_influxdb(dbname, measurements)
             except InfluxDBClientError as err:
                 err_msg = '[DIGITA] InfluxDB error: {}'.format(err)
                 status = 500
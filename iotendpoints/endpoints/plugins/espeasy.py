@@ -29,7 +29,7 @@ from influxdb.exceptions import InfluxDBClientError
 from endpoints.utils import BasePlugin
 from endpoints.utils import basicauth, get_influxdb_client, create_influxdb_obj
 from endpoints.utils import get_setting
-from endpoints.tasks import save_to_influxdb
+from endpoints.sinks import queue_influxdb
 
 ENV_NAME = 'ESPEASY_URL'
 URL = get_setting(ENV_NAME)
@@ -64,6 +64,10 @@ class Plugin(BasePlugin):
             ]
         return urlpatterns
 
+    def get_device_id(self, request):
+        # ESP Easy form body is a few hundred bytes, parsing it is cheap
+        return request.POST.get('idcode') if request.method == 'POST' else None
+
     @csrf_exempt
     def view_func(self, request):
         """
@@ -103,7 +107,7 @@ class Plugin(BasePlugin):
         # import json; print(json.dumps(measurement, indent=1)); print(data)
         dbname = uname  # Use username as database name
         try:
-            save_to_influxdb.delay(dbname, measurements)
+            queue_influxdb(dbname, measurements)
         except Exception as err:
             logger.error(err)
             raise
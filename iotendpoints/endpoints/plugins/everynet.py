@@ -20,7 +20,12 @@ from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
 from influxdb.exceptions import InfluxDBClientError
 from endpoints.utils import BasePlugin
-from endpoints.utils import get_influxdb_client, create_influxdb_obj
+from endpoints.utils import create_influxdb_obj
+from endpoints.bodies import BodyError, parse_body
+from endpoints.sinks import write_influxdb
+from endpoints.dedup import forget, is_duplicate
+from endpoints.decoders import DecodeError, get_decoder
+from endpoints.bindings import get_binding
 from endpoints.utils import get_setting, get_datalogger
 from endpoints.views import dump_request
 
@@ -34,13 +39,6 @@ def handle_v1(data):
     pass
 
 
-def handle_paxcounter(data_str):
-    wifi = int.from_bytes(data_str[:2], byteorder='big')
-    ble = int.from_bytes(data_str[2:], byteorder='big')
-    idata = {'wifi': wifi, 'ble': ble}
-    return idata
-
-
 def handle_keyval(data_str):
     idata = dict(re.findall(r'([^,]+)=(".*?"|[^,]+)', data_str))
     return idata
@@ -95,9 +93,9 @@ class Plugin(BasePlugin):
             return HttpResponse('OK', status=200)
         try:
             body_data = request.body
-            data = json.loads(body_data.decode('utf-8'))
-        except (ValueError, UnicodeDecodeError) as err:
-            return invalid_data(body_data, "Hint: should be UTF-8 json.", status=400)
+            data = parse_body(request)
+        except BodyError as err:
+            return invalid_data(body_data, "{}. Hint: should be UTF-8 json.".format(err), status=err.status)
         # meta and type keys should be always in request json
         try:
             device = data['meta']['device']
@@ -106,6 +104,27 @@ class Plugin(BasePlugin):
         except KeyError as err:
             err_msg = 'Invalid json structure: "{}". Hint: missing key {}.'.format(body_data, err)
             return invalid_data(body_data, err_msg, status=400)
+        if packet_type != 'uplink':
+            return self.handle_packet(request, data, device, packet_type)
+        # Same uplink may arrive via several gateways, acknowledge copies without any I/O
+        params = data.get('params', {})
+        uplink = (self.name, device, params.get('counter_up'), (times, params.get('payload')))
+        if is_duplicate(*uplink):
+            return ok_response
+        try:
+            response = self.handle_packet(request, data, device, packet_type)
+        except Exception:
+            forget(*uplink)  # let the gateway's retry through
+            raise
+        if response.status_code >= 500:
+            forget(*uplink)
+        return response
+
+    def handle_packet(self, request, data, device, packet_type):
+        """
+        Save and handle a packet, which is not a duplicate uplink.
+        """
+        ok_response = HttpResponse("ok")
         now = timezone.now().astimezone(pytz.utc)
         path = os.path.join(settings.MEDIA_ROOT, 'everynet', now.strftime('%Y-%m-%d'), device)
         os.makedirs(path, exist_ok=True)
@@ -120,13 +139,12 @@ class Plugin(BasePlugin):
             return ok_response
         elif packet_type == 'uplink':
             payload = data['params']['payload'].encode()
-            _type = request.GET.get('type')
-            if _type == 'paxcounter':
-                data_str = base64.decodebytes(payload)
-                idata = handle_paxcounter(data_str)
-                keys_str = 'wifi-ble'
-                dl_descr = 'paxcounter'
-            elif _type == 'keyval':  # data should be key=val,key2=val2,... formatted
+            binding = get_binding(device)
+            if binding is not None and binding.decoder:
+                _type = binding.decoder
+            else:
+                _type = request.GET.get('type')
+            if _type == 'keyval':  # data should be key=val,key2=val2,... formatted
                 data_str = base64.decodebytes(payload).decode('utf8')
                 print(data_str, type(data_str))
                 idata = handle_keyval(data_str)
@@ -145,6 +163,15 @@ class Plugin(BasePlugin):
 
                 keys_str = '_'.join(keys)
                 dl_descr = 'keyval'
+            elif _type is not None and get_decoder(_type) is not None:  # binary payload, e.g. paxcounter
+                decoder = get_decoder(_type)
+                data_str = base64.decodebytes(payload)
+                try:
+                    idata = decoder.decode(data_str)
+                except DecodeError as err:
+                    return invalid_data(data_str.hex(), 'Payload error: {}'.format(err), status=400)
+                keys_str = decoder.measurement
+                dl_descr = decoder.description
             else:
                 data_str = base64.decodebytes(payload).decode('utf8')
                 handle_v1(data_str)  # TODO
@@ -171,13 +198,12 @@ class Plugin(BasePlugin):
             ts = pytz.UTC.localize(ts)  # Make timestamp timezone aware at UTC
             measurement = create_influxdb_obj(device, keys_str, idata, ts)
             measurements = [measurement]
-            dbname = request.GET.get('db')
-            if dbname is None:
-                dbname = EVERYNET_DB
-            iclient = get_influxdb_client(database=dbname)
-            iclient.create_database(dbname)
+            if binding is not None and binding.database:
+                dbname = binding.database
+            else:
+                dbname = request.GET.get('db', EVERYNET_DB)
             try:
-                iclient.write_points(measurements)
+                write_influxdb(dbname, measurements)
                 response = HttpResponse("ok")
             except InfluxDBClientError as err:
                 err_msg = '[EVERYNET] InfluxDB error: {}'.format(err)
@@ -0,0 +1,119 @@
+"""
+Noise sensor v1 endpoint.
+
+Sensors send once a minute a GET request with device MAC, RSSI, uptime and
+one second peak-to-peak values, oldest first, the last one measured at request time:
+
+    /noisesensor/v1?mac=5C:CF:7F:00:00:01&rssi=-67&uptime=123456&1s=83,85,0,82,...
+
+URL is `noisesensor/v1` by default, it can be changed with NOISESENSOR_URL.
+Values are saved to NOISESENSOR_DB (default 'noisesensor') as measurements
+`rssi`, `uptime` (seconds) and `raw_pp` (zero values are skipped).
+
+The query is parsed directly to packed series (see endpoints.lineprotocol) with
+integer microsecond timestamps and queued for asynchronous write, no dict or
+datetime is created per sample.
+"""
+import logging
+import time
+
+from django.conf.urls import url
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from endpoints.lineprotocol import PACK_VERSION
+from endpoints.utils import BasePlugin
+from endpoints.utils import get_setting
+from endpoints.sinks import queue_packed_influxdb
+
+ENV_NAME = 'NOISESENSOR_URL'
+URL = get_setting(ENV_NAME, 'noisesensor/v1')
+NOISESENSOR_DB = get_setting('NOISESENSOR_DB', 'noisesensor')
+SECOND_US = 1000000
+logger = logging.getLogger(__name__)
+
+
+def parse_noisesensor_v1(params, now_us=None):
+    """
+    Parse noise sensor v1 query parameters to packed measurements.
+
+    :param params: QueryDict or dict with mac, rssi, uptime and 1s keys
+    :param int now_us: time of the last 1s value in epoch microseconds, default now
+    :return: dict, see endpoints.lineprotocol.pack_measurements()
+    :raises ValueError: if a parameter is missing or invalid
+    """
+    if now_us is None:
+        now_us = int(time.time() * SECOND_US)
+    dev_id = params.get('mac')
+    if not dev_id:
+        raise ValueError('mac is missing')
+    rssi = params.get('rssi')
+    if rssi is None:
+        raise ValueError('rssi is missing')
+    rssi = int(rssi)
+    uptime = int(params.get('uptime') or 0)
+    svals = [int(x) for x in params.get('1s', '').split(',') if x]
+    if not svals:
+        raise ValueError('1s is missing or empty')
+    tags = {'dev-id': dev_id}
+    series = [['rssi', tags, ['rssi'], [now_us], [[rssi]]]]
+    if uptime:
+        series.append(['uptime', tags, ['uptime'], [now_us], [[uptime / 1000.0]]])
+    deltas = []
+    values = []
+    prev = 0
+    ts = now_us - (len(svals) - 1) * SECOND_US
+    for val in svals:
+        if val > 0:
+            deltas.append(ts - prev)
+            values.append(val)
+            prev = ts
+        ts += SECOND_US
+    if values:
+        series.append(['raw_pp', tags, ['raw'], deltas, [values]])
+    return {'v': PACK_VERSION, 'series': series}
+
+
+class Plugin(BasePlugin):
+    """
+    Noise sensor v1 plugin. Endpoint is always in use, NOISESENSOR_URL only changes its path.
+    """
+    name = 'noisesensor'
+    viewname = 'noisesensorhandler'
+
+    def __init__(self):
+        super().__init__()
+        self.in_use = True
+
+    def register(self):
+        print('Registering plugin "{}"'.format(self.name))
+
+    def get_urlpatterns(self):
+        url_pattern = r'^{}$'.format(URL)
+        urlpatterns = [
+            url(url_pattern, self.view_func, name=self.viewname),
+        ]
+        return urlpatterns
+
+    def get_device_id(self, request):
+        return request.GET.get('mac')
+
+    @csrf_exempt
+    def view_func(self, request):
+        """
+        Test like this:
+
+        http -v GET "http://127.0.0.1:8000/noisesensor/v1?mac=5C:CF:7F:00:00:01&rssi=-67&uptime=60000&1s=83,85,84"
+        """
+        try:
+            packed = parse_noisesensor_v1(request.GET)
+        except ValueError as err:
+            err_msg = '[NOISESENSOR] Invalid data: {}. Hint: query was "{}".'.format(
+                err, request.META.get('QUERY_STRING', '')[:100])
+            logger.warning(err_msg)
+            return HttpResponse(err_msg, status=400)
+        try:
+            queue_packed_influxdb(NOISESENSOR_DB, packed)
+        except Exception as err:
+            logger.error(err)
+            raise
+        return HttpResponse("ok")
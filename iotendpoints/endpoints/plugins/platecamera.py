@@ -12,16 +12,18 @@ If you use supervisord to keep gunicorn or similar running, you can add line
 
 Raw gunicorn seems to accept `--env PLATECAMERA_URL=path_without_leading_slash` command line argument.
 """
-import json
 import logging
 import os
 from dateutil.parser import parse
 from django.conf.urls import url
+from django.core.exceptions import RequestDataTooBig
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from influxdb.exceptions import InfluxDBClientError
 from endpoints.utils import BasePlugin
-from endpoints.utils import get_influxdb_client, create_influxdb_obj
+from endpoints.utils import create_influxdb_obj
+from endpoints.bodies import BodyError, parse_body
+from endpoints.sinks import write_influxdb
 from endpoints.utils import get_setting
 from endpoints.views import dump_request
 from endpoints.models import Plate
@@ -67,16 +69,25 @@ class Plugin(BasePlugin):
 
     @csrf_exempt
     def view_func(self, request):
-        res = dump_request(request, postfix='democam')
+        # Parse request.body, the dump is cut off at DUMP_MAX_BYTES
+        try:
+            res = dump_request(request, postfix='democam', stream=False)
+        except RequestDataTooBig as err:  # larger than DATA_UPLOAD_MAX_MEMORY_SIZE
+            return HttpResponse('Request body is too large: {}'.format(err), status=413)
         ok_response = HttpResponse("ok")
         body_data = ''
         if request.method not in ['POST']:
             return HttpResponse('Only POST methdod is allowed', status=405)
+        if request.dump_truncated:
+            return HttpResponse('Request body is larger than {} bytes'.format(
+                get_setting('DUMP_MAX_BYTES', 50 * 1024 * 1024)), status=413)
+        if request.dump_duplicate_of is not None:  # camera resent a plate which is already saved
+            return ok_response
         try:
             body_data = request.body
-            data = json.loads(body_data.decode('utf-8'))
-        except (ValueError, UnicodeDecodeError) as err:
-            return invalid_data(body_data, "Hint: should be UTF-8 json.", status=400)
+            data = parse_body(request)
+        except BodyError as err:
+            return invalid_data(body_data, "{}. Hint: should be UTF-8 json.".format(err), status=err.status)
         # Validate data
         if "direction" not in data.keys():
             data["direction"] = -1
@@ -97,10 +108,8 @@ class Plugin(BasePlugin):
         measurement = create_influxdb_obj('001', 'cnt', idata, timestamp)
         measurements = [measurement]
         dbname = 'vehicle'
-        iclient = get_influxdb_client(database=dbname)
-        iclient.create_database(dbname)
         try:
-            iclient.write_points(measurements)
+            write_influxdb(dbname, measurements)
             response = HttpResponse("OK")
         except InfluxDBClientError as err:
             err_msg = '[PLATECAMERA] InfluxDB error: {}'.format(err)
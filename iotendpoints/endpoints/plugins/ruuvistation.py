@@ -4,7 +4,6 @@ Ruuvi Station endpoint.
 You must declare environment variable RUUVISTATION_URL to activate this plugin.
 """
 
-import json
 import dateutil.parser
 import logging
 from django.conf.urls import url
@@ -13,8 +12,9 @@ from django.utils.timezone import get_default_timezone
 from django.views.decorators.csrf import csrf_exempt
 from endpoints.utils import BasePlugin
 from endpoints.utils import basicauth, create_influxdb_obj
+from endpoints.bodies import BodyError, parse_body
 from endpoints.utils import get_setting
-from endpoints.tasks import save_to_influxdb
+from endpoints.sinks import queue_influxdb
 
 ENV_NAME = 'RUUVISTATION_URL'
 URL = get_setting(ENV_NAME)
@@ -99,16 +99,16 @@ class Plugin(BasePlugin):
             # return HttpResponse("Authentication failure", status=401)
         try:
             body_data = request.body
-            data = json.loads(body_data.decode('utf-8'))
-        except (json.decoder.JSONDecodeError, UnicodeDecodeError) as err:
-            log_msg = '[RUUVISTATION] Invalid data: "{}". Hint: should be UTF-8 json.'.format(body_data[:50])
-            err_msg = 'Invalid data: "{}"... Hint: should be UTF-8 json.'.format(body_data[:50])
+            data = parse_body(request)
+        except BodyError as err:
+            log_msg = '[RUUVISTATION] Invalid data: "{}". {}. Hint: should be UTF-8 json.'.format(body_data[:50], err)
+            err_msg = 'Invalid data: "{}"... {}. Hint: should be UTF-8 json.'.format(body_data[:50], err)
             logger.error(log_msg)
-            return HttpResponse(err_msg, status=400)
+            return HttpResponse(err_msg, status=err.status)
         measurements = parse_tag_data(data)
         dbname = request.GET.get('db', RUUVISTATION_DB)
         try:
-            save_to_influxdb.delay(dbname, measurements)
+            queue_influxdb(dbname, measurements)
         except Exception as err:
             logger.error(err)
         response = HttpResponse("ok")
@@ -48,8 +48,10 @@ from django.views.decorators.csrf import csrf_exempt
 from influxdb.exceptions import InfluxDBClientError
 from endpoints.utils import BasePlugin
 from endpoints.utils import basicauth, get_influxdb_client, create_influxdb_obj
+from endpoints.bodies import BodyError, parse_body
 from endpoints.utils import get_setting, get_datalogger
-from endpoints.tasks import save_to_influxdb, push_ngsi_orion
+from endpoints.sinks import queue_influxdb
+from endpoints.tasks import push_ngsi_orion
 
 ENV_NAME = 'SENTILO_URL'
 URL = get_setting(ENV_NAME)
@@ -165,10 +167,10 @@ class Plugin(BasePlugin):
         export SENTILO_URL=sentilo
         http -v PUT http://127.0.0.1:8000/sentilo < sentilo_packet.json
         """
-        rawbody = request.body.decode('utf-8')
+        rawbody = request.body.decode('utf-8', errors='replace')
         try:
-            data = json.loads(request.body.decode('utf-8'))
-        except ValueError as err:
+            data = parse_body(request)
+        except BodyError as err:
             print(str(err))
             with open('/tmp/sentiloraw.log', 'at') as f:
                 import datetime
@@ -189,7 +191,7 @@ class Plugin(BasePlugin):
         # print(json.dumps(measurement, indent=1)); print(data)
         dbname = SENTILO_DB
         try:
-            save_to_influxdb.delay(dbname, measurements)
+            queue_influxdb(dbname, measurements)
         except Exception as err:
             logger.error(err)
         ngsi_json = parse_sentilo2ngsi(data, lat, lon)
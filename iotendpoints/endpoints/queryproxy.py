@@ -0,0 +1,322 @@
+"""
+Caching read-through proxy for InfluxDB queries of dashboards.
+
+/query accepts the same parameters as InfluxDB /query (db, q, epoch, rp), so
+a Grafana InfluxDB data source can use this server as its URL, with basic
+auth of a user of this server. Only SELECT and SHOW (measurements, series,
+tag, field and retention policy) queries to databases in QUERY_PROXY_DATABASES
+are allowed, also when a database is named in the query, e.g.
+`FROM "db"."rp"."measurement"` or `SHOW MEASUREMENTS ON "db"`.
+
+Queries are normalized before caching: whitespace outside quoted strings is
+collapsed, absolute epoch time bounds are widened to QUERY_PROXY_BUCKET
+(default 60 s) boundaries and now() is replaced with the end of the current
+bucket. So all viewers of a dashboard send the same query during a bucket,
+at the cost of up to one bucket of extra data at the range edges.
+
+Results are cached in Django cache QUERY_PROXY_CACHE (default 'default'),
+set it to a shared cache (e.g. memcached) to share results between gunicorn
+workers. Cache time depends on the age of the end of the queried range:
+
+- ranges ending within QUERY_PROXY_LATE seconds (default 300) of now, where
+  late data may still arrive: QUERY_PROXY_RECENT_TTL (default 10 s)
+- older ranges: their age, at most QUERY_PROXY_MAX_TTL (default 86400 s)
+
+Concurrent identical queries are collapsed into one InfluxDB query: inside a
+process other requests wait for the first one, between processes the first
+one takes a lock in the cache and others poll the cache for its result.
+"""
+import hashlib
+import re
+import threading
+import time
+from collections import Counter
+
+import requests
+from django.core.cache import caches
+
+from endpoints.utils import get_setting
+
+DEFAULT_DATABASES = ['sentilo', 'aqburk', 'paxcounter', 'ruuvistation']
+UNITS_US = {'ns': 0.001, 'u': 1, 'µ': 1, 'ms': 1000, 's': 1000000, 'm': 60000000, 'h': 3600000000}
+SECOND_US = 1000000
+QUOTED = re.compile(r'''('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")''')
+TIME_BOUND = re.compile(r'\btime\s*(>=|>|<=|<)\s*(\d+)(ns|u|µ|ms|s)?\b', re.IGNORECASE)
+NOW = re.compile(r'\bnow\(\)', re.IGNORECASE)
+TOKEN = re.compile(r'''\s*(?:('(?:[^'\\]|\\.)*')|("(?:[^"\\]|\\.)*")|([A-Za-z_]\w*)|(\d[\w.]*)|(\S))''', re.DOTALL)
+REGEX = re.compile(r'/(?:[^/\\]|\\.)*/')
+REGEX_AFTER = {'SELECT', 'FROM', 'WHERE', 'AND', 'OR', 'BY', 'WITH', 'ON'}  # words after which / starts a regex
+FORBIDDEN = {'INTO', 'DROP', 'DELETE', 'CREATE', 'ALTER', 'GRANT', 'REVOKE', 'KILL'}
+SHOW_ALLOWED = {'MEASUREMENTS', 'MEASUREMENT', 'SERIES', 'TAG', 'FIELD', 'RETENTION'}
+
+stats = Counter()  # hits, misses, collapsed, backend_queries, uncacheable
+
+
+class QueryError(ValueError):
+    pass
+
+
+def normalize(query, now_us=None, bucket=None):
+    """
+    Normalize InfluxQL query for caching, see module docstring.
+
+    :return: tuple (normalized query, end of the queried range in epoch microseconds or None)
+    """
+    if now_us is None:
+        now_us = int(time.time() * SECOND_US)
+    if bucket is None:
+        bucket = float(get_setting('QUERY_PROXY_BUCKET', 60))
+    bucket_us = int(bucket * SECOND_US)
+    now_end = now_us - now_us % bucket_us + bucket_us
+    ends = []
+
+    def align(m):
+        op, value, unit = m.group(1), int(m.group(2)), (m.group(3) or 'ns')
+        ts = int(value * UNITS_US[unit])
+        if op.startswith('>'):
+            ts -= ts % bucket_us
+        else:
+            ts += -ts % bucket_us
+            ends.append(ts)
+        return 'time {} {}u'.format(op, ts)
+
+    parts = QUOTED.split(query.strip())
+    for i in range(0, len(parts), 2):  # even parts are outside quotes
+        part = re.sub(r'\s+', ' ', parts[i])
+        part = NOW.sub('{}u'.format(now_end), part)
+        parts[i] = TIME_BOUND.sub(align, part)
+    normalized = ''.join(parts).rstrip(';')
+    if NOW.search(query) and not ends:
+        ends.append(now_end)  # e.g. time > now() - 1h
+    return normalized, max(ends) if ends else None
+
+
+def get_ttl(end_us, now_us=None):
+    """Return cache time in seconds for results of a range ending at `end_us`."""
+    if now_us is None:
+        now_us = int(time.time() * SECOND_US)
+    recent_ttl = float(get_setting('QUERY_PROXY_RECENT_TTL', 10))
+    if end_us is None:
+        return recent_ttl
+    age = (now_us - end_us) / SECOND_US
+    if age < float(get_setting('QUERY_PROXY_LATE', 300)):
+        return recent_ttl
+    return min(float(get_setting('QUERY_PROXY_MAX_TTL', 86400)), max(recent_ttl, age))
+
+
+def tokenize(query):
+    """
+    Split InfluxQL query to tokens.
+
+    :return: list of (kind, value) tuples, kind is 'string', 'ident' (quoted identifier, unescaped),
+        'word' (keyword or identifier), 'number', 'regex' or 'punct'
+    :raises QueryError: if a quoted string or regex is not terminated
+    """
+    tokens = []
+    pos = 0
+    query = query.rstrip()
+    while pos < len(query):
+        prev = tokens[-1] if tokens else None
+        m = TOKEN.match(query, pos)
+        string, ident, word, number, punct = m.groups()
+        if punct == '/' and not (prev and (prev[0] in ('ident', 'number', 'string') or prev == ('punct', ')') or
+                                           (prev[0] == 'word' and prev[1].upper() not in REGEX_AFTER))):
+            r = REGEX.match(query, m.start(5))
+            if r is None:
+                raise QueryError('Unterminated regular expression')
+            tokens.append(('regex', r.group()))
+            pos = r.end()
+            continue
+        if string is not None:
+            tokens.append(('string', string))
+        elif ident is not None:
+            tokens.append(('ident', re.sub(r'\\(.)', r'\1', ident[1:-1])))
+        elif word is not None:
+            tokens.append(('word', word))
+        elif number is not None:
+            tokens.append(('number', number))
+        elif punct in ('"', "'"):
+            raise QueryError('Unterminated quoted string')
+        else:
+            tokens.append(('punct', punct))
+        pos = m.end()
+    return tokens
+
+
+def _name(token):
+    """Return identifier of a word or quoted identifier token, None if it is something else."""
+    return token[1] if token is not None and token[0] in ('word', 'ident') else None
+
+
+def _check_database(dbname, databases):
+    if dbname not in databases:
+        raise QueryError('Database "{}" is not available'.format(dbname))
+
+
+def _from_databases(tokens, i):
+    """
+    Parse comma separated measurement names after FROM at tokens[i].
+
+    :return: list of databases named in fully qualified measurements ("db"."rp"."m" or "db".."m")
+    """
+    databases = []
+    while i < len(tokens):
+        if tokens[i] == ('punct', '('):
+            break  # subquery, its own FROM is checked separately
+        parts = [tokens[i]]
+        i += 1
+        while i < len(tokens) and tokens[i] == ('punct', '.'):
+            i += 1
+            if i < len(tokens) and tokens[i] != ('punct', '.') and tokens[i][0] in ('word', 'ident', 'regex'):
+                parts.append(tokens[i])
+                i += 1
+            else:
+                parts.append(('ident', ''))
+        if len(parts) > 3:
+            raise QueryError('Invalid measurement name')
+        if len(parts) == 3:
+            if _name(parts[0]) is None:
+                raise QueryError('Invalid database name')
+            databases.append(_name(parts[0]))
+        if i < len(tokens) and tokens[i] == ('punct', ','):
+            i += 1
+        else:
+            break
+    return databases
+
+
+def check_query(dbname, query):
+    """
+    :raises QueryError: if a database is not allowed or any statement is not an allowed read
+    """
+    databases = get_setting('QUERY_PROXY_DATABASES', DEFAULT_DATABASES) or []
+    _check_database(dbname, databases)
+    tokens = tokenize(query)
+    statements = [[]]
+    for token in tokens:
+        if token == ('punct', ';'):
+            statements.append([])
+        else:
+            statements[-1].append(token)
+    for statement in statements:
+        if not statement:
+            continue
+        keywords = [value.upper() if kind == 'word' else None for kind, value in statement]
+        if keywords[0] not in ('SELECT', 'SHOW') or FORBIDDEN.intersection(keywords):
+            raise QueryError('Only SELECT and SHOW queries are allowed')
+        if keywords[0] == 'SHOW' and (len(keywords) < 2 or keywords[1] not in SHOW_ALLOWED):
+            raise QueryError('Only SHOW MEASUREMENTS, SERIES, TAG, FIELD and RETENTION POLICIES queries are allowed')
+        for i, keyword in enumerate(keywords):
+            if keyword == 'FROM':
+                for name in _from_databases(statement, i + 1):
+                    _check_database(name, databases)
+            elif keyword == 'ON' and keywords[0] == 'SHOW':
+                name = _name(statement[i + 1]) if i + 1 < len(statement) else None
+                if name is None:
+                    raise QueryError('Invalid database name')
+                _check_database(name, databases)
+
+
+class Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Collapser:
+    """Run one function call per key at a time, concurrent callers with the same key get its result."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func, timeout=60):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+        if not leader:
+            stats['collapsed'] += 1
+            if not call.event.wait(timeout):
+                return func()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+            return call.result
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+
+_collapser = Collapser()
+
+
+def query_backend(params):
+    """
+    :return: tuple (HTTP status, content type, body bytes) of InfluxDB /query
+    """
+    stats['backend_queries'] += 1
+    url = 'http://{}:{}/query'.format(get_setting('INFLUXDB_HOST', '127.0.0.1'), get_setting('INFLUXDB_PORT', 8086))
+    res = requests.get(url, params=params, timeout=float(get_setting('QUERY_PROXY_TIMEOUT', 30)))
+    return res.status_code, res.headers.get('Content-Type', 'application/json'), res.content
+
+
+def cached_query(params, key, ttl):
+    """Return cached result of query `params`, query InfluxDB if not cached, see module docstring."""
+    cache = caches[get_setting('QUERY_PROXY_CACHE', 'default')]
+    result = cache.get(key)
+    if result is not None:
+        stats['hits'] += 1
+        return result
+
+    def load():
+        lock_timeout = float(get_setting('QUERY_PROXY_LOCK_TIMEOUT', 30))
+        locked = cache.add('lock:' + key, 1, lock_timeout)
+        if not locked:
+            # another process is running the same query
+            deadline = time.monotonic() + lock_timeout
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                cached = cache.get(key)
+                if cached is not None:
+                    stats['collapsed'] += 1
+                    return cached
+                if cache.get('lock:' + key) is None:
+                    break  # the result was not cacheable
+        stats['misses'] += 1
+        try:
+            status, content_type, body = query_backend(params)
+            cacheable = status == 200 and b'"error"' not in body
+            if cacheable and len(body) <= int(get_setting('QUERY_PROXY_MAX_BYTES', 5 * 1024 * 1024)):
+                cache.set(key, (status, content_type, body), ttl)
+            else:
+                stats['uncacheable'] += 1
+            return status, content_type, body
+        finally:
+            if locked:
+                cache.delete('lock:' + key)
+
+    return _collapser.do(key, load)
+
+
+def proxy_query(params):
+    """
+    :param dict params: InfluxDB /query parameters db, q and optional epoch and rp
+    :return: tuple (HTTP status, content type, body bytes)
+    :raises QueryError: if the query is not allowed
+    """
+    dbname, query = params.get('db', ''), params.get('q', '')
+    check_query(dbname, query)
+    normalized, end_us = normalize(query)
+    params = {k: params[k] for k in ('db', 'epoch', 'rp') if params.get(k)}
+    params['q'] = normalized
+    key = 'influxql:' + hashlib.sha1(repr(sorted(params.items())).encode('utf-8')).hexdigest()
+    return cached_query(params, key, get_ttl(end_us))
@@ -0,0 +1,218 @@
+"""
+Token bucket rate limiting of plugin endpoints by device, user and plugin.
+
+Every plugin view is wrapped by `limit_view()` in `endpoints.utils.plugin_urlpatterns()`.
+Before the view parses the request, one token is taken from each bucket of
+the request:
+
+- device: device id from `BasePlugin.get_device_id()`, if the plugin can tell
+  it without parsing the body (e.g. noise sensor `mac` GET parameter)
+- user: user name of an authenticated user, either logged in or with a valid
+  basic auth header. Basic auth is checked only if user scope is limited,
+  the result is reused by the view (see endpoints.utils.basicauth()), and
+  requests with invalid credentials are limited only by device and plugin.
+- plugin: plugin name
+
+RATELIMITS setting defines rate (tokens per second) and burst (bucket size)
+of every scope, and action when a bucket is empty: 'reject' returns 429 with
+Retry-After header, 'drop' returns 200 without handling the request, so
+devices which retry failed requests forever calm down, and 'log' handles the
+request but counts it in /status/ratelimit and logs the first one per key,
+so limits can be tried out before they are enforced. Action defaults to
+'reject' and scopes not in RATELIMITS are not limited. Settings ship with
+all scopes in log-only mode, nothing is throttled until an action is changed:
+
+    RATELIMITS = {
+        'device': {'rate': 1, 'burst': 120, 'action': 'log'},
+        'user': {'rate': 20, 'burst': 600, 'action': 'log'},
+        'plugin': {'rate': 200, 'burst': 2000, 'action': 'log'},
+    }
+
+E.g. 'action': 'drop' for device scope and no action (reject) for the others
+enforces the limits.
+
+RATELIMIT_OVERRIDES sets limits of single keys, e.g.
+{'plugin:sentilo': {'rate': 500, 'burst': 5000}, 'device:noisesensor:5C:CF:7F:00:00:01': None},
+None disables the limit of a key.
+
+Buckets are kept in process memory. Set RATELIMIT_CACHE to a Django cache
+alias (e.g. memcached) to enforce the limits over all gunicorn workers: the
+request must then also fit in a shared counter of `burst` requests per
+burst / rate seconds, which is checked only if the local bucket has tokens.
+Throttled request counts per key are in /status/ratelimit.
+"""
+import binascii
+import functools
+import logging
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.core.cache import caches
+from django.http import HttpResponse
+
+from endpoints.utils import basicauth, get_setting
+
+logger = logging.getLogger(__name__)
+
+SCOPES = ('device', 'user', 'plugin')
+MAX_BUCKETS = 100000
+
+throttled = Counter()  # key -> number of throttled requests
+_throttled_lock = threading.Lock()
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic() if now is None else now
+
+    def take(self, now=None):
+        """
+        Take one token. Return 0 if it was available, otherwise seconds until next token.
+        """
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else 3600
+
+
+class Limiter:
+    """In-process token buckets by key, least recently used buckets are dropped after MAX_BUCKETS."""
+
+    def __init__(self, max_buckets=MAX_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+        self.max_buckets = max_buckets
+
+    def take(self, key, rate, burst):
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None or bucket.rate != rate or bucket.burst != burst:
+                bucket = self.buckets[key] = TokenBucket(rate, burst)
+                if len(self.buckets) > self.max_buckets:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+            return bucket.take()
+
+
+_limiter = Limiter()
+
+
+def take_shared(key, rate, burst):
+    """
+    Count a request in RATELIMIT_CACHE. Return 0 if it fits in the limit, otherwise seconds to wait.
+    """
+    alias = get_setting('RATELIMIT_CACHE')
+    if not alias:
+        return 0
+    cache = caches[alias]
+    period = max(1, int(math.ceil(burst / rate))) if rate > 0 else 3600
+    slot = int(time.time()) // period
+    cache_key = 'ratelimit:{}:{}'.format(key, slot)
+    if cache.add(cache_key, 1, period + 1):
+        return 0
+    try:
+        count = cache.incr(cache_key)
+    except ValueError:  # expired between add and incr
+        return 0
+    if count <= burst:
+        return 0
+    return (slot + 1) * period - time.time()
+
+
+def get_limit(scope, key):
+    """
+    :return: dict with rate, burst and action or None if the key is not limited
+    """
+    overrides = get_setting('RATELIMIT_OVERRIDES', {}) or {}
+    if key in overrides:
+        limit = overrides[key]
+        if limit is not None:
+            limit = dict((get_setting('RATELIMITS', {}) or {}).get(scope) or {}, **limit)
+        return limit
+    return (get_setting('RATELIMITS', {}) or {}).get(scope)
+
+
+def user_limited():
+    """Return True if any user is rate limited."""
+    overrides = get_setting('RATELIMIT_OVERRIDES', {}) or {}
+    return bool((get_setting('RATELIMITS', {}) or {}).get('user')) or any(k.startswith('user:') for k in overrides)
+
+
+def request_username(request):
+    """Return user name of logged in user or valid basic auth header, None if there is none."""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user.get_username()
+    try:
+        user = basicauth(request)[2]
+    except (ValueError, binascii.Error, UnicodeDecodeError):  # malformed header
+        return None
+    return user.get_username() if user is not None else None
+
+
+def check(plugin, request):
+    """
+    Take tokens for a request to `plugin`.
+
+    :return: None if the request may be handled, otherwise tuple (action, seconds to wait)
+    """
+    devid = plugin.get_device_id(request)
+    username = request_username(request) if user_limited() else None
+    keys = []
+    if devid:
+        keys.append(('device', 'device:{}:{}'.format(plugin.name, devid)))
+    if username:
+        keys.append(('user', 'user:{}'.format(username)))
+    keys.append(('plugin', 'plugin:{}'.format(plugin.name)))
+    for scope, key in keys:
+        limit = get_limit(scope, key)
+        if not limit:
+            continue
+        rate, burst = float(limit['rate']), float(limit['burst'])
+        wait = _limiter.take(key, rate, burst) or take_shared(key, rate, burst)
+        if wait:
+            with _throttled_lock:
+                throttled[key] += 1
+                first = throttled[key] == 1
+            action = limit.get('action', 'reject')
+            if action != 'log':
+                return action, wait
+            if first:
+                logger.warning('[RATELIMIT] {} is over its limit of {} requests/s, burst {}'.format(key, rate, burst))
+    return None
+
+
+def limit_view(plugin, view):
+    """Wrap plugin's view function with rate limits."""
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        result = check(plugin, request)
+        if result is None:
+            return view(request, *args, **kwargs)
+        action, wait = result
+        if action == 'drop':
+            return HttpResponse('ok')
+        response = HttpResponse('Rate limit exceeded, try again later', status=429)
+        response['Retry-After'] = str(int(math.ceil(wait)))
+        return response
+
+    wrapper.csrf_exempt = getattr(view, 'csrf_exempt', False)
+    return wrapper
+
+
+def stats(limit=100):
+    """Return `limit` most throttled keys and their counts."""
+    with _throttled_lock:
+        return dict(throttled.most_common(limit))
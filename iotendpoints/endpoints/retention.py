@@ -0,0 +1,148 @@
+"""
+Retention policy for dumped requests, see endpoints.views.dump_request.
+
+REQUEST_RETENTION_DAYS setting maps postfix (first directory of Request.path,
+e.g. 'digita') to days to keep, either for all statuses or per status.
+'*' matches any postfix or status and None keeps requests forever. It is
+empty by default, so nothing is purged until operators opt in:
+
+    REQUEST_RETENTION_DAYS = {
+        '*': {'*': 365, 'SPAM': 30, 'DELETED': 7},
+        'democam': 14,
+    }
+
+The most specific rule wins: postfix and status, postfix, status, default.
+
+`purge_requests()` deletes expired requests in batches. Each batch removes the
+dump directories in parallel threads and then the rows with one DELETE, so the
+table is never locked for long. It is run daily by celery beat and by
+`python manage.py purgerequests`.
+"""
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from endpoints.models import Request
+from endpoints.utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+ANY = '*'
+
+
+def get_rules(retention=None):
+    """
+    Flatten REQUEST_RETENTION_DAYS setting to list of (postfix, status, days), most specific first.
+    """
+    if retention is None:
+        retention = get_setting('REQUEST_RETENTION_DAYS', {}) or {}
+    rules = []
+    for postfix, days in retention.items():
+        if not isinstance(days, dict):
+            days = {ANY: days}
+        for status, d in days.items():
+            rules.append((postfix, status, d))
+    rules.sort(key=lambda r: (r[0] == ANY, r[1] == ANY))
+    return rules
+
+
+def rule_scope(postfix, status):
+    q = Q()
+    if postfix != ANY:
+        q &= Q(path__startswith=postfix + '/')
+    if status != ANY:
+        q &= Q(status=status)
+    return q
+
+
+def expired_requests(rules=None, now=None):
+    """
+    Yield (rule, queryset of expired requests) for every rule which has days set.
+    Requests matching a more specific rule are excluded from the less specific ones.
+    """
+    if rules is None:
+        rules = get_rules()
+    if now is None:
+        now = timezone.now()
+    for i, (postfix, status, days) in enumerate(rules):
+        if days is None:
+            continue
+        qs = Request.objects.filter(rule_scope(postfix, status), created__lt=now - timedelta(days=days))
+        for other_postfix, other_status, _ in rules[:i]:
+            qs = qs.exclude(rule_scope(other_postfix, other_status))
+        yield (postfix, status, days), qs
+
+
+def get_dump_dir(path):
+    """
+    Return absolute directory of a dump or None, if `path` is empty or outside MEDIA_ROOT.
+    """
+    if not path:
+        return None
+    root = os.path.realpath(settings.MEDIA_ROOT)
+    full_path = os.path.realpath(os.path.join(root, path))
+    if not full_path.startswith(root + os.sep):
+        return None
+    return full_path
+
+
+def remove_dump_dir(path):
+    full_path = get_dump_dir(path)
+    if full_path is not None:
+        shutil.rmtree(full_path, ignore_errors=True)
+        # Remove day and postfix directories too, if they are empty now
+        for parent in (os.path.dirname(full_path), os.path.dirname(os.path.dirname(full_path))):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+
+
+def purge_queryset(qs, batch_size=1000, workers=8, pause=0, dry_run=False):
+    """
+    Delete requests of `qs` and their dump directories in batches.
+
+    :param int batch_size: rows per DELETE
+    :param int workers: threads removing directories
+    :param float pause: seconds to sleep between batches, gives room to other queries
+    :return: number of deleted requests
+    """
+    if dry_run:
+        return qs.count()
+    deleted = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            batch = list(qs.order_by('created').values_list('id', 'path')[:batch_size])
+            if not batch:
+                break
+            # Files first: if we are interrupted, the rows are still there and purged next time
+            list(executor.map(remove_dump_dir, [path for _, path in batch]))
+            Request.objects.filter(id__in=[pk for pk, _ in batch]).delete()
+            deleted += len(batch)
+            if len(batch) < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+    return deleted
+
+
+def purge_requests(batch_size=1000, workers=8, pause=0, dry_run=False, now=None):
+    """
+    Delete requests which are older than their retention.
+
+    :return: dict rule -> number of deleted requests
+    """
+    result = {}
+    for rule, qs in expired_requests(now=now):
+        cnt = purge_queryset(qs, batch_size=batch_size, workers=workers, pause=pause, dry_run=dry_run)
+        result[rule] = cnt
+        if cnt and not dry_run:
+            logger.info('Purged {} requests, postfix {} status {} older than {} days'.format(cnt, *rule))
+    return result
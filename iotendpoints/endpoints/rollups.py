@@ -0,0 +1,185 @@
+"""
+Continuous downsampling of selected measurement fields at ingest.
+
+ROLLUP_RULES setting selects measurements, fields and window lengths:
+
+    ROLLUP_RULES = [
+        {'measurement': 'aqburk', 'fields': ['pm25avg', 'pm10avg', 'temp', 'humi'], 'windows': ['5m', '1h']},
+        {'measurement': 'ruuvitag', 'fields': ['temperature', 'humidity', 'pressure'], 'windows': ['5m', '1h']},
+    ]
+
+For every series (measurement and tag set) and window, fields `<field>_mean`,
+`<field>_min`, `<field>_max` and `<field>_count` are computed and written to
+the same measurement and tags in a separate database, named by
+ROLLUP_DATABASES setting ({window: (database name template, retention)}).
+Default is '<source database>_<window>' with retention of ROLLUP_RETENTION
+({window: InfluxDB duration}, default 400 days for 5m and infinite for 1h),
+which is set as default retention policy 'rollup' of the database:
+
+    SELECT "temp_mean" FROM "aqburk_1h"."rollup"."aqburk" WHERE time > now() - 365d
+
+Points may arrive late: a window is finished ROLLUP_WATERMARK seconds
+(default 300) after its end and points older than that are dropped. Windows
+are kept in endpoints.windows store, rules are ignored unless ROLLUP_REDIS_URL
+is set, see there.
+"""
+import json
+import logging
+import re
+import time
+from collections import defaultdict
+
+from endpoints.lineprotocol import time_to_us
+from endpoints.utils import get_setting
+from endpoints.windows import get_window_store, is_enabled
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE = 'rollup'
+SECOND_US = 1000000
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+DEFAULT_RETENTION = {'5m': '400d', '1h': 'INF'}
+late_points = 0  # number of dropped points, which arrived after their window was finished
+
+_rules = None
+_rules_source = None
+
+
+def window_seconds(name):
+    """'15m' -> 900"""
+    m = re.match(r'^(\d+)([smhd])$', name)
+    if m is None:
+        raise ValueError('Invalid rollup window "{}", use e.g. 30s, 5m, 1h or 1d'.format(name))
+    return int(m.group(1)) * UNITS[m.group(2)]
+
+
+def get_rules():
+    """
+    :return: dict measurement -> list of (fields, [(window name, seconds), ...]), empty if windows can't be shared
+    """
+    global _rules, _rules_source
+    source = get_setting('ROLLUP_RULES', []) or []
+    if source and not is_enabled():
+        return {}
+    if _rules is None or source is not _rules_source:
+        rules = defaultdict(list)
+        for rule in source:
+            windows = [(w, window_seconds(w)) for w in rule['windows']]
+            rules[rule['measurement']].append((list(rule['fields']), windows))
+        _rules, _rules_source = dict(rules), source
+    return _rules
+
+
+def target_database(dbname, window):
+    """
+    :return: tuple (database name, retention duration) for rollups of `window` from database `dbname`
+    """
+    databases = get_setting('ROLLUP_DATABASES', {}) or {}
+    retention = get_setting('ROLLUP_RETENTION', DEFAULT_RETENTION) or {}
+    template, duration = databases.get(window, ('{db}_{window}', retention.get(window, 'INF')))
+    return template.format(db=dbname, window=window), duration
+
+
+def add_points(dbname, points, now=None):
+    """
+    Add points to open windows.
+
+    :param str dbname: source database
+    :param points: iterable of (measurement, tags dict, fields dict, epoch microseconds)
+    :param float now: current epoch seconds, for tests
+    """
+    global late_points
+    rules = get_rules()
+    if not rules:
+        return
+    if now is None:
+        now = time.time()
+    grace = float(get_setting('ROLLUP_WATERMARK', 300))
+    watermark = now - grace
+    windows = {}  # key -> [counters, mins, maxs]
+    for measurement, tags, fields, ts_us in points:
+        for rule_fields, rule_windows in rules.get(measurement, ()):
+            values = []
+            for f in rule_fields:
+                v = fields.get(f)
+                if isinstance(v, (int, float)) and not isinstance(v, bool):
+                    values.append((f, v))
+            if not values:
+                continue
+            ts = ts_us // SECOND_US
+            series = json.dumps(sorted(tags.items()))
+            for name, length in rule_windows:
+                start = ts - ts % length
+                if start + length <= watermark:
+                    late_points += 1
+                    continue
+                key = (NAMESPACE, dbname, measurement, series, name, start)
+                w = windows.get(key)
+                if w is None:
+                    w = windows[key] = [defaultdict(float), {}, {}]
+                c, lo, hi = w
+                for f, v in values:
+                    c['sum:' + f] += v
+                    c['n:' + f] += 1
+                    if f not in lo or v < lo[f]:
+                        lo[f] = v
+                    if f not in hi or v > hi[f]:
+                        hi[f] = v
+    store = get_window_store()
+    for key, (c, lo, hi) in windows.items():
+        store.merge(key, key[5] + window_seconds(key[4]) + grace, c, lo, hi)
+
+
+def finished_windows(now=None):
+    """
+    Pop finished windows from the store.
+
+    :return: dict (database, retention) -> list of InfluxDB measurement dicts
+    """
+    if now is None:
+        now = time.time()
+    result = defaultdict(list)
+    for key, counters, mins, maxs in get_window_store().pop_due(NAMESPACE, now):
+        _, dbname, measurement, series, name, start = key
+        fields = {}
+        for f in mins:
+            n = counters.get('n:' + f, 0)
+            if not n:
+                continue
+            fields[f + '_mean'] = counters['sum:' + f] / n
+            fields[f + '_min'] = float(mins[f])  # keep field types stable in InfluxDB
+            fields[f + '_max'] = float(maxs[f])
+            fields[f + '_count'] = int(n)
+        if fields:
+            result[target_database(dbname, name)].append({
+                'measurement': measurement,
+                'tags': dict(json.loads(series)),
+                'time': int(start) * SECOND_US,
+                'fields': fields,
+            })
+    return result
+
+
+def observe(dbname, measurements):
+    """Add InfluxDB measurement dicts which match ROLLUP_RULES."""
+    rules = get_rules()
+    if not rules:
+        return
+    add_points(dbname, ((m['measurement'], m.get('tags', {}), m['fields'], time_to_us(m['time']))
+                        for m in measurements if m['measurement'] in rules and m.get('time') is not None))
+
+
+def observe_packed(dbname, packed):
+    """Add measurements packed with endpoints.lineprotocol.pack_measurements() which match ROLLUP_RULES."""
+    rules = get_rules()
+    if not rules:
+        return
+    points = []
+    for measurement, tags, keys, deltas, columns in packed['series']:
+        if measurement not in rules:
+            continue
+        ts = 0
+        for row, delta in enumerate(deltas):
+            ts += delta
+            points.append((measurement, tags, {k: columns[i][row] for i, k in enumerate(keys)}, ts))
+    add_points(dbname, points)
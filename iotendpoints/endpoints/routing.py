@@ -0,0 +1,112 @@
+"""
+Celery task routing: every sink type has its own queue, so a slow Orion
+broker never delays InfluxDB writes.
+
+TASK_QUEUES setting maps task names to queues (see settings.py), tasks not
+listed go to the 'celery' default queue. Run a worker per queue, so every
+queue has its own concurrency and prefetch limit, e.g.
+
+    celery -A iotendpoints worker -Q influxdb -c 4 --prefetch-multiplier 8
+    celery -A iotendpoints worker -Q orion -c 2 --prefetch-multiplier 1
+    celery -A iotendpoints worker -Q maintenance,celery -c 1
+
+TASK_QUEUE_SHARDS setting ({queue: number of shards}) splits a queue to
+'<queue>.0', '<queue>.1', ... by device id with jump consistent hash, so
+tasks of one device always go to the same shard and only 1/n of devices move
+when a shard is added. With one worker process per shard queue, writes of a
+device are handled in order and by the same node:
+
+    TASK_QUEUE_SHARDS = {'influxdb': 4}
+    celery -A iotendpoints worker -Q influxdb.0,influxdb.1 -c 2   # node 1
+    celery -A iotendpoints worker -Q influxdb.2,influxdb.3 -c 2   # node 2
+
+Queue depths are shown in /status/queues.
+"""
+import hashlib
+import logging
+
+from endpoints.utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE = 'celery'
+
+
+def jump_hash(key, buckets):
+    """Jump consistent hash (Lamping & Veach 2014) of int `key` to range(buckets)."""
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def shard_queue(queue, key, shards):
+    """Return shard queue name of device `key`."""
+    digest = hashlib.md5(str(key).encode('utf-8')).digest()
+    return '{}.{}'.format(queue, jump_hash(int.from_bytes(digest[:8], 'big'), shards))
+
+
+def task_device(name, args, kwargs):
+    """Return device id (or other locality key) of a sink task, None if it has none."""
+    if name in ('endpoints.tasks.save_packed_to_influxdb', 'endpoints.tasks.save_to_influxdb'):
+        dbname = args[0] if args else kwargs.get('dbname')
+        payload = args[1] if len(args) > 1 else kwargs.get('packed', kwargs.get('measurements'))
+        try:
+            if isinstance(payload, dict):
+                tags = payload['series'][0][1]
+            else:
+                tags = payload[0].get('tags', {})
+            return tags.get('dev-id') or dbname
+        except (IndexError, KeyError, TypeError, AttributeError):
+            return dbname
+    if name == 'endpoints.tasks.push_ngsi_orion':
+        data = args[0] if args else kwargs.get('data')
+        return data.get('id') if isinstance(data, dict) else None
+    return None
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    """Celery router, see CELERY_TASK_ROUTES setting."""
+    queue = (get_setting('TASK_QUEUES', {}) or {}).get(name)
+    if queue is None:
+        return None
+    shards = int((get_setting('TASK_QUEUE_SHARDS', {}) or {}).get(queue, 0))
+    if shards > 1:
+        key = task_device(name, args, kwargs)
+        if key is not None:
+            queue = shard_queue(queue, key, shards)
+        else:
+            queue = '{}.0'.format(queue)
+    return {'queue': queue}
+
+
+def queue_names():
+    """Return names of all queues which tasks are routed to."""
+    names = {DEFAULT_QUEUE}
+    shards = get_setting('TASK_QUEUE_SHARDS', {}) or {}
+    for queue in set((get_setting('TASK_QUEUES', {}) or {}).values()):
+        n = int(shards.get(queue, 0))
+        names.update(['{}.{}'.format(queue, i) for i in range(n)] if n > 1 else [queue])
+    return sorted(names)
+
+
+def queue_depths(app=None):
+    """
+    :return: dict queue name -> dict with number of waiting messages and consumers, or None if not declared yet
+    """
+    if app is None:
+        from iotendpoints.celery import app
+    depths = {}
+    with app.connection_for_read() as connection:
+        channel = connection.default_channel
+        for name in queue_names():
+            try:
+                ok = channel.queue_declare(queue=name, passive=True)
+                depths[name] = {'messages': ok.message_count, 'consumers': ok.consumer_count}
+            except Exception as err:  # not declared yet, channel must be reopened after an AMQP error
+                logger.debug('Queue {} is not available: {}'.format(name, err))
+                depths[name] = None
+                channel = connection.channel()
+    return depths
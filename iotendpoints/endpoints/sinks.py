@@ -0,0 +1,195 @@
+"""
+Sink writers used by the plugins.
+
+`queue_influxdb()` queues measurements for asynchronous write with Celery,
+`queue_packed_influxdb()` does the same for already packed measurements.
+`write_influxdb()` writes synchronously through a circuit breaker. When InfluxDB
+is unreachable or the breaker is open, measurements are diverted to the
+Celery queue (or to the dead-letter table, if the broker is down too)
+instead of blocking the request.
+
+Databases in INFLUXDB_UDP setting are written with UDP instead, see endpoints.udpsink.
+
+All of them publish the measurements to live stream subscribers (see
+endpoints.livestream), feed ingest-side rollups (see endpoints.acoustic and
+endpoints.rollups) and fan them out to secondary sinks (see endpoints.outputs).
+The last-value cache (see endpoints.lastvalue) is updated only after a write has succeeded.
+Finished rollup windows are queued at most once per ROLLUP_FLUSH_INTERVAL
+seconds (default 1) and by the periodic flush_rollups task.
+
+Settings:
+
+- INFLUXDB_SYNC_TIMEOUT: timeout in seconds for synchronous writes (default 3)
+"""
+import logging
+import threading
+import time
+
+import requests
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+
+from endpoints import acoustic, rollups
+from endpoints.circuitbreaker import CircuitOpenError, get_breaker
+from endpoints.deadletter import TRANSIENT, classify_error, store_failed_write
+from endpoints.fieldtypes import check_packed, quarantine
+from endpoints.influxwrite import write_packed
+from endpoints.lastvalue import update_packed
+from endpoints.lineprotocol import pack_measurements
+from endpoints.livestream import publish, publish_packed
+from endpoints.outputs import fan_out, fan_out_packed
+from endpoints.tasks import save_packed_to_influxdb
+from endpoints.udpsink import send_packed
+from endpoints.utils import get_influxdb_client, get_setting
+
+logger = logging.getLogger(__name__)
+
+_created_databases = set()
+_created_databases_lock = threading.Lock()
+_last_rollup_flush = 0.0
+
+
+def is_transient(err):
+    """Return True if `err` means the backend is unhealthy, not that it rejected the data."""
+    return (isinstance(err, (InfluxDBClientError, InfluxDBServerError, requests.exceptions.RequestException))
+            and classify_error(err) == TRANSIENT)
+
+
+def _write_influxdb(dbname, measurements):
+    timeout = float(get_setting('INFLUXDB_SYNC_TIMEOUT', 3))
+    iclient = get_influxdb_client(database=dbname, timeout=timeout, retries=1)
+    if dbname not in _created_databases:
+        iclient.create_database(dbname)
+        with _created_databases_lock:
+            _created_databases.add(dbname)
+    packed, quarantined = check_packed(iclient, dbname, pack_measurements(measurements))
+    if quarantined is not None:
+        quarantine(dbname, quarantined)
+    write_packed(iclient, dbname, packed)
+    update_packed(packed)
+
+
+def divert_influxdb(dbname, measurements):
+    """Queue measurements for asynchronous write, store them to dead-letter table if queueing fails."""
+    packed = pack_measurements(measurements)
+    try:
+        save_packed_to_influxdb.delay(dbname, packed)
+    except Exception as err:
+        logger.error('[SINK] Could not queue {} points to {}: {}'.format(len(measurements), dbname, err))
+        store_failed_write('influxdb', dbname, packed, err, point_count=len(measurements))
+
+
+def tee(dbname, measurements=None, packed=None):
+    """Fan measurements out to secondary sinks. Their errors never fail ingest."""
+    try:
+        if packed is not None:
+            fan_out_packed(dbname, packed)
+        else:
+            fan_out(dbname, measurements)
+    except Exception as err:
+        logger.error('[SINK] Fan-out failed: {}'.format(err))
+
+
+def _save_packed(dbname, packed, retention=None):
+    """Send packed measurements with UDP if the database is in INFLUXDB_UDP, otherwise queue them."""
+    if retention is None and send_packed(dbname, packed):
+        update_packed(packed)
+        return
+    save_packed_to_influxdb.delay(dbname, packed, retention)
+
+
+def _queue_influxdb(dbname, measurements, retention=None):
+    publish(dbname, measurements)
+    tee(dbname, measurements)
+    _save_packed(dbname, pack_measurements(measurements), retention)
+
+
+def flush_rollups(force=False):
+    """
+    Queue finished rollup windows for write.
+
+    :param bool force: flush even if ROLLUP_FLUSH_INTERVAL has not passed since the last flush
+    :return: number of queued rollup points
+    """
+    global _last_rollup_flush
+    now = time.time()
+    if not force and now - _last_rollup_flush < float(get_setting('ROLLUP_FLUSH_INTERVAL', 1)):
+        return 0
+    _last_rollup_flush = now
+    cnt = 0
+    for dbname, measurements in acoustic.finished_windows(now).items():
+        _queue_influxdb(dbname, measurements)
+        cnt += len(measurements)
+    for (dbname, retention), measurements in rollups.finished_windows(now).items():
+        _queue_influxdb(dbname, measurements, retention)
+        cnt += len(measurements)
+    return cnt
+
+
+def rollup(dbname, measurements=None, packed=None):
+    """Feed measurements to ingest-side rollups. Rollup errors never fail ingest."""
+    try:
+        if packed is not None:
+            acoustic.observe_packed(dbname, packed)
+            rollups.observe_packed(dbname, packed)
+        else:
+            acoustic.observe(dbname, measurements)
+            rollups.observe(dbname, measurements)
+        flush_rollups()
+    except Exception as err:
+        logger.error('[SINK] Rollup failed: {}'.format(err))
+
+
+def queue_influxdb(dbname, measurements):
+    """
+    Queue measurements for asynchronous write to InfluxDB database `dbname`.
+
+    :param str dbname: Database name
+    :param list measurements: InfluxDB measurement dicts
+    """
+    rollup(dbname, measurements)
+    _queue_influxdb(dbname, measurements)
+
+
+def queue_packed_influxdb(dbname, packed):
+    """
+    Queue measurements which are already packed for asynchronous write to InfluxDB database `dbname`.
+    Plugins which parse long series can build the packed structure directly without measurement dicts.
+
+    :param str dbname: Database name
+    :param dict packed: see endpoints.lineprotocol.pack_measurements()
+    """
+    rollup(dbname, packed=packed)
+    publish_packed(dbname, packed)
+    tee(dbname, packed=packed)
+    _save_packed(dbname, packed)
+
+
+def write_influxdb(dbname, measurements):
+    """
+    Write measurements to InfluxDB database `dbname` synchronously. If InfluxDB
+    is unhealthy, divert them to asynchronous write.
+
+    :param str dbname: Database name
+    :param list measurements: InfluxDB measurement dicts
+    :return: True if written synchronously, False if diverted
+    :raises InfluxDBClientError: if InfluxDB rejected the data
+    """
+    rollup(dbname, measurements)
+    publish(dbname, measurements)
+    tee(dbname, measurements)
+    packed = pack_measurements(measurements)
+    if send_packed(dbname, packed):
+        update_packed(packed)
+        return True
+    breaker = get_breaker('influxdb')
+    try:
+        breaker.call(_write_influxdb, dbname, measurements, is_failure=is_transient)
+        return True
+    except CircuitOpenError:
+        pass
+    except Exception as err:
+        if not is_transient(err):
+            raise
+        logger.warning('[SINK] InfluxDB write to {} failed: {}'.format(dbname, err))
+    divert_influxdb(dbname, measurements)
+    return False
@@ -1,35 +1,96 @@
 import requests
-import json
 from celery import shared_task
 from celery.utils.log import get_task_logger
-from influxdb.exceptions import InfluxDBClientError
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
 
+from endpoints.deadletter import store_failed_write, retry_due
+from endpoints.fieldtypes import check_packed, get_registry, quarantine
+from endpoints.influxwrite import write_packed
+from endpoints.lastvalue import update_packed
+from endpoints.lineprotocol import pack_measurements
+from endpoints.retention import purge_requests
 from endpoints.utils import get_influxdb_client
 
 logger = get_task_logger(__name__)
 
 
-@shared_task
+@shared_task(ignore_result=True)
 def save_to_influxdb(dbname, measurements):
     """
     Save valid `measurements` dictionary into InfluxDB database `dbname`.
-    Log errors.
+    Log errors and store failed writes to dead-letter table.
     :param dbname: Database name
     :param measurements: a valid InfluxDB dictionary.
     """
+    save_packed_to_influxdb(dbname, pack_measurements(measurements))
+
+
+_retention_policies = set()
+
+
+def ensure_retention_policy(iclient, dbname, duration):
+    """
+    Create retention policy 'rollup' with `duration` (e.g. '400d' or 'INF') as default policy of `dbname`.
+    """
+    if (dbname, duration) in _retention_policies:
+        return
+    try:
+        iclient.create_retention_policy('rollup', duration, 1, database=dbname, default=True)
+    except InfluxDBClientError as err:
+        if 'already exists' not in str(err):
+            raise
+        iclient.alter_retention_policy('rollup', database=dbname, duration=duration, default=True)
+    _retention_policies.add((dbname, duration))
+
+
+@shared_task(serializer='msgpack', ignore_result=True)
+def save_packed_to_influxdb(dbname, packed, retention=None):
+    """
+    Save measurements packed with `endpoints.lineprotocol.pack_measurements()`
+    into InfluxDB database `dbname`. Payload is decoded straight to line protocol.
+    Log errors and store failed writes to dead-letter table.
+    :param dbname: Database name
+    :param packed: columnar measurement payload
+    :param retention: optional duration of default retention policy of the database, e.g. '400d'
+    """
     iclient = get_influxdb_client(database=dbname)
     try:
         iclient.create_database(dbname)
-        iclient.write_points(measurements)
-        logger.info('Successfully saved InfluxDB object to database {}'.format(dbname))  # Goes to celery log
-    except InfluxDBClientError as err:
+        if retention:
+            ensure_retention_policy(iclient, dbname, retention)
+        packed, quarantined = check_packed(iclient, dbname, packed)
+        if quarantined is not None:
+            quarantine(dbname, quarantined)
+        cnt = write_packed(iclient, dbname, packed)
+        if not retention:  # rollups are not readings
+            update_packed(packed)
+        logger.info('Successfully saved {} points to database {}'.format(cnt, dbname))
+    except (InfluxDBClientError, InfluxDBServerError, requests.exceptions.RequestException) as err:
         err_msg = '[InfluxDB] {}'.format(err)
         logger.error(err_msg)
-        logger.error(json.dumps(measurements))
+        if 'field type conflict' in str(err):
+            get_registry().invalidate(dbname)
+        store_failed_write('influxdb', dbname, packed, err, point_count=sum(len(s[3]) for s in packed['series']))
 
 
-@shared_task
+@shared_task(ignore_result=True)
 def push_ngsi_orion(data, url_root, username, password):
+    """
+    Create or update NGSI entity `data` in Orion. Failed pushes are stored to dead-letter table.
+    """
+    if data is None:
+        return None
+    try:
+        resp = _push_ngsi_orion(data, url_root, username, password)
+        resp.raise_for_status()
+    except requests.exceptions.RequestException as err:
+        logger.error('[Orion] {}'.format(err))
+        store_failed_write('orion', url_root, {'data': data}, err, point_count=1)
+        return None
+    return resp
+
+
+def _push_ngsi_orion(data, url_root, username, password):
     # device_id = data['id']
     resp = None
     resp = requests.post('{}/entities/'.format(url_root), auth=(username, password), json=data)
@@ -47,3 +108,38 @@ def push_ngsi_orion(data, url_root, username, password):
     if not resp or (resp.status_code != 204):
         resp = requests.post('{}/entities/?options=keyValues'.format(url_root), auth=(username, password), json=data)
     return resp
+
+
+@shared_task(ignore_result=True)
+def retry_failed_writes():
+    """
+    Retry failed sink writes from dead-letter table whose backoff has expired.
+    Run periodically with celery beat.
+    """
+    written, failed = retry_due()
+    if written or failed:
+        logger.info('Retried failed writes: {} written, {} failed'.format(written, failed))
+
+
+@shared_task(ignore_result=True)
+def purge_expired_requests():
+    """
+    Delete dumped requests which are older than REQUEST_RETENTION_DAYS.
+    Run daily with celery beat.
+    """
+    result = purge_requests()
+    deleted = sum(result.values())
+    if deleted:
+        logger.info('Purged {} expired requests'.format(deleted))
+
+
+@shared_task(ignore_result=True)
+def flush_rollups():
+    """
+    Queue finished rollup windows of devices which have stopped sending.
+    Run periodically with celery beat. Windows come from ROLLUP_REDIS_URL, which the web workers share.
+    """
+    from endpoints.sinks import flush_rollups as flush  # sinks imports this module
+    cnt = flush(force=True)
+    if cnt:
+        logger.info('Flushed {} rollup points'.format(cnt))
@@ -1,3 +1,1595 @@
-from django.test import TestCase
+import base64
+import binascii
+import csv
+import datetime
+import gzip
+import io
+import json
+import math
+import os
+import queue
+import random
+import re
+import socket
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import msgpack
+from django.contrib.auth.models import AnonymousUser, User
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from influxdb.exceptions import InfluxDBClientError
+
+from endpoints import (acoustic, archive, bindings, bodies, deadletter, decoders, dedup, export, fieldtypes,
+                       influxwrite, lastvalue, outputs, queryproxy, ratelimit, retention, rollups, routing, sinks,
+                       udpsink, windows)
+from endpoints.circuitbreaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+from endpoints.lineprotocol import iter_packed, measurements_to_lines, pack_measurements, packed_to_lines, time_to_us
+from endpoints.livestream import DROPPED, Broker, RedisRelay, Subscriber
+from endpoints.models import Datalogger, FailedWrite, Plate, Request
+from endpoints.plugins.noisesensor import parse_noisesensor_v1
+from endpoints.utils import create_influxdb_obj
+from endpoints.views import dump_request
+
+
+def create_failed_write(target='testdb', status='PENDING', next_attempt_at=None):
+    packed = {'v': 1, 'series': [['m', {'dev-id': 'dev1'}, ['x'], [1514885219000000], [[1.0]]]]}
+    return FailedWrite.objects.create(sink='influxdb', target=target, status=status,
+                                      payload=msgpack.packb(packed, use_bin_type=True), point_count=1,
+                                      next_attempt_at=next_attempt_at or timezone.now())
+
+
+class DeadLetterClaimTest(TestCase):
+
+    def test_claimed_rows_are_not_claimed_again(self):
+        for _ in range(3):
+            create_failed_write()
+        pending = FailedWrite.objects.filter(status='PENDING')
+        first = deadletter.claim(pending, 2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(FailedWrite.objects.filter(status='RETRYING').count(), 2)
+        second = deadletter.claim(FailedWrite.objects.filter(status='PENDING'))
+        self.assertEqual([row.id for row in second], [row.id for row in FailedWrite.objects.exclude(
+            id__in=[r.id for r in first])])
+
+    def test_retry_due_skips_live_claims_and_takes_over_expired_ones(self):
+        now = timezone.now()
+        create_failed_write(status='RETRYING', next_attempt_at=now + datetime.timedelta(minutes=5))
+        expired = create_failed_write(status='RETRYING', next_attempt_at=now - datetime.timedelta(minutes=5))
+        written = []
+        original = deadletter._write_group
+        deadletter._write_group = lambda sink, target, rows: written.extend(rows)
+        try:
+            self.assertEqual(deadletter.retry_due(), (1, 0))
+        finally:
+            deadletter._write_group = original
+        self.assertEqual([row.id for row in written], [expired.id])
+        self.assertEqual(FailedWrite.objects.count(), 1)
+
+    def test_admin_retry_now_skips_claimed_rows(self):
+        from endpoints.admin import retry_now
+        later = timezone.now() + datetime.timedelta(minutes=5)
+        held = create_failed_write(status='HELD', next_attempt_at=later)
+        claimed = create_failed_write(status='RETRYING', next_attempt_at=later)
+        modeladmin = mock.Mock()
+        retry_now(modeladmin, None, FailedWrite.objects.all())
+        held.refresh_from_db()
+        claimed.refresh_from_db()
+        self.assertEqual(held.status, 'PENDING')
+        self.assertLess(held.next_attempt_at, later)
+        self.assertEqual((claimed.status, claimed.next_attempt_at), ('RETRYING', later))
+        self.assertEqual(modeladmin.message_user.call_count, 1)
+
+    @override_settings(DEADLETTER_MAX_ATTEMPTS=5)
+    def test_failed_retry_releases_claim(self):
+        create_failed_write()
+        original = deadletter._write_group
+
+        def fail(sink, target, rows):
+            raise ConnectionError('InfluxDB is down')
+
+        deadletter._write_group = fail
+        try:
+            self.assertEqual(deadletter.retry_due(due_only=False), (0, 1))
+        finally:
+            deadletter._write_group = original
+        row = FailedWrite.objects.get()
+        self.assertEqual((row.status, row.attempts), ('PENDING', 2))
+
+
+class LineProtocolTest(SimpleTestCase):
+
+    def measurements(self):
+        start = datetime.datetime(2018, 1, 2, 9, 26, 59, 123456, tzinfo=datetime.timezone.utc)
+        data = []
+        for i in range(5):
+            ts = start + datetime.timedelta(seconds=i if i != 3 else -10)  # one out of order
+            data.append(create_influxdb_obj('dev 1', 'LAeq1s', {'dBA': 40.0 + i, 'cnt': i}, ts))
+            data.append({'measurement': 'm,1', 'tags': {'dev-id': 'dev=2,x', 'empty': ''}, 'time': ts,
+                         'fields': {'status': 'o"k\\', 'on': i % 2 == 0, 'cnt': i}})
+        data.append({'measurement': 'LAeq1s', 'tags': {'dev-id': 'dev1'}, 'time': start, 'fields': {'dBA': None}})
+        data.append({'measurement': 'LAeq1s', 'tags': {'dev-id': 'dev1'}, 'time': start,
+                     'fields': {'dBA': 1.5, 'cnt': None}})
+        return data
+
+    def test_round_trip(self):
+        data = self.measurements()
+        packed = msgpack.unpackb(msgpack.packb(pack_measurements(data), use_bin_type=True), raw=False)
+        expected = [(m['measurement'], m['tags'], {k: v for k, v in m['fields'].items() if v is not None},
+                     time_to_us(m['time'])) for m in data if any(v is not None for v in m['fields'].values())]
+        key = lambda row: (row[0], row[3], sorted(row[2]))  # noqa: E731
+        self.assertEqual(sorted(iter_packed(packed), key=key), sorted(expected, key=key))
+        # Packed fields are in sorted key order, line protocol doesn't care
+        data = [dict(m, fields=dict(sorted(m['fields'].items()))) for m in data]
+        self.assertEqual(sorted(packed_to_lines(packed)), sorted(measurements_to_lines(data)))
+        self.assertEqual(len(packed['series']), 3)
+
+    def test_escaping_and_precision(self):
+        packed = pack_measurements([{'measurement': 'm,1 a', 'tags': {'dev-id': 'dev=2,x'}, 'time': 1514851200000000,
+                                     'fields': {'f k': 'o"k', 'i': 3, 'b': True}}])
+        self.assertEqual(packed_to_lines(packed, precision_us=1000000),
+                         ['m\\,1\\ a,dev-id=dev\\=2\\,x b=true,f\\ k="o\\"k",i=3i 1514851200'])
+
+    def test_unsupported_version(self):
+        with self.assertRaises(ValueError):
+            packed_to_lines({'v': 2, 'series': []})
+        with self.assertRaises(ValueError):
+            list(iter_packed({'series': []}))
+
+
+def basic_auth(username, password):
+    return 'Basic ' + base64.b64encode('{}:{}'.format(username, password).encode('utf-8')).decode('ascii')
+
+
+class CircuitBreakerTest(SimpleTestCase):
+
+    def fail(self):
+        raise ConnectionError('down')
+
+    def test_opens_after_threshold_and_rejects(self):
+        breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=30)
+        for _ in range(3):
+            self.assertEqual(breaker.state, CLOSED)
+            with self.assertRaises(ConnectionError):
+                breaker.call(self.fail)
+        self.assertEqual(breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.call(lambda: 'ok')
+        self.assertEqual(breaker.as_dict()['rejected'], 1)
+        self.assertEqual(breaker.as_dict()['trips'], 1)
+
+    def test_half_open_trial_closes_or_reopens(self):
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=30, half_open_calls=1)
+        with mock.patch('endpoints.circuitbreaker.time.monotonic', return_value=1000.0):
+            with self.assertRaises(ConnectionError):
+                breaker.call(self.fail)
+        with mock.patch('endpoints.circuitbreaker.time.monotonic', return_value=1031.0):
+            self.assertTrue(breaker.allow_request())
+            self.assertEqual(breaker.state, HALF_OPEN)
+            self.assertFalse(breaker.allow_request())  # only one trial call
+            breaker.record_failure()
+            self.assertEqual(breaker.state, OPEN)
+            self.assertEqual(breaker.trips, 2)
+        with mock.patch('endpoints.circuitbreaker.time.monotonic', return_value=1062.0):
+            self.assertEqual(breaker.call(lambda: 'ok'), 'ok')
+            self.assertEqual(breaker.state, CLOSED)
+
+    def test_rejected_data_is_not_a_failure(self):
+        breaker = CircuitBreaker('test', failure_threshold=1)
+        with self.assertRaises(ValueError):
+            breaker.call(int, 'x', is_failure=lambda err: not isinstance(err, ValueError))
+        self.assertEqual(breaker.state, CLOSED)
+
+
+class StatusAuthTest(TestCase):
+
+    status_urls = ['/status/circuitbreakers', '/latest?devid=dev1', '/status/livestream', '/status/dedup',
+                   '/status/queryproxy', '/status/ratelimit', '/status/fieldtypes', '/status/sinks',
+                   '/status/influxdb']
+
+    def setUp(self):
+        User.objects.create_user('staff', password='staffpass', is_staff=True)
+        User.objects.create_user('user', password='userpass')
+
+    def test_status_requires_staff(self):
+        for url in self.status_urls:
+            self.assertEqual(self.client.get(url).status_code, 401, url)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION=basic_auth('user', 'userpass')).status_code,
+                             401, url)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION=basic_auth('staff', 'wrong')).status_code,
+                             401, url)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Basic !!!').status_code, 401, url)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION=basic_auth('staff', 'staffpass')).status_code,
+                             200, url)
+
+    def test_queues_requires_staff(self):
+        with mock.patch('endpoints.views.queue_depths', return_value={'celery': None}) as depths:
+            self.assertEqual(self.client.get('/status/queues').status_code, 401)
+            response = self.client.get('/status/queues', HTTP_AUTHORIZATION=basic_auth('user', 'userpass'))
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(depths.call_count, 0)
+            response = self.client.get('/status/queues', HTTP_AUTHORIZATION=basic_auth('staff', 'staffpass'))
+            self.assertEqual(json.loads(response.content.decode()), {'queues': {'celery': None}})
+
+    def test_stream_requires_staff(self):
+        self.assertEqual(self.client.get('/stream').status_code, 401)
+        self.assertEqual(self.client.get('/stream', HTTP_AUTHORIZATION=basic_auth('user', 'userpass')).status_code,
+                         401)
+
+
+class FakeResult:
+
+    def __init__(self, raw):
+        self.raw = raw
+
+
+class FakeExportClient:
+    """InfluxDB client which returns `points` (time us, measurement, dev-id, temperature) in 2 result chunks."""
+
+    columns = ['time', 'dev-id', 'n', 'temperature']
+
+    def __init__(self, points):
+        self.points = points
+        self.queries = []
+
+    def query(self, query, epoch=None, chunked=False, chunk_size=None):
+        self.queries.append(query)
+        if query.startswith('SHOW TAG KEYS'):
+            return FakeResult({'series': [{'values': [['site'], ['dev-id']]}]})
+        if query.startswith('SHOW FIELD KEYS'):
+            return FakeResult({'series': [{'values': [['temperature', 'float'], ['n', 'integer']]}]})
+        self.assert_chunked = (epoch, chunked, chunk_size)
+        measurement = re.search(r'FROM "(.+?)"', query).group(1)
+        start, end = map(int, re.search(r'time >= (\d+)u AND time < (\d+)u', query).groups())
+        values = [[ts, devid, 1, temp] for ts, m, devid, temp in self.points if m == measurement and start <= ts < end]
+        half = len(values) // 2
+        return [FakeResult({'series': [{'name': measurement, 'columns': self.columns, 'values': part}]})
+                for part in [values[:half], values[half:]] if part]
+
+
+class ExportTest(TestCase):
+
+    start_us = 1514764800 * 1000000  # 2018-01-01T00:00:00Z
+    hour_us = 3600 * 1000000
+
+    def setUp(self):
+        User.objects.create_user('staff', password='staff:pass', is_staff=True)
+        User.objects.create_user('user', password='userpass')
+        self.iclient = FakeExportClient([
+            (self.start_us, 'ruuvitag', 'dev1', 21.5),
+            (self.start_us + self.hour_us, 'ruuvitag', 'dev2', 22.0),
+            (self.start_us + 30 * self.hour_us, 'ruuvitag', 'dev1', 23.0),
+            (self.start_us + 40 * self.hour_us, 'ruuvitag', 'dev1', 24.0),  # after end
+        ])
+        patcher = mock.patch('endpoints.export.get_influxdb_client', return_value=self.iclient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, params, auth=('staff', 'staff:pass'), **extra):
+        query = {'db': 'ruuvistation', 'measurement': 'ruuvitag', 'start': '2018-01-01', 'end': '2018-01-02T12:00:00Z'}
+        query.update(params)
+        if auth is not None:
+            extra['HTTP_AUTHORIZATION'] = basic_auth(*auth)
+        return self.client.get('/export', {k: v for k, v in query.items() if v is not None}, **extra)
+
+    def content(self, response):
+        content = b''.join(response.streaming_content)
+        if response.get('Content-Encoding') == 'gzip':
+            content = gzip.decompress(content)
+        return content.decode('utf-8')
+
+    def test_requires_staff(self):
+        self.assertEqual(self.get({}, auth=None).status_code, 401)
+        self.assertEqual(self.get({}, auth=('user', 'userpass')).status_code, 401)
+        self.assertEqual(self.get({}, auth=('staff', 'wrong')).status_code, 401)
+        for header in ['Basic !!!', 'Basic ' + base64.b64encode(b'staff').decode()]:  # malformed
+            response = self.get({}, auth=None, HTTP_AUTHORIZATION=header)
+            self.assertEqual(response.status_code, 401)
+            self.assertIn('WWW-Authenticate', response)
+        self.assertEqual(self.iclient.queries, [])
+        self.assertEqual(self.get({}).status_code, 200)  # password with a colon
+
+    def test_invalid_parameters(self):
+        for params in [{'db': None}, {'start': None}, {'end': None}, {'measurement': None},
+                       {'format': 'xlsx'}, {'start': 'yesterday-ish'}, {'end': '2017-01-01'}]:
+            response = self.get(params)
+            self.assertEqual(response.status_code, 400, params)
+        self.assertEqual(self.get({'db': None}).content, b"'db' is missing")
+
+    @override_settings(EXPORT_CHUNK_HOURS=12)
+    def test_csv(self):
+        response = self.get({'devid': 'dev1,dev2'}, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="ruuvistation-20180101-20180102.csv"')
+        rows = list(csv.reader(io.StringIO(self.content(response))))
+        self.assertEqual(rows, [
+            ['time', 'measurement', 'dev-id', 'site', 'n', 'temperature'],
+            ['2018-01-01T00:00:00Z', 'ruuvitag', 'dev1', '', '1', '21.5'],
+            ['2018-01-01T01:00:00Z', 'ruuvitag', 'dev2', '', '1', '22.0'],
+            ['2018-01-02T06:00:00Z', 'ruuvitag', 'dev1', '', '1', '23.0'],
+        ])
+        self.assertEqual(len([q for q in self.iclient.queries if q.startswith('SELECT')]), 3)
+        self.assertEqual(self.iclient.assert_chunked, ('u', True, 10000))
+
+    def test_ndjson(self):
+        for encoding in ['', 'gzip']:
+            response = self.get({'format': 'ndjson'}, HTTP_ACCEPT_ENCODING=encoding)
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            self.assertEqual(response.get('Content-Encoding'), encoding or None)
+            lines = [json.loads(line) for line in self.content(response).splitlines()]
+            self.assertEqual(lines[0], {'time': '2018-01-01T00:00:00Z', 'measurement': 'ruuvitag', 'dev-id': 'dev1',
+                                        'n': 1, 'temperature': 21.5})
+            self.assertEqual(len(lines), 3)
+
+    def test_queries(self):
+        exporter = export.Export('db', ['m1', 'm"2'], ["dev'1", 'dev2'], self.start_us,
+                                 self.start_us + 5 * self.hour_us // 2, chunk_hours=1)
+        queries = list(exporter.queries())
+        self.assertEqual([m for m, q in queries], ['m1', 'm"2'] * 3)
+        bounds = [tuple(int(t) for t in re.findall(r'time [<>]=? (\d+)u', q)) for m, q in queries[::2]]
+        self.assertEqual(bounds, [(self.start_us, self.start_us + self.hour_us),
+                                  (self.start_us + self.hour_us, self.start_us + 2 * self.hour_us),
+                                  (self.start_us + 2 * self.hour_us, self.start_us + 5 * self.hour_us // 2)])
+        self.assertEqual(queries[1][1], 'SELECT * FROM "m\\"2" WHERE time >= {}u AND time < {}u '
+                                        'AND ("dev-id" = \'dev\\\'1\' OR "dev-id" = \'dev2\') ORDER BY time'.format(
+                                            self.start_us, self.start_us + self.hour_us))
+        exporter = export.Export('db', ['m1'], [], '2018-01-01T00:00:00Z', '2018-01-01T00:00:01Z')
+        self.assertEqual(list(exporter.queries()), [
+            ('m1', 'SELECT * FROM "m1" WHERE time >= {}u AND time < {}u ORDER BY time'.format(
+                self.start_us, self.start_us + 1000000))])
+        with self.assertRaises(export.ExportError):
+            export.Export('db', ['m1'], [], self.start_us, self.start_us)
+
+
+class InfluxWriteTest(SimpleTestCase):
+
+    hour_us = 3600 * 1000000
+
+    def setUp(self):
+        patcher = mock.patch('endpoints.influxwrite.stats', Counter())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.iclient = mock.Mock()
+
+    def test_coarsest_precision(self):
+        base = 1527000000 // 3600 * self.hour_us
+        for timestamps, precision in [([base, base + self.hour_us], ('h', self.hour_us)),
+                                      ([base, base + 60 * 1000000], ('m', 60000000)),
+                                      ([base, base + 1000000, base + 7 * 1000000], ('s', 1000000)),
+                                      ([base + 1000, base + 1000000], ('ms', 1000)),
+                                      ([base, base + 1000000, base + 1500, base + 1], ('u', 1)),
+                                      ([base, base + 1000, base + 1000000], ('ms', 1000)),  # mixed
+                                      ([base + 1], ('u', 1)),
+                                      ([], ('h', self.hour_us))]:
+            self.assertEqual(influxwrite.coarsest_precision(iter(timestamps)), precision, timestamps)
+
+    def write(self, lines, precision='s'):
+        influxwrite.write_lines(self.iclient, 'db', lines, precision)
+        kwargs = self.iclient.request.call_args[1]
+        self.assertEqual((kwargs['url'], kwargs['method'], kwargs['expected_response_code']), ('write', 'POST', 204))
+        self.assertEqual(kwargs['params'], {'db': 'db', 'precision': precision})
+        return kwargs
+
+    @override_settings(INFLUXDB_GZIP_MIN_BYTES=100)
+    def test_gzip(self):
+        lines = ['m,dev-id=a v={} {}'.format(i, 1527000000 + i) for i in range(10)]
+        body = ('\n'.join(lines) + '\n').encode()
+        kwargs = self.write(lines)
+        self.assertEqual(kwargs['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(kwargs['data']), body)
+        stats = influxwrite.get_stats()
+        self.assertEqual((stats['writes'], stats['points'], stats['gzipped'], stats['precision_s']), (1, 10, 1, 1))
+        self.assertEqual((stats['lines_bytes'], stats['wire_bytes']), (len(body), len(kwargs['data'])))
+        self.assertLess(stats['wire_bytes'], stats['lines_bytes'])
+        self.assertEqual(stats['compression_ratio'], round(len(kwargs['data']) / len(body), 3))
+
+    @override_settings(INFLUXDB_GZIP_MIN_BYTES=100)
+    def test_short_body_is_not_gzipped(self):
+        kwargs = self.write(['m v=1 1527000000000'], 'ms')
+        self.assertNotIn('Content-Encoding', kwargs['headers'])
+        self.assertEqual(kwargs['data'], b'm v=1 1527000000000\n')
+        stats = influxwrite.get_stats()
+        self.assertEqual((stats['gzipped'], stats['precision_ms'], stats['lines_bytes'], stats['wire_bytes']),
+                         (0, 1, 20, 20))
+
+    @override_settings(INFLUXDB_GZIP=False, INFLUXDB_GZIP_MIN_BYTES=0)
+    def test_gzip_disabled(self):
+        self.assertNotIn('Content-Encoding', self.write(['m v=1 1527000000'])['headers'])
+
+    def test_failed_write_is_not_counted(self):
+        self.iclient.request.side_effect = InfluxDBClientError('partial write', 400)
+        with self.assertRaises(InfluxDBClientError):
+            influxwrite.write_lines(self.iclient, 'db', ['m v=1 1'], 'u')
+        influxwrite.write_lines(self.iclient, 'db', [], 'u')
+        self.assertEqual(influxwrite.get_stats(), {})
+
+    def test_write_packed(self):
+        packed = pack_measurements([{'measurement': 'm', 'tags': {'dev-id': 'a'}, 'fields': {'v': i},
+                                     'time': (1527000000 + i) * 1000000} for i in range(3)])
+        self.assertEqual(influxwrite.write_packed(self.iclient, 'db', packed), 3)
+        kwargs = self.iclient.request.call_args[1]
+        self.assertEqual(kwargs['params']['precision'], 's')
+        self.assertEqual(kwargs['data'], b'm,dev-id=a v=0i 1527000000\nm,dev-id=a v=1i 1527000001\n'
+                                         b'm,dev-id=a v=2i 1527000002\n')
+
+
+class UDPSinkTest(SimpleTestCase):
+
+    ts_us = 1527000000 * 1000000 + 250000
+
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.settimeout(5)
+        self.addCleanup(self.listener.close)
+        self.port = self.listener.getsockname()[1]
+        for name, value in [('_writers', {}), ('stats', Counter())]:
+            patcher = mock.patch('endpoints.udpsink.' + name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def packed(self, count, ts_us=None):
+        ts_us = self.ts_us if ts_us is None else ts_us
+        return pack_measurements([{'measurement': 'noise', 'tags': {'dev-id': 'n{}'.format(i)},
+                                   'fields': {'dBA': 40.0 + i}, 'time': ts_us} for i in range(count)])
+
+    def send(self, packed, precision=None):
+        conf = {'host': '127.0.0.1', 'port': self.port}
+        if precision:
+            conf['precision'] = precision
+        with override_settings(INFLUXDB_UDP={'noisesensor': conf}):
+            self.assertTrue(udpsink.send_packed('noisesensor', packed))
+
+    def receive(self, count):
+        return [self.listener.recv(65536) for _ in range(count)]
+
+    def test_not_configured(self):
+        with override_settings(INFLUXDB_UDP={}):
+            self.assertFalse(udpsink.send_packed('noisesensor', self.packed(1)))
+        self.assertEqual(udpsink.get_stats(), {})
+
+    @override_settings(INFLUXDB_UDP_PAYLOAD=200)
+    def test_payload(self):
+        self.send(self.packed(20))
+        stats = udpsink.get_stats()
+        datagrams = self.receive(stats['datagrams'])
+        self.assertGreater(len(datagrams), 1)
+        self.assertTrue(all(len(d) <= 200 for d in datagrams))
+        lines = [line for d in datagrams for line in d.decode().split('\n')]
+        self.assertEqual(sorted(lines), sorted(line + '000' for line in packed_to_lines(self.packed(20))))
+        self.assertEqual((stats['points'], stats['bytes'], stats['dropped']),
+                         (20, sum(len(d) for d in datagrams), 0))
+        # a line longer than the payload is sent alone
+        long_line = 'noise,dev-id=n1 text="{}" 1'.format('x' * 300)
+        self.assertEqual([len(d) for d, n in udpsink.pack_datagrams(['a 1', long_line, 'b 1'], 200)],
+                         [3, len(long_line), 3])
+
+    def test_precision(self):
+        for precision, ts in [(None, self.ts_us * 1000), ('u', self.ts_us), ('ms', self.ts_us // 1000),
+                              ('s', self.ts_us // 1000000)]:
+            udpsink._writers.clear()
+            self.send(self.packed(1), precision)
+            self.assertEqual(self.receive(1), ['noise,dev-id=n0 dBA=40.0 {}'.format(ts).encode()])
+        with self.assertRaises(ValueError):
+            udpsink.UDPWriter('127.0.0.1', self.port, precision='h')
+
+    def test_full_socket_buffer(self):
+        self.send(self.packed(1))  # creates the writer
+        self.receive(1)
+        writer = udpsink._writers['noisesensor']
+        with mock.patch.object(writer, 'sock') as sock:
+            sock.sendto.side_effect = [None, BlockingIOError(), OSError('unreachable')]
+            writer.payload = 100
+            self.assertEqual(writer.send_packed(self.packed(6)), 1)
+        stats = udpsink.get_stats()
+        self.assertEqual((stats['datagrams'], stats['dropped'], stats['errors']), (2, 1, 1))
+        self.assertEqual(stats['points'], 1 + 2)  # lines of the dropped datagrams are not counted
+
+
+class LastValueTest(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('endpoints.lastvalue._store', lastvalue.MemoryLastValueStore())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def measurement(self, value, second):
+        return create_influxdb_obj('dev1', 'ruuvitag', {'temperature': value},
+                                   timestamp=datetime.datetime(2018, 1, 2, 10, 0, second, tzinfo=datetime.timezone.utc))
+
+    def test_only_written_values_are_cached(self):
+        self.measurement(20.0, 0)
+        self.assertEqual(lastvalue.get_last_values(['dev1']), {})
+
+    def test_newest_reading_wins(self):
+        lastvalue.update_packed(pack_measurements([self.measurement(21.0, 30), self.measurement(20.0, 10)]))
+        lastvalue.update_packed(pack_measurements([self.measurement(19.0, 20)]))  # late reading
+        value = lastvalue.get_last_values(['dev1'])['dev1']['ruuvitag']
+        self.assertEqual(value, {'time': '2018-01-02T10:00:30.000000Z', 'fields': {'temperature': 21.0}, 'tags': {}})
+
+    def test_latest_view(self):
+        User.objects.create_user('staff', password='staffpass', is_staff=True)
+        lastvalue.update_packed(pack_measurements([self.measurement(21.0, 30)]))
+        auth = basic_auth('staff', 'staffpass')
+        response = self.client.get('/latest?devid=dev1,dev2', HTTP_AUTHORIZATION=auth)
+        self.assertEqual(list(response.json()), ['dev1'])
+        response = self.client.get('/latest?devid=dev1', HTTP_AUTHORIZATION=auth, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class LiveStreamTest(SimpleTestCase):
+
+    def measurements(self, devid, n):
+        return [{'measurement': 'm', 'tags': {'dev-id': devid}, 'fields': {'x': i}, 'time': i} for i in range(n)]
+
+    def test_counters_under_concurrent_publish(self):
+        broker = Broker()
+        subscriber = Subscriber(devids={'dev1'}, buffer_size=100000)
+        broker.subscribe(subscriber, 10)
+        threads = [threading.Thread(target=broker.publish, args=('db', self.measurements(devid, 1000)))
+                   for devid in ['dev1', 'dev2'] * 4]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats = broker.stats()
+        self.assertEqual((stats['published'], stats['delivered']), (8000, 4000))
+        self.assertEqual(subscriber.queue.qsize(), 4000)
+
+    def test_slow_subscriber_is_dropped_once(self):
+        broker = Broker()
+        subscriber = Subscriber(buffer_size=5)
+        broker.subscribe(subscriber, 10)
+        broker.publish('db', self.measurements('dev1', 10))
+        broker.publish('db', self.measurements('dev1', 10))
+        self.assertEqual(broker.stats(), {'subscribers': 0, 'published': 10, 'delivered': 5,
+                                          'dropped_subscribers': 1})
+        events = [subscriber.queue.get_nowait() for _ in range(subscriber.queue.qsize())]
+        self.assertIs(events[-1], DROPPED)
+
+
+class FakePubSub:
+
+    def __init__(self, server):
+        self.server = server
+        self.queue = queue.Queue()
+
+    def subscribe(self, channel):
+        with self.server.lock:
+            self.server.queues.append(self.queue)
+
+    def get_message(self, timeout=None):
+        try:
+            return {'type': 'message', 'data': self.queue.get(timeout=timeout)}
+        except queue.Empty:
+            return None
+
+    def close(self):
+        with self.server.lock:
+            self.server.queues.remove(self.queue)
+
+
+class FakeRedis:
+    """Redis pub/sub stand-in shared by relays of simulated worker processes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = []
+        self.published = 0
+
+    def pubsub_numsub(self, channel):
+        return [(channel.encode(), len(self.queues))]
+
+    def publish(self, channel, data):
+        self.published += 1
+        for q in list(self.queues):
+            q.put(data.encode())
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+
+class LiveStreamRelayTest(SimpleTestCase):
+
+    def test_points_reach_subscribers_of_other_processes(self):
+        server = FakeRedis()
+        publisher = RedisRelay(client=server)  # worker which handles the request
+        relay, broker = RedisRelay(client=server), Broker()  # worker which has the subscriber
+        publisher.send('db', [{'measurement': 'm', 'tags': {'dev-id': 'dev1'}, 'fields': {'x': 1}, 'time': 1}])
+        self.assertEqual(server.published, 0)  # nobody listens
+        subscriber = Subscriber(devids={'dev1'})
+        broker.subscribe(subscriber, 10)
+        relay.start(broker)
+        for _ in range(100):
+            if server.queues:
+                break
+            time.sleep(0.01)
+        publisher.listeners_checked = None
+        publisher.send('db', [{'measurement': 'm', 'tags': {'dev-id': 'dev1'}, 'fields': {'x': 2}, 'time': 2},
+                              {'measurement': 'm', 'tags': {'dev-id': 'dev2'}, 'fields': {'x': 3}, 'time': 3}])
+        event = subscriber.queue.get(timeout=5)
+        self.assertEqual(json.loads(event[len('data: '):]),
+                         {'measurement': 'm', 'tags': {'dev-id': 'dev1'}, 'fields': {'x': 2}, 'time': 2, 'db': 'db'})
+        self.assertTrue(subscriber.queue.empty())
+        # The listener stops when the process has no subscribers left
+        thread = relay.thread
+        broker.unsubscribe(subscriber)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(relay.thread)
+        self.assertEqual(server.queues, [])
+
+
+class BlockingSink(outputs.Sink):
+
+    def __init__(self, name, **kwargs):
+        super().__init__(name, **kwargs)
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.batches = []
+
+    def write(self, points):
+        self.entered.set()
+        if not self.release.wait(10):
+            raise RuntimeError('not released')
+        self.batches.append(points)
+
+
+class OutputSinkTest(SimpleTestCase):
+
+    measurements = [{'measurement': 'm', 'tags': {'dev-id': 'a'}, 'fields': {'x': i},
+                     'time': (1500000000 + i) * 1000000}
+                    for i in range(3)]
+
+    def sinks(self, *sinks):
+        patcher = mock.patch('endpoints.outputs._sinks', list(sinks))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for sink in sinks:
+            self.addCleanup(sink.stop, 1)
+            self.addCleanup(sink.release.set)
+
+    def test_blocking_sink_does_not_block_fan_out(self):
+        slow = BlockingSink('slow', batch_size=1, queue_size=1000)
+        fast = BlockingSink('fast', batch_size=3 * 100)
+        fast.release.set()
+        self.sinks(slow, fast)
+        started = time.monotonic()
+        for _ in range(100):
+            outputs.fan_out('db', self.measurements)
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertTrue(slow.entered.wait(5))
+        fast.stop(5)
+        self.assertEqual(fast.stats()['written'], 300)
+        self.assertEqual(fast.batches[0][0], ('db', 'm', {'dev-id': 'a'}, {'x': 0}, 1500000000000000))
+        self.assertEqual(slow.stats()['written'], 0)
+        slow.release.set()
+        slow.stop(5)
+        self.assertEqual(slow.stats()['written'], 300)
+
+    def test_full_queue_drops_points(self):
+        sink = BlockingSink('slow', batch_size=1, queue_size=1)
+        self.sinks(sink)
+        packed = pack_measurements(self.measurements)
+        outputs.fan_out_packed('db', packed)
+        self.assertTrue(sink.entered.wait(5))  # the 1st batch is being written
+        outputs.fan_out_packed('db', packed)  # queued
+        outputs.fan_out_packed('db', packed)  # dropped
+        outputs.fan_out('db', self.measurements)  # dropped
+        self.assertEqual(sink.stats()['dropped'], 6)
+        sink.release.set()
+        sink.stop(5)
+        self.assertEqual(sink.stats()['written'], 6)
+        self.assertEqual(outputs.sink_states()['slow']['dropped'], 6)
+
+    def test_write_errors_are_counted(self):
+        sink = BlockingSink('broken', batch_size=1)
+        self.sinks(sink)
+        with mock.patch.object(sink, 'write', side_effect=OSError('disk full')):
+            outputs.fan_out('db', self.measurements)
+            sink.stop(5)
+        stats = sink.stats()
+        self.assertEqual((stats['written'], stats['errors'], stats['last_error']), (0, 1, 'OSError: disk full'))
+
+
+@skipUnless(archive.pa, 'pyarrow is not installed')
+class ArchiveTest(SimpleTestCase):
+
+    day_us = 1527000000 * 1000000  # 2018-05-22T14:40:00Z
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = tmpdir.name
+
+    def sink(self, **kwargs):
+        kwargs.setdefault('batch_rows', 2)
+        return archive.ArchiveSink('archive', self.path, **kwargs)
+
+    def points(self, devid, values, start_us=None, measurement='aqburk'):
+        start_us = self.day_us if start_us is None else start_us
+        return [('db', measurement, {'dev-id': devid, 'site': 's1'}, {'v': v}, start_us + i * 1000000)
+                for i, v in enumerate(values)]
+
+    def rows(self, devids=None, start=None, end=None):
+        batches = list(archive.scan(self.path, 'db', 'aqburk', devids=devids, start=start, end=end))
+        return [(r['devid'], r['v']) for b in batches for r in b.to_pylist()]
+
+    def test_mixed_field_types(self):
+        partition = archive.Partition(batch_rows=2)
+        for i, v in enumerate([1, 2, 1.5, None, 3]):
+            partition.add('a', self.day_us + i, {}, {'v': v})
+        table = partition.to_table()
+        self.assertEqual(table.schema.field('v').type, archive.pa.float64())
+        self.assertEqual(table.column('v').to_pylist(), [1.0, 2.0, 1.5, None, 3.0])
+        partition.add('a', self.day_us + 10, {}, {'v': 'high'})
+        self.assertEqual(partition.to_table().column('v').to_pylist(), ['1', '2', '1.5', None, '3', 'high'])
+
+    def test_flush_on_size(self):
+        sink = self.sink(rows_per_file=3)
+        sink.write(self.points('a', [1, 2, 3.5, 4, 5]))
+        stats = sink.stats()
+        self.assertEqual((stats['files'], stats['open_partitions'], stats['buffered_rows']), (1, 1, 2))
+        self.assertEqual(self.rows(), [('a', 1.0), ('a', 2.0), ('a', 3.5)])
+        sink.close()
+        self.assertEqual(sink.stats()['files'], 2)
+        self.assertEqual(self.rows(), [('a', 1.0), ('a', 2.0), ('a', 3.5), ('a', 4), ('a', 5)])
+
+    def test_flush_on_time(self):
+        sink = self.sink(file_interval=60)
+        sink.flush(self.points('a', [1, 2, 3]))
+        self.assertEqual(sink.stats()['files'], 0)
+        for partition in sink.partitions.values():
+            partition.created -= 61
+        sink.flush([])
+        self.assertEqual(sink.stats()['files'], 1)
+        self.assertEqual(sink.partitions, {})
+
+    def test_manifest(self):
+        sink = self.sink()
+        sink.write(self.points('b', [1, 2]) + self.points('a', [3], start_us=self.day_us - 5000000))
+        sink.write(self.points('c', [4], start_us=self.day_us + 86400 * 1000000))  # next day
+        sink.close()
+        entries = sorted(archive.read_manifest(self.path, 'db', 'aqburk'), key=lambda e: e['file'])
+        self.assertEqual([(e['file'].split('/')[0], e['rows'], e['devids'], e['time_min'], e['time_max'])
+                          for e in entries],
+                         [('date=2018-05-22', 3, ['a', 'b'], self.day_us - 5000000, self.day_us + 1000000),
+                          ('date=2018-05-23', 1, ['c'], self.day_us + 86400 * 1000000, self.day_us + 86400 * 1000000)])
+        self.assertTrue(all(os.path.exists(e['path']) for e in entries))
+        table = archive.pq.read_table(entries[0]['path'])
+        # sorted by devid and time, devid and tags dictionary encoded
+        self.assertEqual(table.column('devid').to_pylist(), ['a', 'b', 'b'])
+        self.assertEqual(table.column('time').cast(archive.pa.int64()).to_pylist(),
+                         [self.day_us - 5000000, self.day_us, self.day_us + 1000000])
+        self.assertTrue(archive.pa.types.is_dictionary(table.schema.field('site').type))
+
+    def test_scan_pruning(self):
+        sink = self.sink()
+        hour_us = 3600 * 1000000
+        sink.write(self.points('a', [1, 2]))
+        sink.close()
+        sink.write(self.points('b', [3, 4], start_us=self.day_us + hour_us))
+        sink.close()
+        with mock.patch('endpoints.archive.pq.read_table', wraps=archive.pq.read_table) as read_table:
+            self.assertEqual(self.rows(devids=['b']), [('b', 3), ('b', 4)])
+            self.assertEqual(read_table.call_count, 1)
+            read_table.reset_mock()
+            self.assertEqual(self.rows(start=self.day_us + 1000000, end=self.day_us + hour_us), [('a', 2)])
+            self.assertEqual(read_table.call_count, 1)
+            read_table.reset_mock()
+            self.assertEqual(self.rows(devids=['a'], start=self.day_us + hour_us), [])
+            self.assertEqual(read_table.call_count, 0)
+            self.assertEqual(len(self.rows()), 4)
+            self.assertEqual(read_table.call_count, 2)
+
+    def test_failed_write_keeps_partition(self):
+        sink = self.sink(rows_per_file=2, file_interval=60, write_attempts=2)
+        with mock.patch('endpoints.archive.pq.write_table', side_effect=OSError('disk full')):
+            sink.write(self.points('a', [1, 2, 3]))
+            self.assertEqual(sink.stats()['errors'], 1)  # not retried on every point
+            self.assertEqual(sink.stats()['buffered_rows'], 3)
+        sink.flush([])  # retried after file_interval
+        self.assertEqual(sink.stats()['files'], 0)
+        next(iter(sink.partitions.values())).created -= 61
+        sink.flush([])
+        self.assertEqual((sink.stats()['files'], sink.stats()['buffered_rows']), (1, 0))
+        self.assertEqual(self.rows(), [('a', 1), ('a', 2), ('a', 3)])
+        with mock.patch('endpoints.archive.pq.write_table', side_effect=OSError('disk full')):
+            sink.write(self.points('b', [1, 2]))
+            sink.close()
+            sink.close()
+        stats = sink.stats()
+        self.assertEqual((stats['errors'], stats['dropped'], stats['open_partitions']), (3, 2, 0))
+        self.assertEqual(stats['last_error'], 'OSError: disk full')
+
+
+class SeenKeysTest(SimpleTestCase):
+
+    def test_ttl(self):
+        seen = dedup.SeenKeys(ttl=60, max_keys=10)
+        self.assertTrue(seen.add('a', now=0))
+        self.assertFalse(seen.add('a', now=59))
+        self.assertTrue(seen.add('a', now=61))
+        self.assertTrue(seen.add('b', now=200))
+        self.assertEqual(len(seen), 1)  # 'a' expired
+
+    def test_lru_bound(self):
+        seen = dedup.SeenKeys(ttl=60, max_keys=3)
+        for i, key in enumerate('abcd'):
+            self.assertTrue(seen.add(key, now=i))
+        self.assertEqual(len(seen), 3)
+        self.assertTrue(seen.add('a', now=5))  # evicted
+        self.assertFalse(seen.add('d', now=5))
+
+    def test_forget(self):
+        with mock.patch('endpoints.dedup._seen', dedup.SeenKeys()):
+            self.assertFalse(dedup.is_duplicate('test', 'dev1', 7))
+            self.assertTrue(dedup.is_duplicate('test', 'dev1', 7))
+            dedup.forget('test', 'dev1', 7)
+            self.assertFalse(dedup.is_duplicate('test', 'dev1', 7))
+
+
+class DigitaUplinkTest(TestCase):
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        patcher = mock.patch('endpoints.dedup._seen', dedup.SeenKeys())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, payload_hex='13040b040bfe', db=None, fcnt=42):
+        from endpoints.plugins.digita import Plugin
+        body = {'DevEUI_uplink': {'DevEUI': 'A81758FFFE030F52', 'Time': '2018-01-02T10:00:00.000+02:00',
+                                  'FCntUp': fcnt, 'LrrRSSI': -100.0, 'payload_hex': payload_hex}}
+        path = '/digita?db={}'.format(db) if db else '/digita'
+        request = RequestFactory().post(path, json.dumps(body), content_type='application/json')
+        return Plugin().view_func(request)
+
+    def test_failed_uplink_is_not_acknowledged_as_duplicate(self):
+        with mock.patch('endpoints.plugins.digita.write_influxdb',
+                        side_effect=InfluxDBClientError('database not found', 404)):
+            self.assertEqual(self.post().status_code, 500)
+        with mock.patch('endpoints.plugins.digita.write_influxdb') as write:
+            self.assertEqual(self.post().status_code, 200)  # gateway retry
+            self.assertEqual(self.post().status_code, 200)  # copy from another gateway
+        self.assertEqual(write.call_count, 1)
+
+    def test_crashed_uplink_is_not_acknowledged_as_duplicate(self):
+        with mock.patch('endpoints.plugins.digita.get_datalogger', side_effect=RuntimeError('db is down')):
+            with self.assertRaises(RuntimeError):
+                self.post()
+        with mock.patch('endpoints.plugins.digita.write_influxdb') as write:
+            self.assertEqual(self.post().status_code, 200)
+        self.assertEqual(write.call_count, 1)
+
+    def test_db_parameter_only_for_aqburk(self):
+        with mock.patch('endpoints.plugins.digita.write_influxdb') as write:
+            self.post('13040b040bfe', db='otherdb')
+            self.post('2a2a0021002c002800300056003b0000004000500060', db='aqproject', fcnt=43)
+        self.assertEqual([c[0][0] for c in write.call_args_list], ['digita', 'aqproject'])
+
+
+# Payload formulas of the Digita plugin before table-driven decoders
+def baseline_hex2value10(hex_str):
+    return int(hex_str, 16) / 10.0
+
+
+def baseline_clickey_tempsens(hex_str):
+    def calc_temp(h):
+        return (300 * (int(h[0:2], 16) * 256 + int(h[2:4], 16)) / 4095) - 50
+    return {'temp1': calc_temp(hex_str[2:6]), 'temp2': calc_temp(hex_str[6:10]),
+            'volt': ((int(hex_str[10:12], 16) / 0.23) + 2400) / 1000}
+
+
+def baseline_aqburk(hex_str):
+    names = ['pm25min', 'pm25max', 'pm25avg', 'pm25med', 'pm10min', 'pm10max', 'pm10avg', 'pm10med']
+    data = {name: baseline_hex2value10(hex_str[4 + i * 4:8 + i * 4]) for i, name in enumerate(names)}
+    if len(hex_str) == 52:
+        data['temp'] = round(baseline_hex2value10(hex_str[36:40]) - 100, 1)
+        data['humi'] = baseline_hex2value10(hex_str[40:44])
+        data['pres'] = baseline_hex2value10(hex_str[44:48])
+        data['gas'] = baseline_hex2value10(hex_str[48:52])
+    return data
+
+
+class DecoderTest(SimpleTestCase):
+
+    def random_hex(self, prefix, nbytes):
+        return prefix + binascii.hexlify(bytes(random.getrandbits(8) for _ in range(nbytes))).decode()
+
+    def assertDecodesLike(self, decoder_name, payload_hex, expected):
+        decoded = decoders.get_decoder(decoder_name).decode_hex(payload_hex)
+        self.assertEqual(sorted(decoded), sorted(expected), payload_hex)
+        for key, value in expected.items():
+            self.assertAlmostEqual(decoded[key], value, places=9, msg='{} {}'.format(payload_hex, key))
+
+    def test_guess_decoder(self):
+        self.assertEqual(decoders.guess_decoder('00010002'), 'paxcounter')
+        self.assertEqual(decoders.guess_decoder('13040b040bfe'), 'clickey_tempsens')
+        self.assertEqual(decoders.guess_decoder('2A2A00210022'), 'aqburk')
+        self.assertEqual(decoders.guess_decoder(binascii.hexlify(b'temp=24.61').decode()), 'keyval')
+
+    def test_paxcounter(self):
+        for _ in range(100):
+            payload_hex = self.random_hex('', 4)
+            self.assertDecodesLike('paxcounter', payload_hex,
+                                   {'wifi': int(payload_hex[0:4], 16), 'ble': int(payload_hex[4:8], 16)})
+
+    def test_clickey_tempsens(self):
+        self.assertDecodesLike('clickey_tempsens', '13040b040bfe', baseline_clickey_tempsens('13040b040bfe'))
+        for _ in range(100):
+            payload_hex = self.random_hex('13', 5)
+            self.assertDecodesLike('clickey_tempsens', payload_hex, baseline_clickey_tempsens(payload_hex))
+
+    def test_aqburk(self):
+        for nbytes in [16, 24]:  # without and with BME680
+            for _ in range(100):
+                payload_hex = self.random_hex('2a2a', nbytes)
+                self.assertDecodesLike('aqburk', payload_hex, baseline_aqburk(payload_hex))
+
+    def test_keyval(self):
+        payload_hex = binascii.hexlify(b'temp=24.61,hum=28.69').decode()
+        self.assertEqual(decoders.get_decoder('keyval').decode_hex(payload_hex), {'temp': 24.61, 'hum': 28.69})
+        with self.assertRaises(decoders.DecodeError):
+            decoders.get_decoder('keyval').decode_hex('ff00')
+
+    def test_short_payload(self):
+        with self.assertRaises(decoders.DecodeError):
+            decoders.get_decoder('aqburk').decode_hex('2a2a')
+
+    def test_decode_batch(self):
+        decoder = decoders.get_decoder('aqburk')
+        payloads = [bytes.fromhex(self.random_hex('2a2a', n)) for n in [16, 24, 16, 30]]
+        self.assertEqual(decoder.decode_batch(payloads), [decoder.decode(p) for p in payloads])
+
+
+class BindingTest(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('endpoints.bindings.bindings', bindings.DecoderBindings())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_binding_resolves_decoder_and_database(self):
+        Datalogger.objects.create(devid='dev1', decoder='paxcounter', database='pax')
+        Datalogger.objects.create(devid='dev2', database='other')
+        Datalogger.objects.create(devid='dev3')
+        self.assertEqual(bindings.get_binding('dev1'), bindings.Binding('paxcounter', 'pax'))
+        self.assertEqual(bindings.get_binding('dev2'), bindings.Binding(None, 'other'))
+        self.assertIsNone(bindings.get_binding('dev3'))
+        self.assertIsNone(bindings.get_binding('unknown'))
+
+    def test_saves_apply_immediately_and_others_after_ttl(self):
+        self.assertIsNone(bindings.get_binding('dev1'))
+        datalogger = Datalogger.objects.create(devid='dev1', decoder='keyval')
+        self.assertEqual(bindings.get_binding('dev1').decoder, 'keyval')  # post_save signal
+        Datalogger.objects.filter(devid='dev1').update(decoder='aqburk')  # e.g. another process, no signal
+        self.assertEqual(bindings.get_binding('dev1').decoder, 'keyval')
+        with override_settings(DECODER_BINDINGS_TTL=0):
+            self.assertEqual(bindings.get_binding('dev1').decoder, 'aqburk')
+        datalogger.delete()
+        self.assertIsNone(bindings.get_binding('dev1'))
+
+
+class DigitaBindingTest(TestCase):
+    """Digita uplinks use the decoder and database of a binding, guess_decoder() only without one."""
+
+    payload_hex = binascii.hexlify(b'a=12').decode()  # 8 hex digits look like paxcounter
+    setUp = DigitaUplinkTest.setUp
+    post = DigitaUplinkTest.post
+
+    def test_bound_decoder_and_database(self):
+        Datalogger.objects.create(devid='A81758FFFE030F52', decoder='keyval', database='kvdb')
+        with mock.patch('endpoints.plugins.digita.write_influxdb') as write, \
+                mock.patch('endpoints.bindings.bindings', bindings.DecoderBindings()):
+            self.assertEqual(self.post(self.payload_hex, db='ignored').status_code, 200)
+        dbname, measurements = write.call_args[0]
+        self.assertEqual(dbname, 'kvdb')
+        self.assertEqual(measurements[0]['measurement'], 'a_rssi')
+        self.assertEqual(measurements[0]['fields'], {'a': 12.0, 'rssi': -100.0})
+
+    def test_guessed_without_binding(self):
+        self.assertEqual(decoders.guess_decoder(self.payload_hex), 'paxcounter')
+        with mock.patch('endpoints.plugins.digita.write_influxdb') as write, \
+                mock.patch('endpoints.bindings.bindings', bindings.DecoderBindings()):
+            self.assertEqual(self.post(self.payload_hex).status_code, 200)
+        dbname, measurements = write.call_args[0]
+        self.assertEqual(dbname, decoders.get_decoder('paxcounter').database or 'digita')
+        self.assertEqual(measurements[0]['measurement'], decoders.get_decoder('paxcounter').measurement)
+
+
+class NoiseSensorTest(SimpleTestCase):
+
+    def test_same_lines_as_legacy_parser(self):
+        from endpoints.management.commands.benchnoisesensor import legacy_parse_noisesensor_v1, sample_params
+        now = datetime.datetime(2018, 1, 2, 9, 26, 59, 123456)
+        for samples in [1, 60, 300]:
+            params = sample_params(samples, seed=samples)
+            self.assertEqual(sorted(packed_to_lines(parse_noisesensor_v1(params, time_to_us(now)))),
+                             sorted(packed_to_lines(legacy_parse_noisesensor_v1(params, now))))
+
+    def test_invalid_query(self):
+        for params in [{'rssi': '-67', '1s': '80'}, {'mac': 'x', '1s': '80'}, {'mac': 'x', 'rssi': '-67', '1s': ','},
+                       {'mac': 'x', 'rssi': 'strong', '1s': '80'}]:
+            with self.assertRaises(ValueError):
+                parse_noisesensor_v1(params)
+
+
+class AcousticRollupTest(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch('endpoints.windows._store', windows.MemoryWindowStore())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def observe(self):
+        start = int(time.time()) // 60 * 60  # older windows would be dropped as late
+        packed = {'v': 1, 'series': [['LAeq1s', {'dev-id': 'TA120'}, ['dBA'],
+                                      [start * 1000000] + [1000000] * 59, [[40.0] * 30 + [60.0] * 30]]]}
+        acoustic.observe_packed('sentilo', packed)
+        return acoustic.finished_windows(now=start + 3 * 3600)
+
+    def test_disabled_without_shared_store(self):
+        self.assertEqual(self.observe(), {})
+
+    @override_settings(ROLLUP_MEMORY_WINDOWS=True)
+    def test_levels(self):
+        rows = {m['tags']['window']: m['fields'] for m in self.observe()['sentilo']}
+        self.assertEqual(rows['1m']['count'], 60)
+        self.assertEqual((rows['1m']['Lmin'], rows['1m']['Lmax'], rows['1m']['L90'], rows['1m']['L10']),
+                         (40.0, 60.0, 40.0, 60.0))
+        self.assertAlmostEqual(rows['1m']['Leq'], 10 * math.log10((10 ** 4 + 10 ** 6) / 2), places=2)
+
+
+@override_settings(ROLLUP_MEMORY_WINDOWS=True, ROLLUP_WATERMARK=300, ROLLUP_DATABASES={},
+                   ROLLUP_RULES=[{'measurement': 'aqburk', 'fields': ['temp', 'pm25'], 'windows': ['5m', '1h']}])
+class RollupTest(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch('endpoints.windows._store', windows.MemoryWindowStore())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.start = (int(time.time()) - 3 * 3600) // 3600 * 3600
+        tags = {'dev-id': 'a1'}
+        self.points = [
+            ('aqburk', tags, {'temp': 10, 'pm25': 2.0, 'ok': True, 'name': 'x'}, self.start * 1000000),
+            ('aqburk', tags, {'temp': 20.5}, (self.start + 299) * 1000000 + 999999),  # last moment of 1st 5m
+            ('aqburk', tags, {'temp': 30.0}, (self.start + 300) * 1000000),  # first moment of 2nd 5m
+            ('aqburk', {'dev-id': 'a2'}, {'temp': -5.0}, (self.start + 10) * 1000000),
+            ('aqburk', tags, {'ok': True, 'name': 'x'}, (self.start + 20) * 1000000),  # no numeric rule fields
+            ('ruuvitag', tags, {'temp': 99.0}, (self.start + 20) * 1000000),  # no rule
+        ]
+
+    def rows(self, windows):
+        return {(db, m['tags']['dev-id'], m['time'] // 1000000 - self.start): m['fields']
+                for (db, retention), measurements in windows.items() for m in measurements}
+
+    def test_windows(self):
+        rollups.add_points('aq', self.points, now=self.start)
+        self.assertEqual(rollups.finished_windows(now=self.start + 599), {})
+        # 5m windows are due ROLLUP_WATERMARK seconds after their end
+        rows = self.rows(rollups.finished_windows(now=self.start + 600))
+        self.assertEqual(rows, {
+            ('aq_5m', 'a1', 0): {'temp_mean': 15.25, 'temp_min': 10.0, 'temp_max': 20.5, 'temp_count': 2,
+                                 'pm25_mean': 2.0, 'pm25_min': 2.0, 'pm25_max': 2.0, 'pm25_count': 1},
+            ('aq_5m', 'a2', 0): {'temp_mean': -5.0, 'temp_min': -5.0, 'temp_max': -5.0, 'temp_count': 1},
+        })
+        self.assertIsInstance(rows[('aq_5m', 'a1', 0)]['temp_min'], float)
+        rows = self.rows(rollups.finished_windows(now=self.start + 3600 + 300))
+        self.assertEqual(rows[('aq_5m', 'a1', 300)], {'temp_mean': 30.0, 'temp_min': 30.0, 'temp_max': 30.0,
+                                                      'temp_count': 1})
+        self.assertEqual(rows[('aq_1h', 'a1', 0)]['temp_count'], 3)
+        self.assertEqual(rows[('aq_1h', 'a1', 0)]['temp_mean'], (10 + 20.5 + 30) / 3)
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rollups.finished_windows(now=self.start + 10 * 3600), {})
+
+    def test_windows_are_merged(self):
+        for point in self.points[:3]:
+            rollups.add_points('aq', [point], now=self.start)
+        rows = self.rows(rollups.finished_windows(now=self.start + 3600 + 300))
+        self.assertEqual(rows[('aq_1h', 'a1', 0)]['temp_count'], 3)
+        self.assertEqual(rows[('aq_1h', 'a1', 0)]['temp_max'], 30.0)
+
+    def test_late_points_are_dropped(self):
+        late = rollups.late_points
+        # 5m windows ended more than ROLLUP_WATERMARK seconds ago, the 1h window did not
+        rollups.add_points('aq', self.points[:3], now=self.start + 3000)
+        self.assertEqual(rollups.late_points - late, 3)
+        rows = self.rows(rollups.finished_windows(now=self.start + 10 * 3600))
+        self.assertEqual(list(rows), [('aq_1h', 'a1', 0)])
+
+    @override_settings(ROLLUP_DATABASES={'1h': ('hourly', '3650d')}, ROLLUP_RETENTION={'5m': '30d'})
+    def test_target_database(self):
+        self.assertEqual(rollups.target_database('aq', '1h'), ('hourly', '3650d'))
+        self.assertEqual(rollups.target_database('aq', '5m'), ('aq_5m', '30d'))
+        self.assertEqual(rollups.target_database('aq', '1d'), ('aq_1d', 'INF'))
+
+    def test_invalid_window(self):
+        self.assertEqual(rollups.window_seconds('15m'), 900)
+        with self.assertRaises(ValueError):
+            rollups.window_seconds('15 minutes')
+
+    @override_settings(ROLLUP_MEMORY_WINDOWS=False)
+    def test_disabled_without_shared_store(self):
+        self.assertEqual(rollups.get_rules(), {})
+
+    @mock.patch('endpoints.sinks.tee')
+    @mock.patch('endpoints.sinks.publish')
+    @mock.patch('endpoints.sinks.save_packed_to_influxdb')
+    def test_flush_rollups(self, task, publish, tee):
+        packed = pack_measurements([{'measurement': m, 'tags': tags, 'fields': fields, 'time': ts}
+                                    for m, tags, fields, ts in self.points])
+        with mock.patch('time.time', return_value=self.start):
+            rollups.observe_packed('aq', packed)
+        self.assertEqual(sinks.flush_rollups(force=True), 5)
+        written = {}
+        for (dbname, packed, retention), kwargs in task.delay.call_args_list:
+            for measurement, tags, fields, ts in iter_packed(packed):
+                written[(dbname, retention, tags['dev-id'], ts // 1000000 - self.start)] = fields
+        self.assertEqual(sorted(written), [('aq_1h', 'INF', 'a1', 0), ('aq_1h', 'INF', 'a2', 0),
+                                           ('aq_5m', '400d', 'a1', 0), ('aq_5m', '400d', 'a1', 300),
+                                           ('aq_5m', '400d', 'a2', 0)])
+        self.assertEqual(written[('aq_5m', '400d', 'a1', 0)]['temp_mean'], 15.25)
+        self.assertEqual(written[('aq_1h', 'INF', 'a1', 0)]['pm25_count'], 1)
+        self.assertEqual(sinks.flush_rollups(force=True), 0)
+
+
+@override_settings(QUERY_PROXY_DATABASES=['ruuvistation'])
+class QueryProxyTest(TestCase):
+
+    allowed = [
+        'SELECT mean("temperature") FROM "ruuvitag" WHERE time > now() - 6h GROUP BY time(5m)',
+        'SELECT * FROM "ruuvistation"."autogen"."ruuvitag", ruuvistation..m2 WHERE "name" = \'DROP; "x".y.z\'',
+        'SELECT "into" FROM /^ruuvi.*/ WHERE "dev-id" =~ /^a\\/b"/ AND x / 2 > 1',
+        'SELECT max(x) FROM (SELECT mean(x) AS x FROM "autogen"."m" GROUP BY time(1m))',
+        'SHOW TAG KEYS ON "ruuvistation" FROM "ruuvitag"; SHOW MEASUREMENTS',
+        'SHOW RETENTION POLICIES',
+    ]
+    bypasses = [
+        'SELECT * FROM "_internal"."monitor"."shard"',
+        'SELECT * FROM other..m',
+        'SELECT * FROM ruuvitag, "secret"."autogen"./.*/',
+        'SELECT * FROM (SELECT * FROM "secret"."autogen"."m")',
+        'SELECT * FROM "ruuvitag" WHERE "a" = \'b\'; SELECT * FROM secret.autogen.m',
+        'SHOW MEASUREMENTS ON "secret"',
+        'SHOW USERS',
+        'SHOW DATABASES',
+        'SELECT * INTO "ruuvistation"."autogen"."copy" FROM "ruuvitag"',
+        'SELECT a"x"INTO b FROM "ruuvitag"',
+        'SELECT * FROM "ruuvitag"; DROP MEASUREMENT "ruuvitag"',
+        'SELECT * FROM "ruuvitag" WHERE "a" = \'b',
+        'SELECT * FROM "ruuvitag\\"; DROP DATABASE "ruuvistation"',
+    ]
+
+    def test_allowed(self):
+        for q in self.allowed:
+            queryproxy.check_query('ruuvistation', q)
+
+    def test_bypass(self):
+        for q in self.bypasses:
+            with self.assertRaises(queryproxy.QueryError, msg=q):
+                queryproxy.check_query('ruuvistation', q)
+        with self.assertRaises(queryproxy.QueryError):
+            queryproxy.check_query('secret', 'SELECT * FROM "m"')
+
+    def test_view_requires_user(self):
+        User.objects.create_user('user', password='userpass')
+        params = {'db': 'ruuvistation', 'q': 'SELECT * FROM "ruuvitag"'}
+        with mock.patch('endpoints.queryproxy.query_backend', return_value=(200, 'application/json', b'{}')) as q:
+            self.assertEqual(self.client.get('/query', params).status_code, 401)
+            self.assertEqual(self.client.get('/query', params, HTTP_AUTHORIZATION=basic_auth('user', 'x')).status_code,
+                             401)
+            self.assertEqual(q.call_count, 0)
+            response = self.client.get('/query', params, HTTP_AUTHORIZATION=basic_auth('user', 'userpass'))
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get('/query', dict(params, q='SELECT * FROM secret..m'),
+                                       HTTP_AUTHORIZATION=basic_auth('user', 'userpass'))
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(q.call_count, 1)
+
+
+class FakePlugin:
+    name = 'fake'
+
+    def get_device_id(self, request):
+        return request.GET.get('mac')
+
+
+class RateLimitTest(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('endpoints.ratelimit._limiter', ratelimit.Limiter())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        ratelimit.throttled.clear()
+        self.factory = RequestFactory()
+
+    def request(self, mac=None, auth=None):
+        request = self.factory.get('/fake', {'mac': mac} if mac else {},
+                                   **({'HTTP_AUTHORIZATION': auth} if auth else {}))
+        request.user = AnonymousUser()
+        return request
+
+    def test_token_bucket(self):
+        bucket = ratelimit.TokenBucket(rate=2, burst=3, now=0)
+        self.assertEqual([bucket.take(now=0) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.take(now=0), 0.5)
+        self.assertEqual(bucket.take(now=0.5), 0)
+        self.assertEqual([bucket.take(now=100) for _ in range(4)][3], 0.5)  # refill stops at burst
+
+    def test_limiter_drops_least_recently_used(self):
+        limiter = ratelimit.Limiter(max_buckets=2)
+        limiter.take('a', 0, 1)
+        limiter.take('b', 0, 1)
+        self.assertEqual(limiter.take('a', 0, 1), 3600)
+        limiter.take('c', 0, 1)
+        self.assertEqual(list(limiter.buckets), ['a', 'c'])
+        self.assertEqual(limiter.take('b', 0, 1), 0)
+
+    @override_settings(RATELIMITS={'device': {'rate': 0.001, 'burst': 2, 'action': 'drop'},
+                                   'plugin': {'rate': 0.001, 'burst': 100}},
+                       RATELIMIT_OVERRIDES={'device:fake:vip': None})
+    def test_scopes_and_overrides(self):
+        plugin = FakePlugin()
+        self.assertEqual([ratelimit.check(plugin, self.request('dev1')) for _ in range(2)], [None, None])
+        self.assertEqual(ratelimit.check(plugin, self.request('dev1'))[0], 'drop')
+        self.assertIsNone(ratelimit.check(plugin, self.request('dev2')))
+        for _ in range(10):
+            self.assertIsNone(ratelimit.check(plugin, self.request('vip')))
+        self.assertEqual(ratelimit.stats(), {'device:fake:dev1': 1})
+
+    @override_settings(RATELIMITS={'user': {'rate': 0.001, 'burst': 1}})
+    def test_user_bucket_needs_valid_credentials(self):
+        User.objects.create_user('user', password='userpass')
+        plugin = FakePlugin()
+        self.assertIsNone(ratelimit.check(plugin, self.request(auth=basic_auth('user', 'userpass'))))
+        # Forged headers with the user's name must not use up the user's bucket
+        for _ in range(3):
+            self.assertIsNone(ratelimit.check(plugin, self.request(auth=basic_auth('user', 'wrong'))))
+        self.assertIsNone(ratelimit.check(plugin, self.request(auth='Basic !!!')))
+        request = self.request(auth=basic_auth('user', 'userpass'))
+        self.assertEqual(ratelimit.check(plugin, request)[0], 'reject')
+        self.assertEqual(request._basicauth[2].username, 'user')  # the view reuses the result
+
+    @override_settings(RATELIMITS={'plugin': {'rate': 0.001, 'burst': 1, 'action': 'log'}})
+    def test_log_only(self):
+        plugin = FakePlugin()
+        view = ratelimit.limit_view(plugin, lambda request: HttpResponse('handled'))
+        with self.assertLogs('endpoints.ratelimit', 'WARNING') as logs:
+            responses = [view(self.request()) for _ in range(3)]
+        self.assertEqual([r.content for r in responses], [b'handled'] * 3)
+        self.assertEqual(len(logs.output), 1)
+        self.assertEqual(ratelimit.stats(), {'plugin:fake': 2})
+
+    @override_settings(RATELIMITS={'plugin': {'rate': 0.5, 'burst': 1}})
+    def test_reject(self):
+        view = ratelimit.limit_view(FakePlugin(), lambda request: HttpResponse('handled'))
+        self.assertEqual(view(self.request()).status_code, 200)
+        response = view(self.request())
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '2')
+
+
+class FieldTypesTest(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('endpoints.fieldtypes._registry', fieldtypes.FieldTypeRegistry())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        fieldtypes.drift.clear()
+        self.iclient = mock.Mock()
+        self.iclient.query.return_value.raw = {'series': [
+            {'name': 'm', 'columns': ['fieldKey', 'fieldType'],
+             'values': [['temp', 'float'], ['cnt', 'integer'], ['ok', 'boolean'], ['name', 'string']]},
+        ]}
+
+    def test_coerce(self):
+        for value, expected, result in [(21, 'float', 21.0), ('21.5', 'float', 21.5), (21.0, 'integer', 21),
+                                        ('21', 'integer', 21), (1, 'boolean', True), ('False', 'boolean', False),
+                                        (True, 'string', 'true'), (2.5, 'string', '2.5'), (3, 'integer', 3)]:
+            converted = fieldtypes.coerce(value, expected)
+            self.assertEqual((converted, fieldtypes.value_type(converted)), (result, expected), (value, expected))
+        for value, expected in [(21.5, 'integer'), ('x', 'float'), ('nan', 'float'), (2, 'boolean'),
+                                ('yes', 'boolean'), (1.0, 'boolean'), (True, 'integer')]:
+            with self.assertRaises((ValueError, TypeError), msg=(value, expected)):
+                fieldtypes.coerce(value, expected)
+
+    def test_new_field_type(self):
+        self.assertEqual(fieldtypes.new_field_type([1, 2.5]), 'float')
+        self.assertEqual(fieldtypes.new_field_type([1, 2]), 'integer')
+        self.assertEqual(fieldtypes.new_field_type(['a', 1]), 'string')
+
+    def test_check_packed_coerces_and_quarantines(self):
+        packed = {'v': 1, 'series': [
+            ['m', {'dev-id': 'dev1'}, ['cnt', 'temp'], [1000000, 1000000, 1000000], [[1, 2.0, 2.5], [20, 21.5, 'x']]],
+            ['m', {'dev-id': 'dev2'}, ['ok'], [1000000], [['true']]],
+            ['new', {'dev-id': 'dev1'}, ['level'], [1000000, 1000000], [[1, 2.5]]],
+        ]}
+        ok, quarantined = fieldtypes.check_packed(self.iclient, 'testdb', packed)
+        rows = sorted((m, tags['dev-id'], ts, sorted(fields.items())) for m, tags, fields, ts in iter_packed(ok))
+        self.assertEqual(rows, [  # the third dev1 row had only conflicting values
+            ('m', 'dev1', 1000000, [('cnt', 1), ('temp', 20.0)]),
+            ('m', 'dev1', 2000000, [('cnt', 2), ('temp', 21.5)]),
+            ('m', 'dev2', 1000000, [('ok', True)]),
+            ('new', 'dev1', 1000000, [('level', 1.0)]),
+            ('new', 'dev1', 2000000, [('level', 2.5)]),
+        ])
+        self.assertEqual(list(iter_packed(quarantined)),
+                         [('m', {'dev-id': 'dev1'}, {'cnt': 2.5}, 3000000),
+                          ('m', {'dev-id': 'dev1'}, {'temp': 'x'}, 3000000)])
+        self.assertEqual(self.iclient.query.call_count, 1)
+        actions = {(d['field'], d['got'], d['action']): d['count'] for d in fieldtypes.stats()}
+        self.assertEqual(actions[('temp', 'integer', 'coerced')], 1)
+        self.assertEqual(actions[('cnt', 'float', 'quarantined')], 1)
+        self.assertEqual(actions[('temp', 'string', 'quarantined')], 1)
+
+        fieldtypes.quarantine('testdb', quarantined)
+        failed = FailedWrite.objects.get()
+        self.assertEqual((failed.kind, failed.status, failed.point_count), ('CONFLICT', 'HELD', 2))
+        self.assertEqual(deadletter.load_payload(failed), quarantined)
+
+
+@override_settings(TASK_QUEUES={'endpoints.tasks.save_packed_to_influxdb': 'influxdb',
+                                'endpoints.tasks.push_ngsi_orion': 'orion'},
+                   TASK_QUEUE_SHARDS={'influxdb': 4})
+class RoutingTest(SimpleTestCase):
+
+    def test_jump_hash(self):
+        # Reference values of the paper's C++ implementation
+        self.assertEqual([routing.jump_hash(key, buckets) for key, buckets in
+                          [(1, 1), (42, 57), (0xDEAD10CC, 1), (0xDEAD10CC, 666), (256, 1024)]], [0, 43, 0, 361, 520])
+
+    def test_shard_is_stable(self):
+        # Changing these moves devices to other workers, so they are pinned
+        self.assertEqual([routing.shard_queue('influxdb', d, 4) for d in ['dev1', '70B3D5E050001234']],
+                         ['influxdb.3', 'influxdb.0'])
+        devices = ['dev{}'.format(i) for i in range(2000)]
+        before = {d: routing.shard_queue('influxdb', d, 4) for d in devices}
+        after = {d: routing.shard_queue('influxdb', d, 5) for d in devices}
+        moved = [d for d in devices if before[d] != after[d]]
+        self.assertEqual({after[d] for d in moved}, {'influxdb.4'})  # only to the new shard
+        self.assertAlmostEqual(len(moved) / len(devices), 1 / 5, delta=0.05)
+        self.assertEqual(len(set(before.values())), 4)
+
+    def test_route_task(self):
+        packed = {'v': 1, 'series': [['m', {'dev-id': 'dev1'}, ['x'], [1], [[1.0]]]]}
+        name = 'endpoints.tasks.save_packed_to_influxdb'
+        self.assertEqual(routing.route_task(name, ('db', packed), {}, {}), {'queue': 'influxdb.3'})
+        self.assertEqual(routing.route_task(name, (), {'dbname': 'db', 'packed': packed}, {}), {'queue': 'influxdb.3'})
+        self.assertEqual(routing.route_task(name, ('db', {'v': 1, 'series': []}), {}, {}),
+                         {'queue': routing.shard_queue('influxdb', 'db', 4)})
+        self.assertEqual(routing.route_task('endpoints.tasks.push_ngsi_orion', ({'id': 'dev1'},), {}, {}),
+                         {'queue': 'orion'})
+        self.assertIsNone(routing.route_task('endpoints.tasks.other', (), {}, {}))
+
+    def test_queue_names(self):
+        self.assertEqual(routing.queue_names(), ['celery', 'influxdb.0', 'influxdb.1', 'influxdb.2', 'influxdb.3',
+                                                 'orion'])
+
+
+class BodiesTest(SimpleTestCase):
+
+    data = {'devid': 'dev1', 'values': [1, 2.5, 'x'], 'ok': True}
+
+    def request(self, body, content_type='application/json', encoding=None):
+        extra = {'HTTP_CONTENT_ENCODING': encoding} if encoding else {}
+        return RequestFactory().post('/x', body, content_type=content_type, **extra)
+
+    def test_content_encodings(self):
+        raw = json.dumps(self.data).encode()
+        deflate = zlib.compressobj(wbits=zlib.MAX_WBITS)
+        for encoding, body in [(None, raw), ('identity', raw), ('gzip', gzip.compress(raw)),
+                               ('x-gzip', gzip.compress(raw)), ('deflate', deflate.compress(raw) + deflate.flush())]:
+            request = self.request(body, encoding=encoding)
+            self.assertEqual(bodies.parse_body(request), self.data, encoding)
+            self.assertEqual(request.body, body)  # raw body stays available for dump_request()
+
+    def test_content_types(self):
+        packed = msgpack.packb(self.data, use_bin_type=True)
+        for content_type in bodies.MSGPACK_TYPES:
+            self.assertEqual(bodies.parse_body(self.request(packed, content_type)), self.data)
+        self.assertEqual(bodies.parse_body(self.request(gzip.compress(packed), 'application/msgpack', 'gzip')),
+                         self.data)
+        for content_type in ['text/plain', 'application/json; charset=utf-8', '']:
+            self.assertEqual(bodies.parse_body(self.request(json.dumps(self.data), content_type)), self.data)
+
+    @skipUnless(bodies.cbor2, 'cbor2 is not installed')
+    def test_cbor(self):
+        body = bodies.cbor2.dumps(self.data)
+        self.assertEqual(bodies.parse_body(self.request(body, 'application/cbor')), self.data)
+        self.assertEqual(bodies.parse_body(self.request(gzip.compress(body), 'application/cbor', 'gzip')), self.data)
+
+    def test_cbor_without_cbor2(self):
+        with mock.patch('endpoints.bodies.cbor2', None):
+            with self.assertRaises(bodies.UnsupportedMediaType) as cm:
+                bodies.parse_body(self.request(b'\xa0', 'application/cbor'))
+        self.assertEqual(cm.exception.status, 415)
+
+    def test_invalid_bodies(self):
+        for request, status in [(self.request(b'{"a":'), 400),
+                                (self.request(b'\xc1', 'application/msgpack'), 400),
+                                (self.request(b'not gzip', encoding='gzip'), 400),
+                                (self.request(b'{}', encoding='br'), 415)]:
+            with self.assertRaises(bodies.BodyError) as cm:
+                bodies.parse_body(request)
+            self.assertEqual(cm.exception.status, status)
+
+    @override_settings(REQUEST_BODY_MAX_BYTES=1024 * 1024)
+    def test_decompressed_size_is_capped(self):
+        bomb = gzip.compress(b'0' * (50 * 1024 * 1024))  # 50 MB of zeros, about 50 kB compressed
+        self.assertLess(len(bomb), 100 * 1024)
+        with self.assertRaises(bodies.BodyTooLarge) as cm:
+            bodies.parse_body(self.request(bomb, encoding='gzip'))
+        self.assertEqual(cm.exception.status, 413)
+        # Streamed: decompressed in READ_SIZE parts and stopped right after the cap
+        parts = []
+        with self.assertRaises(bodies.BodyTooLarge):
+            for part in bodies.iter_body_chunks(self.request(bomb, encoding='gzip')):
+                parts.append(len(part))
+        self.assertLessEqual(max(parts), bodies.READ_SIZE)
+        self.assertLessEqual(sum(parts), 1024 * 1024)
+        # Uncompressed bodies have the same cap, under it everything passes
+        with self.assertRaises(bodies.BodyTooLarge):
+            bodies.parse_body(self.request(b'0' * (1024 * 1024 + 1)))
+        self.assertEqual(bodies.parse_body(self.request(gzip.compress(b'[' + b'0,' * 1000 + b'0]'), encoding='gzip')),
+                         [0] * 1001)
+
+
+class BatchUploadTest(TestCase):
+
+    ndjson = '\n'.join([
+        '{"devid": "dev1", "measurement": "ruuvitag", "time": "2018-05-22T19:16:31Z", "fields": {"temperature": 5.18}}',
+        '{"devid": "dev1", "measurement": "ruuvitag", "time": 1527016651, "fields": {"temperature": 5.21}, '
+        '"tags": {"name": "vetari 2"}}',
+        '',
+        '{"devid": "dev2", "measurement": "ruuvitag", "time": 1527016652, "fields": {"temperature": "warm"}}',
+        '{"devid": "dev2", "measurement": "ruuvitag", "fields": {"temperature": 5.0}}',
+        '{not json',
+        '{"devid": "dev2", "measurement": "ruuvitag", "time": "1527016653", "fields": {"temperature": 5.3}}',
+    ]) + '\n'
+
+    def setUp(self):
+        User.objects.create_user('station', password='pass')
+        patcher = mock.patch('endpoints.plugins.batchupload.CHUNK_SIZE', 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, body, content_type='application/x-ndjson', auth=None, **extra):
+        from endpoints.plugins.batchupload import Plugin
+        request = RequestFactory().post('/batch', body, content_type=content_type,
+                                        HTTP_AUTHORIZATION=auth or basic_auth('station', 'pass'), **extra)
+        with mock.patch('endpoints.plugins.batchupload.queue_influxdb') as queue_influxdb:
+            response = Plugin().view_func(request)
+        return response, [(c[0][0], list(c[0][1])) for c in queue_influxdb.call_args_list]
+
+    def test_ndjson_is_queued_in_chunks(self):
+        response, calls = self.post(self.ndjson)
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content.decode())
+        self.assertEqual((result['accepted'], result['rejected']), (3, 3))
+        self.assertEqual([r.split(':')[0] for r in result['errors']], ['Reading 3', 'Reading 4', 'Reading 5'])
+        self.assertIn('KeyError', result['errors'][1])
+        self.assertEqual([(db, len(batch)) for db, batch in calls], [('station', 2), ('station', 1)])
+        first, second = calls[0][1]
+        self.assertEqual((first['time'], first['fields']), ('2018-05-22T19:16:31.000000Z', {'temperature': 5.18}))
+        self.assertEqual((second['time'], second['tags']), ('2018-05-22T19:17:31.000000Z',
+                                                            {'dev-id': 'dev1', 'name': 'vetari 2'}))
+
+    def test_csv_is_queued_in_chunks(self):
+        body = ('devid,measurement,time,temperature,humidity\r\n'
+                'dev1,ruuvitag,2018-05-22T19:16:31Z,5.18,83.0\r\n'
+                'dev1,ruuvitag,1527016651,5.21,\r\n'
+                'dev2,ruuvitag,yesterday,5.0,80\r\n'
+                'dev2,ruuvitag,1527016652,5.3,81\r\n'
+                'dev2,ruuvitag,1527016653,5.4,82\r\n')
+        response, calls = self.post(gzip.compress(body.encode()), content_type='text/csv', HTTP_CONTENT_ENCODING='gzip')
+        result = json.loads(response.content.decode())
+        self.assertEqual((response.status_code, result['accepted'], result['rejected']), (200, 4, 1))
+        self.assertTrue(result['errors'][0].startswith('Reading 3: '), result['errors'])
+        self.assertEqual([len(batch) for _, batch in calls], [2, 2])
+        self.assertEqual([m['fields'] for m in calls[0][1]], [{'temperature': 5.18, 'humidity': 83.0},
+                                                              {'temperature': 5.21}])
+
+    def test_invalid_uploads(self):
+        response, calls = self.post('{not json\n')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content.decode())['rejected'], 1)
+        response, calls = self.post('id,temperature\ndev1,5\n', content_type='text/csv')
+        self.assertEqual(json.loads(response.content.decode())['errors'],
+                         ['Reading 1: CSV header must start with devid,measurement,time'])
+        self.assertEqual(self.post('x', content_type='text/plain')[0].status_code, 415)
+        self.assertEqual(self.post(self.ndjson, auth=basic_auth('station', 'wrong'))[0].status_code, 401)
+        self.assertEqual(self.post(b'not gzip', HTTP_CONTENT_ENCODING='gzip')[0].status_code, 400)
+        self.assertEqual(calls, [])
+
+
+class RetentionTest(TestCase):
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.media_root = media.name
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def create_request(self, path, days_old, status='NEW'):
+        os.makedirs(os.path.join(self.media_root, path))
+        return Request.objects.create(method='POST', path=path, status=status,
+                                      created=timezone.now() - datetime.timedelta(days=days_old))
+
+    def test_nothing_is_purged_by_default(self):
+        self.create_request('digita/2018-01-02/20180102T100000.000000Z', 1000)
+        self.assertEqual(retention.purge_requests(), {})
+        self.assertEqual(Request.objects.count(), 1)
+
+    @override_settings(REQUEST_RETENTION_DAYS={'*': {'*': 365, 'SPAM': 30}, 'digita': 7})
+    def test_most_specific_rule_wins(self):
+        kept = [self.create_request('sentilo/2018-01-02/a', 100), self.create_request('other/2018-01-02/b', 10,
+                                                                                        status='SPAM')]
+        self.create_request('sentilo/2018-01-02/c', 400)
+        self.create_request('other/2018-01-02/d', 40, status='SPAM')
+        self.create_request('digita/2018-01-02/e', 8)
+        retention.purge_requests()
+        self.assertEqual(set(Request.objects.values_list('id', flat=True)), {r.id for r in kept})
+        self.assertEqual(sorted(os.listdir(self.media_root)), ['other', 'sentilo'])
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'sentilo', '2018-01-02')), ['a'])
+
+
+@override_settings(DUMP_MAX_BYTES=200)
+class DumpRequestTest(TestCase):
+
+    plate = {'plate': 'ABC-123', 'date': '2018-01-02T10:00:00Z', 'country': 'fi', 'confidence': 91.5,
+             'ip': '10.0.0.1', 'direction': 1}
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def request(self, body):
+        return RequestFactory().post('/camera', body, content_type='application/json')
+
+    def post_plate(self, data):
+        from endpoints.plugins.platecamera import Plugin
+        with mock.patch('endpoints.plugins.platecamera.write_influxdb') as write:
+            response = Plugin().view_func(self.request(json.dumps(data)))
+        return response, write
+
+    def test_plate_is_parsed_from_body(self):
+        response, write = self.post_plate(self.plate)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual(Plate.objects.get().plate, 'ABC-123')
+
+    def test_truncated_body_is_rejected(self):
+        response, write = self.post_plate(dict(self.plate, image='x' * 300))
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(write.call_count, 0)
+
+    def test_duplicate_scope(self):
+        dump_request(self.request(b'{"a": 1}'), postfix='democam')
+        request = self.request(b'{"a": 1}')
+        dump_request(request, postfix='democam')
+        self.assertIsNotNone(request.dump_duplicate_of)
+        request = self.request(b'{"a": 1}')
+        dump_request(request, postfix='digita')
+        self.assertIsNone(request.dump_duplicate_of)
+        Request.objects.update(created=timezone.now() - datetime.timedelta(days=8))
+        request = self.request(b'{"a": 1}')
+        dump_request(request, postfix='democam')
+        self.assertIsNone(request.dump_duplicate_of)
@@ -0,0 +1,136 @@
+"""
+Fire-and-forget UDP line protocol writes for high-rate sensors.
+
+Databases listed in INFLUXDB_UDP setting are written straight from the
+request to an InfluxDB UDP listener instead of the Celery queue. Sending a
+datagram from a non-blocking socket takes microseconds, but a lost datagram
+is never noticed, so use it only for data which tolerates rare loss:
+
+    INFLUXDB_UDP = {
+        'noisesensor': {'host': '127.0.0.1', 'port': 8089},
+        'sentilo': {'host': '127.0.0.1', 'port': 8090, 'precision': 's'},
+    }
+
+Every InfluxDB UDP listener writes to one database (see [[udp]] in
+influxdb.conf), so every database has its own port. `precision` must match
+the listener's precision setting: 'n' (InfluxDB default), 'u', 'ms' or 's'.
+Lines are packed into datagrams of at most INFLUXDB_UDP_PAYLOAD bytes
+(default 1400, fits in an Ethernet MTU). Field types are not checked (see
+endpoints.fieldtypes), a conflicting line is dropped by InfluxDB.
+
+Sent datagrams, bytes and points and datagrams dropped because the socket
+buffer was full are counted per process, see /status/influxdb.
+"""
+import logging
+import socket
+import threading
+from collections import Counter
+
+from endpoints.lineprotocol import packed_to_lines
+from endpoints.utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS_US = {'u': 1, 'ms': 1000, 's': 1000000}
+
+stats = Counter()  # datagrams, bytes, points, dropped, errors
+_stats_lock = threading.Lock()
+
+
+def pack_datagrams(lines, max_bytes):
+    """
+    Join lines to datagrams of at most `max_bytes` bytes. A longer line is sent alone.
+
+    :return: list of (bytes, number of lines) tuples
+    """
+    datagrams = []
+    current = []
+    size = 0
+    for line in lines:
+        data = line.encode('utf-8')
+        if current and size + 1 + len(data) > max_bytes:
+            datagrams.append((b'\n'.join(current), len(current)))
+            current, size = [], 0
+        current.append(data)
+        size += len(data) + (1 if size else 0)
+    if current:
+        datagrams.append((b'\n'.join(current), len(current)))
+    return datagrams
+
+
+class UDPWriter:
+
+    def __init__(self, host, port, precision='n', payload=1400):
+        if precision != 'n' and precision not in PRECISIONS_US:
+            raise ValueError('Unsupported UDP precision "{}", use n, u, ms or s'.format(precision))
+        self.address = (host, int(port))
+        self.precision = precision
+        self.payload = int(payload)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def lines(self, packed):
+        if self.precision == 'n':
+            # microsecond timestamps to nanoseconds without another pass over the values
+            return [line + '000' for line in packed_to_lines(packed)]
+        return packed_to_lines(packed, PRECISIONS_US[self.precision])
+
+    def send_packed(self, packed):
+        """Send packed measurements, never block."""
+        sent = dropped = errors = nbytes = points = 0
+        for datagram, line_count in pack_datagrams(self.lines(packed), self.payload):
+            try:
+                self.sock.sendto(datagram, self.address)
+                sent += 1
+                nbytes += len(datagram)
+                points += line_count
+            except BlockingIOError:
+                dropped += 1
+            except OSError as err:
+                errors += 1
+                logger.warning('[UDP] Send to {}:{} failed: {}'.format(*self.address, err))
+        with _stats_lock:
+            stats['datagrams'] += sent
+            stats['bytes'] += nbytes
+            stats['points'] += points  # lines in dropped datagrams are not counted
+            stats['dropped'] += dropped
+            stats['errors'] += errors
+        return sent
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(dbname):
+    """Return UDPWriter of database `dbname` or None if it is not written with UDP."""
+    conf = (get_setting('INFLUXDB_UDP', {}) or {}).get(dbname)
+    if conf is None:
+        return None
+    writer = _writers.get(dbname)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get(dbname)
+            if writer is None:
+                conf = dict(conf)
+                conf.setdefault('payload', get_setting('INFLUXDB_UDP_PAYLOAD', 1400))
+                writer = _writers[dbname] = UDPWriter(**conf)
+    return writer
+
+
+def send_packed(dbname, packed):
+    """
+    Send packed measurements with UDP if `dbname` is in INFLUXDB_UDP.
+
+    :return: True if sent, False if the database is not written with UDP
+    """
+    writer = get_writer(dbname)
+    if writer is None:
+        return False
+    writer.send_packed(packed)
+    return True
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(stats)
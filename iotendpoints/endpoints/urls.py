@@ -20,12 +20,24 @@ urlpatterns = plugin_urlpatterns(plugins)
 
 urlpatterns += [
     url(r'^$', views.index, name='index'),
+    url(r'^status/circuitbreakers$', views.circuitbreakers, name='circuitbreakers'),
+    url(r'^status/livestream$', views.livestream_status, name='livestream_status'),
+    url(r'^status/dedup$', views.dedup_status, name='dedup_status'),
+    url(r'^status/sinks$', views.sinks_status, name='sinks_status'),
+    url(r'^status/queryproxy$', views.queryproxy_status, name='queryproxy_status'),
+    url(r'^status/ratelimit$', views.ratelimit_status, name='ratelimit_status'),
+    url(r'^status/fieldtypes$', views.fieldtypes_status, name='fieldtypes_status'),
+    url(r'^status/influxdb$', views.influxdb_status, name='influxdb_status'),
+    url(r'^status/queues$', views.queues_status, name='queues_status'),
+    url(r'^latest$', views.latest, name='latest'),
+    url(r'^stream$', views.stream, name='stream'),
+    url(r'^export$', views.export, name='export'),
+    url(r'^query$', views.query, name='query'),
     url(OBSCURE_URL_PATTERN, views.obscure_dump_request_endpoint, name='dump_request'),
     url(DIGITA_URL_PATTERN, views.digita_dump_request_endpoint, name='digita_dump_request'),
     url(r'^basicauth$', views.basicauth_dump_request_endpoint, name='basicauth_dump_request'),
     url(r'^aqtest$', views.basicauth_dump_request_endpoint, name='aqtest'),
     url(r'^fmiaq/v1$', views.fmiaqhandler, name='fmiaqhandler'),
-    url(r'^noisesensor/v1$', views.noisesensorhandler, name='noisesensorhandler'),
     url(r'^mapmytracks/v1$', views.mapmytracks, name='mapmytracks'),
 ]
 
@@ -71,17 +71,25 @@ def get_plugins(plugins_dir):
 
 
 def plugin_urlpatterns(plugins_dir):
+    from .ratelimit import limit_view  # ratelimit imports this module
     plugins = get_plugins(plugins_dir)
     urlpatterns = []
     for p in plugins:
         register_plugin = p.register
         register_plugin()
-        urlpatterns += p.get_urlpatterns()
+        for pattern in p.get_urlpatterns():
+            pattern.callback = limit_view(p, pattern.callback)
+            urlpatterns.append(pattern)
     return urlpatterns
 
 
 def basicauth(request):
-    """Check for valid basic auth header."""
+    """
+    Check for valid basic auth header. The result is kept in the request, so rate limiting
+    (see endpoints.ratelimit) and the view hash the password only once.
+    """
+    if hasattr(request, '_basicauth'):
+        return request._basicauth
     uname, passwd, user = None, None, None
     if 'HTTP_AUTHORIZATION' in request.META:
         auth = request.META['HTTP_AUTHORIZATION'].split()
@@ -89,13 +97,22 @@ def basicauth(request):
             if auth[0].lower() == "basic":
                 a = auth[1].encode('utf8')
                 s = base64.b64decode(a)
-                uname, passwd = s.decode('utf8').split(':')
+                uname, passwd = s.decode('utf8').split(':', 1)  # password may contain ':'
                 user = authenticate(username=uname, password=passwd)
-    return uname, passwd, user
+    request._basicauth = uname, passwd, user
+    return request._basicauth
 
 
-def get_influxdb_client(host='127.0.0.1', port=8086, database='mydb'):
-    iclient = influxdb.InfluxDBClient(host=host, port=port, database=database)
+def get_influxdb_client(host=None, port=None, database='mydb', timeout=None, retries=3):
+    """
+    Return InfluxDBClient. Host and port default to INFLUXDB_HOST and INFLUXDB_PORT
+    settings (or env variables), which default to 127.0.0.1:8086.
+    """
+    if host is None:
+        host = get_setting('INFLUXDB_HOST', '127.0.0.1')
+    if port is None:
+        port = int(get_setting('INFLUXDB_PORT', 8086))
+    iclient = influxdb.InfluxDBClient(host=host, port=port, database=database, timeout=timeout, retries=retries)
     return iclient
 
 
@@ -152,3 +169,9 @@ class BasePlugin:
 
     def get_urlpatterns(self):
         return []
+
+    def get_device_id(self, request):
+        """
+        Return device id of a request, if it is known without parsing the body. Used for rate limiting.
+        """
+        return None
@@ -1,4 +1,7 @@
+import binascii
 import datetime
+import hashlib
+import io
 import json
 import os
 import re
@@ -6,17 +9,34 @@ import pytz
 import base64
 import influxdb
 import requests
+import shutil
+from functools import wraps
 from dateutil.parser import parse
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
 from django.contrib.auth import authenticate
 from .models import Request
+from .utils import get_setting
+from .circuitbreaker import breaker_states
+from .outputs import sink_states
+from .export import FORMATS, Export, ExportError, gzip_stream
+from . import fieldtypes
+from . import influxwrite
+from . import udpsink
+from .routing import queue_depths
+from . import queryproxy
+from . import ratelimit
+from .lastvalue import get_last_values, make_etag
+from .livestream import broker, event_stream, subscribe
+from . import dedup
 
 META_KEYS = ['QUERY_STRING', 'REMOTE_ADDR', 'REMOTE_HOST', 'REMOTE_USER',
              'REQUEST_METHOD', 'SERVER_NAME', 'SERVER_PORT', 'REQUEST_URI']
 
+DUMP_CHUNK_SIZE = 64 * 1024
+
 ORION_URL_ROOT = os.environ.get('ORION_URL_ROOT')
 ORION_USERNAME = os.environ.get('ORION_USERNAME')
 ORION_PASSWORD = os.environ.get('ORION_PASSWORD')
@@ -54,26 +74,323 @@ def index(request):
     return HttpResponse("Hello, world. This is IoT endpoint.")
 
 
-def dump_request(request, user=None, postfix=None):
+def authenticated_user(request):
+    """
+    Return user logged in with session or valid basic auth header, None if there is none.
+    """
+    if request.user.is_authenticated:
+        return request.user
+    try:
+        return _basicauth(request)[2]
+    except (ValueError, binascii.Error, UnicodeDecodeError):  # malformed header
+        return None
+
+
+def _auth_required(view, staff):
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        user = authenticated_user(request)
+        if user is None or (staff and not user.is_staff):
+            response = HttpResponse('You need a {}user account to access this page.'.format('staff ' if staff else ''),
+                                    status=401)
+            response['WWW-Authenticate'] = 'Basic realm="iotendpoints"'
+            return response
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def staff_required(view):
+    """
+    Return 401 with basic auth challenge, if request has no staff user (see authenticated_user()).
+    """
+    return _auth_required(view, staff=True)
+
+
+def user_required(view):
+    """
+    Return 401 with basic auth challenge, if request has no active user (see authenticated_user()).
+    """
+    return _auth_required(view, staff=False)
+
+
+@staff_required
+def circuitbreakers(request):
+    """
+    Return circuit breaker states and trip counts of the worker process which handles the request.
+    """
+    data = {'pid': os.getpid(), 'breakers': breaker_states()}
+    return HttpResponse(json.dumps(data, indent=2), content_type='application/json')
+
+
+@staff_required
+def livestream_status(request):
+    """
+    Return live stream subscriber and delivery counts of the worker process which handles the request.
+    """
+    data = {'pid': os.getpid(), 'livestream': broker.stats()}
+    return HttpResponse(json.dumps(data, indent=2), content_type='application/json')
+
+
+@staff_required
+def sinks_status(request):
+    """
+    Return write, drop and error counts of secondary sinks of the worker process which handles the request.
+    """
+    data = {'pid': os.getpid(), 'sinks': sink_states()}
+    return HttpResponse(json.dumps(data, indent=2), content_type='application/json')
+
+
+@staff_required
+def dedup_status(request):
+    """
+    Return LoRaWAN uplink duplicate counts per device of the worker process which handles the request.
+    """
+    data = {'pid': os.getpid(), 'dedup': dedup.stats()}
+    return HttpResponse(json.dumps(data, indent=2), content_type='application/json')
+
+
+@staff_required
+def fieldtypes_status(request):
+    """
+    Return coerced and quarantined field value counts of the worker process which handles the request.
+    """
+    data = {'pid': os.getpid(), 'drift': fieldtypes.stats()}
+    return HttpResponse(json.dumps(data, indent=2), content_type='application/json')
+
+
+@staff_required
+def influxdb_status(request):
+    """
+    Return InfluxDB write counts and bytes before and after compression of the worker process which handles the request.
+    """
+    data = {'pid': os.getpid(), 'writes': influxwrite.get_stats(), 'udp': udpsink.get_stats()}
+    return HttpResponse(json.dumps(data, indent=2), content_type='application/json')
+
+
+@staff_required
+def queues_status(request):
+    """
+    Return number of waiting tasks and consumers of every Celery queue. Requires a staff user.
+    """
+    try:
+        data = {'queues': queue_depths()}
+    except Exception as err:
+        return HttpResponse(json.dumps({'error': 'Broker is not available: {}'.format(err)}), status=503,
+                            content_type='application/json')
+    return HttpResponse(json.dumps(data, indent=2), content_type='application/json')
+
+
+@staff_required
+def ratelimit_status(request):
+    """
+    Return throttled request counts per device, user and plugin of the worker process which handles the request.
+    """
+    data = {'pid': os.getpid(), 'throttled': ratelimit.stats()}
+    return HttpResponse(json.dumps(data, indent=2), content_type='application/json')
+
+
+@staff_required
+def queryproxy_status(request):
+    """
+    Return query cache hit, miss and collapse counts of the worker process which handles the request.
+    """
+    data = {'pid': os.getpid(), 'queryproxy': dict(queryproxy.stats)}
+    return HttpResponse(json.dumps(data, indent=2), content_type='application/json')
+
+
+@csrf_exempt
+@user_required
+def query(request):
+    """
+    Caching InfluxDB /query proxy for dashboards, see endpoints.queryproxy. Requires a user.
+
+    http -a user:pass GET http://127.0.0.1:8000/query db==ruuvistation epoch==ms \\
+        q=='SELECT mean("temperature") FROM "ruuvitag" WHERE time > now() - 6h GROUP BY time(5m)'
+    """
+    params = request.POST if request.method == 'POST' else request.GET
+    try:
+        status, content_type, body = queryproxy.proxy_query(params)
+    except queryproxy.QueryError as err:
+        return HttpResponse(json.dumps({'error': str(err)}), status=400, content_type='application/json')
+    except requests.exceptions.RequestException as err:
+        return HttpResponse(json.dumps({'error': 'InfluxDB is not available: {}'.format(err)}),
+                            status=502, content_type='application/json')
+    return HttpResponse(body, status=status, content_type=content_type)
+
+
+def _getlist(request, key):
+    """Return list of values from repeated and/or comma separated GET parameter `key`."""
+    return [x for v in request.GET.getlist(key) for x in v.split(',') if x]
+
+
+@staff_required
+def stream(request):
+    """
+    Stream newly ingested measurements as server-sent events. Requires a staff user.
+    Filter with comma separated devid, measurement and db parameters.
+
+    http -a user:pass --stream GET "http://127.0.0.1:8000/stream?devid=dev1,dev2&db=ruuvistation"
+    """
+    subscriber = subscribe(devids=set(_getlist(request, 'devid')),
+                           measurements=set(_getlist(request, 'measurement')),
+                           databases=set(_getlist(request, 'db')))
+    if subscriber is None:
+        return HttpResponse('Too many subscribers, try again later', status=503)
+    response = StreamingHttpResponse(event_stream(subscriber), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # disable nginx proxy buffering
+    return response
+
+
+@csrf_exempt
+@staff_required
+def latest(request):
+    """
+    Return latest reading of devices from last-value cache as JSON. Requires a staff user.
+    Supports If-None-Match, returns 304 if no reading has changed.
+
+    http -a user:pass -v GET "http://127.0.0.1:8000/latest?devid=dev1,dev2&measurement=ruuvitag"
+    echo '{"devids": ["dev1", "dev2"], "measurements": ["ruuvitag"]}' | http -a user:pass -v POST http://127.0.0.1:8000/latest
+    """
+    if request.method == 'POST':
+        try:
+            query = json.loads(request.body.decode('utf-8'))
+            devids = [str(x) for x in query['devids']]
+            measurements = query.get('measurements')
+        except (ValueError, UnicodeDecodeError, KeyError, TypeError) as err:
+            return HttpResponse('Invalid query: {}. Hint: {{"devids": [...], "measurements": [...]}}'.format(err),
+                                status=400)
+    else:
+        devids = _getlist(request, 'devid')
+        measurements = _getlist(request, 'measurement')
+    if not devids:
+        return HttpResponse('devid is missing', status=400)
+    values = get_last_values(devids, set(measurements) if measurements else None)
+    etag = make_etag(values)
+    if etag in [x.strip() for x in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+        response = HttpResponse(status=304)
+    else:
+        response = HttpResponse(json.dumps(values), content_type='application/json')
+    response['ETag'] = etag
+    return response
+
+
+@staff_required
+def export(request):
+    """
+    Stream measurements of devices in a time range as CSV, NDJSON or Parquet. Requires a staff user.
+    CSV and NDJSON are gzip compressed if the client accepts it.
+
+    http -a user:pass GET http://127.0.0.1:8000/export db==ruuvistation measurement==ruuvitag devid==dev1,dev2 \\
+        start==2018-01-01 end==2019-01-01 format==csv
+    """
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in FORMATS:
+        return HttpResponse('Unsupported format, use one of {}'.format(', '.join(FORMATS)), status=400)
+    try:
+        start, end = parse(request.GET['start']), parse(request.GET['end'])
+        exporter = Export(request.GET['db'], _getlist(request, 'measurement'), _getlist(request, 'devid'),
+                          start, end)
+    except KeyError as err:
+        return HttpResponse('{} is missing'.format(err), status=400)
+    except (ExportError, ValueError, OverflowError, influxdb.exceptions.InfluxDBClientError) as err:
+        return HttpResponse('Invalid export: {}'.format(err), status=400)
+    content_type, extension = FORMATS[fmt]
+    chunks = exporter.iter_bytes(fmt)
+    gzipped = fmt != 'parquet' and 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    response = StreamingHttpResponse(gzip_stream(chunks) if gzipped else chunks, content_type=content_type)
+    if gzipped:
+        response['Content-Encoding'] = 'gzip'
+    response['Content-Disposition'] = 'attachment; filename="{}-{}-{}.{}"'.format(
+        exporter.dbname, start.strftime('%Y%m%d'), end.strftime('%Y%m%d'), extension)
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _copy_body(source, fname, max_bytes):
+    """
+    Copy request body from file-like `source` to file `fname` in chunks.
+    Bytes after `max_bytes` are read and hashed but not written.
+
+    :return: tuple (sha256 hex digest, body size, truncated)
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(fname, 'wb') as destination:
+        while True:
+            chunk = source.read(DUMP_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            if size < max_bytes:
+                destination.write(chunk[:max_bytes - size])
+            size += len(chunk)
+    return digest.hexdigest(), size, size > max_bytes
+
+
+def dump_request(request, user=None, postfix=None, stream=None):
     """
     Dump a HttpRequest to files in a directory.
+
+    In stream mode (DUMP_REQUEST_STREAM setting, default True) the body is copied
+    from the WSGI input straight to disk, so request.body, request.POST and
+    request.FILES are not available after this. Otherwise the body is read into
+    memory first and POST parameters and uploaded files are dumped separately.
+
+    The body is written up to DUMP_MAX_BYTES (default 50 MB). If the same body
+    has been dumped with the same postfix within DUMP_DUPLICATE_DAYS (default 7)
+    and DUMP_SKIP_DUPLICATES is True (default), the new dump is removed and no
+    Request is saved.
+
+    Sets request.dumped_body_path to the body file, request.dump_truncated to
+    True if the body was longer than DUMP_MAX_BYTES and request.dump_duplicate_of
+    to the earlier Request, if this one was a duplicate. Views which parse the
+    body must not parse a truncated dump, they should parse request.body.
     """
+    if stream is None:
+        stream = get_setting('DUMP_REQUEST_STREAM', True)
+    if hasattr(request, '_body'):  # body has already been read, stream it from memory
+        stream = False
+    max_bytes = int(get_setting('DUMP_MAX_BYTES', 50 * 1024 * 1024))
+    source = request if stream else io.BytesIO(request.body)
     r = Request(method=request.method, user=user)
     fpath = create_path(postfix)
+    r.path = os.path.relpath(fpath, settings.MEDIA_ROOT)
     fname = os.path.join(fpath, 'request_body.txt')
-    with open(fname, 'wb') as destination:
-        destination.write(request.body)
+    r.body_sha256, r.body_size, truncated = _copy_body(source, fname, max_bytes)
+    request.dumped_body_path = fname
+    request.dump_truncated = truncated
+    request.dump_duplicate_of = None
     res = []
     res.append('Request Method: {}'.format(request.method))
     res.append('Request full path: {}'.format(request.get_full_path()))
+    res.append('Body: {} bytes, sha256 {}{}'.format(r.body_size, r.body_sha256,
+                                                    ', truncated to {} bytes'.format(max_bytes) if truncated else ''))
+
+    if r.body_size > 0 and get_setting('DUMP_SKIP_DUPLICATES', True):
+        # Index (body_sha256, created) covers the lookup, scope it to recent dumps of the same postfix
+        since = timezone.now() - datetime.timedelta(days=float(get_setting('DUMP_DUPLICATE_DAYS', 7)))
+        candidates = Request.objects.filter(body_sha256=r.body_sha256, created__gte=since)
+        if postfix:
+            candidates = candidates.filter(path__startswith=r.path.split(os.sep)[0] + os.sep)
+        original = candidates.order_by('created').first()
+        if original is not None:
+            shutil.rmtree(fpath, ignore_errors=True)
+            request.dumped_body_path = os.path.join(settings.MEDIA_ROOT, original.path, 'request_body.txt')
+            request.dump_duplicate_of = original
+            res.append('Duplicate of request {} ({}), not saved'.format(original.pk, original.path))
+            return res
 
     res.append('--- GET parameters ---')
     for key, val in request.GET.items():
         res.append('{}={}'.format(key, val))
 
     res.append('--- POST parameters ---')
-    for key, val in request.POST.items():
-        res.append('{}={}'.format(key, val))
+    if stream:
+        res.append('(streamed, see request_body.txt)')
+    else:
+        for key, val in request.POST.items():
+            res.append('{}={}'.format(key, val))
 
     res.append('--- META parameters ---')
     for key, val in request.META.items():
@@ -83,17 +400,20 @@ def dump_request(request, user=None, postfix=None):
     res.append('--- FILES ---')
 
     fnr = 0
-    for key, val in request.FILES.items():
-        res.append('{}. {}={}'.format(fnr, key, val))
-        fnr += 1
-        f = request.FILES[key]
-        res.append('content_type={}'.format(f.content_type))
-        res.append('size={}B'.format(f.size))
-        fname = os.path.join(fpath, '{}'.format(val))
-        res.append('path={}'.format(fname))
-        with open(fname, 'wb+') as destination:
-            for chunk in f.chunks():
-                destination.write(chunk)
+    if stream:
+        res.append('(streamed, see request_body.txt)')
+    else:
+        for key, val in request.FILES.items():
+            res.append('{}. {}={}'.format(fnr, key, val))
+            fnr += 1
+            f = request.FILES[key]
+            res.append('content_type={}'.format(f.content_type))
+            res.append('size={}B'.format(f.size))
+            fname = os.path.join(fpath, '{}'.format(val))
+            res.append('path={}'.format(fname))
+            with open(fname, 'wb+') as destination:
+                for chunk in f.chunks():
+                    destination.write(chunk)
     r.filecount = fnr
     r.save()
     fname = os.path.join(fpath, 'request_headers.txt')
@@ -141,7 +461,7 @@ def _basicauth(request):
             if auth[0].lower() == "basic":
                 a = auth[1].encode('utf8')
                 s = base64.b64decode(a)
-                uname, passwd = s.decode('utf8').split(':')
+                uname, passwd = s.decode('utf8').split(':', 1)  # password may contain ':'
                 user = authenticate(username=uname, password=passwd)
     return uname, passwd, user
 
@@ -380,85 +700,12 @@ def sentilohandler(request, version='0.0.0'):
     return influx_response
 
 
-def parse_noisesensorv1_data(request):
-    json_body = []
-    ts = datetime.datetime.utcnow()
-    s = request.GET.get('1s', '')
-    dev_id = request.GET.get('mac')
-    rssi = int(request.GET.get('rssi'))
-    uptime = int(request.GET.get('uptime', 0))
-    if s != '':
-        svals = [int(x) for x in filter(None, s.split(','))]
-        svals.reverse()
-    else:
-        return HttpResponse('Broken data {}'.format(s[:10]), status=400)
-    cnt = 0
-    measurement = {
-        "measurement": 'rssi',
-        "tags": {
-            "dev-id": dev_id,  # leave out sensor type
-        },
-        "time": (ts - datetime.timedelta(seconds=cnt)).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-        "fields": {
-            'rssi': rssi
-        }
-    }
-    json_body.append(measurement)
-    if uptime:
-        uptime = uptime / 1000.0  # convert to seconds
-        measurement = {
-            "measurement": 'uptime',
-            "tags": {
-                "dev-id": dev_id,  # leave out sensor type
-            },
-            "time": (ts - datetime.timedelta(seconds=cnt)).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-            "fields": {
-                'uptime': uptime
-            }
-        }
-        json_body.append(measurement)
-    for val in svals:
-        measurement = {
-            "measurement": 'raw_pp',
-            "tags": {
-                "dev-id": dev_id,  # leave out sensor type
-            },
-            "time": (ts - datetime.timedelta(seconds=cnt)).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-            "fields": {
-                'raw': val
-            }
-        }
-        cnt += 1
-        if val > 0:
-            json_body.append(measurement)
-    return json_body
-
-
-@csrf_exempt
-def noisesensorhandler(request, version='0.0.0'):
-    data = request.GET.get('1s', 'NO DATA')
-    with open('/tmp/noiseraw.log', 'at') as f:
-        f.write(datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ") + ' SERVER ERROR with data\n')
-        f.write(data)
-    json_body = parse_noisesensorv1_data(request)
-    # print(json.dumps(json_body, indent=1))
-    try:
-        iclient = get_iclient(database='noisesensor')
-        iclient.write_points(json_body)
-    except influxdb.exceptions.InfluxDBClientError as err:
-        print(str(err))
-        raise
-        return HttpResponse(str(err), status=500)
-    response = HttpResponse("ok")
-    return response
-
-
 @csrf_exempt
 def mapmytracks(request):
     """
     Dump a HttpRequest to files in a directory.
     """
-    res = dump_request(request, postfix='mapmytracks')
+    res = dump_request(request, postfix='mapmytracks', stream=False)  # POST is parsed below
     print('\n'.join(res))  # to console or stdout/stderr
     pl = request.POST.get('points', '').split()
     points = [pl[x:x + 4] for x in range(0, len(pl), 4)]
@@ -0,0 +1,163 @@
+"""
+Store for open aggregation windows of ingest-side rollups, see endpoints.acoustic.
+
+A window is identified by a key tuple, its first item is a namespace (e.g.
+'acoustic'). An aggregate is three dicts: `counters` which are summed, `mins`
+and `maxs` which keep the smallest and largest value. Every window has a due
+time, after which it is complete and `pop_due()` returns and removes it.
+Callers must drop samples whose window is already due, so a popped window
+is never created again.
+
+Windows must be shared by every process which handles requests and by the
+Celery worker running the flush_rollups task, otherwise each process writes
+its own partial aggregate of the same window and they overwrite each other
+in InfluxDB. Set ROLLUP_REDIS_URL (e.g. redis://localhost:6379/2) to keep
+them in Redis. Without it ingest-side rollups are disabled, unless
+ROLLUP_MEMORY_WINDOWS is True, which keeps windows in process memory and is
+only correct when a single process both handles requests and flushes
+(e.g. runserver or one gunicorn worker with CELERY_TASK_ALWAYS_EAGER).
+"""
+import heapq
+import json
+import logging
+import threading
+
+from endpoints.utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryWindowStore:
+    """Windows in process memory: {key: [counters, mins, maxs]} and a heap of (due_at, key)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.due = {}  # namespace -> heap of (due_at, key)
+
+    def merge(self, key, due_at, counters=None, mins=None, maxs=None):
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None:
+                window = self.windows[key] = [{}, {}, {}]
+                heapq.heappush(self.due.setdefault(key[0], []), (due_at, key))
+            c, lo, hi = window
+            for k, v in (counters or {}).items():
+                c[k] = c.get(k, 0) + v
+            for k, v in (mins or {}).items():
+                if k not in lo or v < lo[k]:
+                    lo[k] = v
+            for k, v in (maxs or {}).items():
+                if k not in hi or v > hi[k]:
+                    hi[k] = v
+
+    def pop_due(self, namespace, now, limit=1000):
+        """
+        :return: list of (key, counters, mins, maxs) of windows due at `now`
+        """
+        result = []
+        with self.lock:
+            heap = self.due.get(namespace, [])
+            while heap and heap[0][0] <= now and len(result) < limit:
+                due_at, key = heapq.heappop(heap)
+                c, lo, hi = self.windows.pop(key)
+                result.append((key, c, lo, hi))
+        return result
+
+
+class RedisWindowStore:
+    """
+    Windows in Redis hashes 'window:<key JSON>', fields 'c:<name>', 'min:<name>' and 'max:<name>'.
+    Due times are in sorted set 'windows:due:<namespace>'.
+    """
+
+    MERGE_SCRIPT = """
+local i = 4
+for _, prefix in ipairs({'c:', 'min:', 'max:'}) do
+  local n = tonumber(ARGV[i])
+  i = i + 1
+  for j = 1, n do
+    local f = prefix .. ARGV[i]
+    local v = tonumber(ARGV[i + 1])
+    if prefix == 'c:' then
+      redis.call('HINCRBYFLOAT', KEYS[1], f, ARGV[i + 1])
+    else
+      local cur = redis.call('HGET', KEYS[1], f)
+      if not cur or (prefix == 'min:' and v < tonumber(cur)) or (prefix == 'max:' and v > tonumber(cur)) then
+        redis.call('HSET', KEYS[1], f, ARGV[i + 1])
+      end
+    end
+    i = i + 2
+  end
+end
+redis.call('ZADD', KEYS[2], 'NX', ARGV[1], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+    POP_SCRIPT = """
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local result = {}
+for _, m in ipairs(members) do
+  local k = 'window:' .. m
+  table.insert(result, m)
+  table.insert(result, redis.call('HGETALL', k))
+  redis.call('DEL', k)
+  redis.call('ZREM', KEYS[1], m)
+end
+return result
+"""
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.merge_script = self.redis.register_script(self.MERGE_SCRIPT)
+        self.pop_script = self.redis.register_script(self.POP_SCRIPT)
+
+    def merge(self, key, due_at, counters=None, mins=None, maxs=None):
+        member = json.dumps(key)
+        args = [due_at, member, int(get_setting('ROLLUP_REDIS_TTL', 3 * 24 * 3600))]
+        for d in (counters or {}, mins or {}, maxs or {}):
+            args.append(len(d))
+            for k, v in d.items():
+                args.extend([k, repr(float(v))])
+        self.merge_script(keys=['window:' + member, 'windows:due:' + key[0]], args=args)
+
+    def pop_due(self, namespace, now, limit=1000):
+        raw = self.pop_script(keys=['windows:due:' + namespace], args=[now, limit])
+        result = []
+        for member, fields in zip(raw[::2], raw[1::2]):
+            aggs = {'c': {}, 'min': {}, 'max': {}}
+            for f, v in zip(fields[::2], fields[1::2]):
+                prefix, name = f.decode().split(':', 1)
+                aggs[prefix][name] = float(v)
+            result.append((tuple(json.loads(member)), aggs['c'], aggs['min'], aggs['max']))
+        return result
+
+
+_store = None
+_store_lock = threading.Lock()
+_disabled_warned = False
+
+
+def is_enabled():
+    """
+    Return True if windows can be aggregated: ROLLUP_REDIS_URL or ROLLUP_MEMORY_WINDOWS is set.
+    """
+    global _disabled_warned
+    if get_setting('ROLLUP_REDIS_URL') or get_setting('ROLLUP_MEMORY_WINDOWS', False):
+        return True
+    if not _disabled_warned:
+        _disabled_warned = True
+        logger.warning('Ingest-side rollups are disabled, set ROLLUP_REDIS_URL to enable them')
+    return False
+
+
+def get_window_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                redis_url = get_setting('ROLLUP_REDIS_URL')
+                _store = RedisWindowStore(redis_url) if redis_url else MemoryWindowStore()
+    return _store
@@ -120,6 +120,83 @@ DATETIME_FORMAT = 'Y-m-d H:i:s e'
 
 STATIC_URL = '/static/'
 
+# Celery
+# Measurement tasks use compact msgpack payloads, see endpoints.lineprotocol
+
+CELERY_ACCEPT_CONTENT = ['json', 'msgpack']
+
+# Every sink type has its own queue, see endpoints.routing.
+# Sink writes are idempotent, so they are acknowledged after they have run and
+# redelivered if a worker dies. Nobody reads task results.
+
+TASK_QUEUES = {
+    'endpoints.tasks.save_to_influxdb': 'influxdb',
+    'endpoints.tasks.save_packed_to_influxdb': 'influxdb',
+    'endpoints.tasks.push_ngsi_orion': 'orion',
+    'endpoints.tasks.retry_failed_writes': 'maintenance',
+    'endpoints.tasks.flush_rollups': 'maintenance',
+    'endpoints.tasks.purge_expired_requests': 'maintenance',
+    'iotendpoints.celery.debug_task': 'maintenance',
+}
+
+# Shard queues by device id, e.g. {'influxdb': 4}
+TASK_QUEUE_SHARDS = {}
+
+CELERY_TASK_ROUTES = ('endpoints.routing.route_task',)
+CELERY_TASK_ACKS_LATE = True
+CELERY_TASK_REJECT_ON_WORKER_LOST = True
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 4
+
+CELERY_BEAT_SCHEDULE = {
+    'retry-failed-writes': {
+        'task': 'endpoints.tasks.retry_failed_writes',
+        'schedule': 60.0,
+    },
+    'flush-rollups': {
+        'task': 'endpoints.tasks.flush_rollups',
+        'schedule': 60.0,
+    },
+    'purge-expired-requests': {
+        'task': 'endpoints.tasks.purge_expired_requests',
+        'schedule': 24 * 60 * 60.0,
+    },
+}
+
+# Token bucket rate limits of plugin endpoints, see endpoints.ratelimit.
+# Log-only: throttled requests are handled and counted in /status/ratelimit.
+# Check the counts before enforcing limits with 'action': 'reject' or 'drop'.
+
+RATELIMITS = {
+    'device': {'rate': 1, 'burst': 120, 'action': 'log'},
+    'user': {'rate': 20, 'burst': 600, 'action': 'log'},
+    'plugin': {'rate': 200, 'burst': 2000, 'action': 'log'},
+}
+
+# Secondary sinks which get a copy of every ingested point, see endpoints.outputs.
+# E.g. a daily partitioned Parquet archive (endpoints.archive):
+# SINKS = {'archive': {'class': 'endpoints.archive.ArchiveSink', 'path': '/var/lib/iotendpoints/archive'}}
+
+SINKS = {}
+
+# Downsampled series written to '<database>_<window>' databases, see endpoints.rollups.
+# Rules (and acoustic rollups, see endpoints.acoustic) are used only when ROLLUP_REDIS_URL is set,
+# because every gunicorn worker and the Celery worker must share the open windows. E.g.
+# ROLLUP_REDIS_URL = 'redis://localhost:6379/2'
+# ROLLUP_RULES = [
+#     {'measurement': 'aqburk', 'fields': ['pm25avg', 'pm10avg', 'temp', 'humi', 'pres'], 'windows': ['5m', '1h']},
+#     {'measurement': 'ruuvitag', 'fields': ['temperature', 'humidity', 'pressure'], 'windows': ['5m', '1h']},
+#     {'measurement': 'bme280', 'fields': ['Temperature', 'Humidity', 'Pressure'], 'windows': ['5m', '1h']},  # ESP Easy
+# ]
+
+ROLLUP_RULES = []
+
+# Days to keep dumped requests by postfix and status, see endpoints.retention.
+# Empty: nothing is purged. Purging deletes dump files too, so opt in explicitly, e.g.
+# REQUEST_RETENTION_DAYS = {'*': {'*': 365, 'SPAM': 30, 'DELETED': 7}}
+
+REQUEST_RETENTION_DAYS = {}
+
 # local_settings.py can be used to override environment-specific settings
 # like database and email that differ between development and production.
 try:
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "iotendpoints.settings")
 
 application = get_wsgi_application()
+
+# Load device decoder bindings once per worker instead of on the first uplink
+from endpoints.bindings import preload  # noqa: E402
+preload()
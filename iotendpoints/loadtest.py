@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+"""
+End-to-end HTTP load test for iotendpoints plugins.
+
+Starts fake InfluxDB (`/query`, `/write`) and Orion (`/v2/entities`) HTTP servers
+with injectable latency, serves the Django WSGI application from a threaded
+server and replays a mix of Digita, Everynet, Sentilo, Ruuvi Station, ESP Easy
+and noise sensor traffic at a target rate. Reports throughput, p50/p95/p99
+latency per plugin and backend call counts.
+
+Run it against a development database, a `loadtest` user is created there
+for basic auth protected endpoints:
+
+    python loadtest.py --rate 200 --duration 30 --mix digita=4,everynet=2,sentilo=1,ruuvistation=2,espeasy=1
+
+Celery tasks are run eagerly inside the request by default (`--celery eager`).
+`--celery memory` uses the in-memory broker, so tasks are only enqueued.
+
+To measure a gunicorn instance instead, start only the fake backends and
+point the load at it with `--target http://127.0.0.1:8000`. The environment
+variables the server must be started with are printed on start up.
+
+Latency is measured from the scheduled send time, so queueing inside the
+load generator is included when the server can't keep up.
+"""
+import argparse
+import base64
+import binascii
+import datetime
+import http.client
+import json
+import os
+import random
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+LOADTEST_USER = 'loadtest'
+LOADTEST_PASSWORD = 'loadtest-password'
+
+PLUGIN_URL_SETTINGS = {
+    'digita': 'DIGITA_URL',
+    'everynet': 'EVERYNET_URL',
+    'sentilo': 'SENTILO_URL',
+    'ruuvistation': 'RUUVISTATION_URL',
+    'espeasy': 'ESPEASY_URL',
+    'noisesensor': 'NOISESENSOR_URL',
+}
+
+# InfluxDB database name -> plugin which writes into it
+DB_PLUGIN = {
+    'paxcounter': 'digita',
+    'digita': 'digita',
+    'aqburk': 'digita',
+    'everynet': 'everynet',
+    'sentilo': 'sentilo',
+    'ruuvistation': 'ruuvistation',
+    LOADTEST_USER: 'espeasy',
+    'noisesensor': 'noisesensor',
+}
+
+
+class BackendStats:
+    """Thread safe call counters for the fake backends."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.points = Counter()
+
+    def add(self, key, points=0):
+        with self.lock:
+            self.calls[key] += 1
+            self.points[key] += points
+
+
+class FakeBackendHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def _respond(self, status, body=b''):
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeInfluxDBHandler(FakeBackendHandler):
+    """Accepts line protocol writes to /write and answers every /query with an empty result."""
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        body = self._read_body()
+        if url.path == '/write':
+            dbname = query.get('db', [''])[0]
+            self.server.stats.add(('influxdb', 'write', dbname), points=len(body.splitlines()))
+            self._respond(204)
+        elif url.path == '/query':
+            self.server.stats.add(('influxdb', 'query', query.get('q', [''])[0].split(' ')[0].upper()))
+            self._respond(200, b'{"results":[{"statement_id":0}]}')
+        else:
+            self._respond(404)
+
+    do_GET = do_POST
+
+
+class FakeOrionHandler(FakeBackendHandler):
+    """Accepts NGSI v2 entity creates and attribute updates."""
+
+    def _handle(self, status):
+        self._read_body()
+        if self.path.startswith('/v2/entities'):
+            self.server.stats.add(('orion', self.command, ''))
+            self._respond(status)
+        else:
+            self._respond(404)
+
+    def do_POST(self):
+        self._handle(201)
+
+    def do_PATCH(self):
+        self._handle(204)
+
+
+def start_fake_server(handler_class, stats, latency):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+    server.daemon_threads = True
+    server.stats = stats
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def basic_auth_header():
+    token = base64.b64encode('{}:{}'.format(LOADTEST_USER, LOADTEST_PASSWORD).encode()).decode()
+    return 'Basic {}'.format(token)
+
+
+def random_devid(prefix, devices):
+    return '{}{:04d}'.format(prefix, random.randint(1, devices))
+
+
+def digita_request(devices):
+    payload_hex = random.choice([
+        '{:04x}{:04x}'.format(random.randint(0, 200), random.randint(0, 100)),  # paxcounter
+        '13040b04107f00',  # Clickey Tempsens
+        '2a2a0021002c002800300056003b0000',  # AQ burk
+        '2a2a0021002c002800300056003b00000064031a27de0050',  # AQ burk with BME680
+        binascii.hexlify('temp={:.2f},hum={:.2f}'.format(random.uniform(15, 30), random.uniform(20, 80))
+                         .encode()).decode(),  # key-val
+    ])
+    data = {
+        'DevEUI_uplink': {
+            'DevEUI': random_devid('A81758FFFE03', devices),
+            'Time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'LrrRSSI': random.randint(-120, -40),
+            'payload_hex': payload_hex,
+        }
+    }
+    return 'POST', '', {'Content-Type': 'application/json'}, json.dumps(data).encode()
+
+
+def everynet_request(devices):
+    if random.random() < 0.5:
+        payload = random.randint(0, 200).to_bytes(2, 'big') + random.randint(0, 100).to_bytes(2, 'big')
+        query = '?type=paxcounter'
+    else:
+        payload = 'temp={:.2f},hum={:.2f}'.format(random.uniform(15, 30), random.uniform(20, 80)).encode()
+        query = '?type=keyval'
+    data = {
+        'meta': {'device': random_devid('70b3d5499', devices), 'time': time.time()},
+        'type': 'uplink',
+        'params': {'payload': base64.b64encode(payload).decode()},
+    }
+    return 'POST', query, {'Content-Type': 'application/json'}, json.dumps(data).encode()
+
+
+def sentilo_request(devices):
+    ts = datetime.datetime.utcnow().strftime('%d/%m/%YT%H:%M:%SUTC')
+    sensor = random_devid('TA120-T24', devices)
+    secvals = ';'.join('{:05.1f},0,0'.format(random.uniform(40, 70)) for _ in range(60))
+    data = {'sensors': [
+        {'sensor': sensor + '-N', 'observations': [{'value': '{:.1f}'.format(random.uniform(40, 70)), 'timestamp': ts}]},
+        {'sensor': sensor + '-O', 'observations': [{'value': 'false', 'timestamp': ts}]},
+        {'sensor': sensor + '-U', 'observations': [{'value': 'false', 'timestamp': ts}]},
+        {'sensor': sensor + '-M', 'observations': [{'value': '100', 'timestamp': ts}]},
+        {'sensor': sensor + '-S', 'observations': [{'value': secvals, 'timestamp': ts}]},
+    ]}
+    return 'PUT', '', {'Content-Type': 'application/json'}, json.dumps(data).encode()
+
+
+def ruuvistation_request(devices):
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    tags = []
+    for i in range(random.randint(1, 4)):
+        tags.append({
+            'id': 'ED:20:D0:FE:{:02X}:{:02X}'.format(i, random.randint(1, devices) % 256),
+            'name': 'tag {}'.format(i),
+            'updateAt': now,
+            'accelX': -0.002, 'accelY': 0.002, 'accelZ': 1.006,
+            'humidity': random.uniform(20, 90), 'pressure': random.uniform(980, 1030),
+            'temperature': random.uniform(-10, 30), 'voltage': 3.163,
+            'defaultBackground': 4, 'movementCounter': 0, 'rssi': random.randint(-100, -40),
+        })
+    data = {'deviceId': 'a9e3f766-b2e6-44a5-aba0-8aab09662938', 'tags': tags, 'time': now}
+    headers = {'Content-Type': 'application/json', 'Authorization': basic_auth_header()}
+    return 'POST', '', headers, json.dumps(data).encode()
+
+
+def espeasy_request(devices):
+    form = {
+        'idcode': random_devid('esp', devices),
+        'sensor': 'bme280',
+        'id': '0',
+        'data': 'Temperature={:.2f},Humidity={:.2f},Pressure={:.2f}'.format(
+            random.uniform(15, 30), random.uniform(20, 80), random.uniform(980, 1030)),
+    }
+    headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Authorization': basic_auth_header()}
+    return 'POST', '', headers, urllib.parse.urlencode(form).encode()
+
+
+def noisesensor_request(devices):
+    query = urllib.parse.urlencode({
+        'mac': '5C:CF:7F:{:02X}:{:02X}:{:02X}'.format(*random.randint(1, devices).to_bytes(3, 'big')),
+        'rssi': random.randint(-90, -40),
+        'uptime': random.randint(0, 10 ** 9),
+        '1s': ','.join(str(random.choice([0, random.randint(50, 120)])) for _ in range(60)),
+    })
+    return 'GET', '?' + query, {}, b''
+
+
+REQUEST_FACTORIES = {
+    'digita': digita_request,
+    'everynet': everynet_request,
+    'sentilo': sentilo_request,
+    'ruuvistation': ruuvistation_request,
+    'espeasy': espeasy_request,
+    'noisesensor': noisesensor_request,
+}
+
+
+def parse_mix(mix_str):
+    mix = {}
+    for item in mix_str.split(','):
+        name, weight = item.split('=')
+        if name not in REQUEST_FACTORIES:
+            raise ValueError('Unknown plugin "{}", choose from {}'.format(name, ', '.join(REQUEST_FACTORIES)))
+        mix[name] = float(weight)
+    return mix
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    idx = max(0, int(round(pct / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[min(idx, len(sorted_values) - 1)]
+
+
+def setup_django(args, influxdb_server, orion_server):
+    """
+    Configure Django to use the fake backends and return the WSGI application
+    and plugin url paths.
+    """
+    sys.path.insert(0, BASE_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iotendpoints.settings')
+    import django
+    django.setup()
+    from django.conf import settings
+    from django.contrib.auth.models import User
+    from django.test.utils import override_settings
+    from iotendpoints.celery import app as celery_app
+
+    overrides = {
+        'INFLUXDB_HOST': '127.0.0.1',
+        'INFLUXDB_PORT': influxdb_server.server_address[1],
+        'ORION_URL_ROOT': 'http://127.0.0.1:{}/v2'.format(orion_server.server_address[1]),
+        'ORION_USERNAME': 'loadtest',
+        'ORION_PASSWORD': 'loadtest',
+        'MEDIA_ROOT': tempfile.mkdtemp(prefix='iotendpoints-loadtest-'),
+        'ALLOWED_HOSTS': ['127.0.0.1', 'localhost'],
+    }
+    paths = {}
+    for name, key in PLUGIN_URL_SETTINGS.items():
+        url = os.environ.pop(key, None) or getattr(settings, key, None) or 'loadtest/{}'.format(name)
+        overrides[key] = url
+        paths[name] = '/' + url
+    for key in overrides:
+        os.environ.pop(key, None)  # get_setting() refuses values configured twice
+    override_settings(**overrides).enable()
+
+    if args.celery == 'eager':
+        celery_app.conf.update(task_always_eager=True, task_eager_propagates=False)
+    else:
+        celery_app.conf.update(task_always_eager=False, broker_url='memory://', result_backend=None)
+
+    user, created = User.objects.get_or_create(username=LOADTEST_USER)
+    user.set_password(LOADTEST_PASSWORD)
+    user.save()
+
+    from django.core.wsgi import get_wsgi_application
+    return get_wsgi_application(), paths, overrides['MEDIA_ROOT']
+
+
+def send_request(host, port, method, path, headers, body, timeout):
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        resp.read()
+        return resp.status
+    finally:
+        conn.close()
+
+
+def run_load(args, host, port, paths):
+    mix = parse_mix(args.mix)
+    names = list(mix.keys())
+    weights = [mix[n] for n in names]
+    latencies = defaultdict(list)
+    statuses = defaultdict(Counter)
+    lock = threading.Lock()
+
+    def worker(name, scheduled_at):
+        method, query, headers, body = REQUEST_FACTORIES[name](args.devices)
+        try:
+            status = send_request(host, port, method, paths[name] + query, headers, body, args.timeout)
+        except Exception as err:
+            status = type(err).__name__
+        elapsed = time.perf_counter() - scheduled_at
+        with lock:
+            latencies[name].append(elapsed)
+            statuses[name][status] += 1
+
+    total = int(args.rate * args.duration)
+    interval = 1.0 / args.rate
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for i in range(total):
+            scheduled_at = start + i * interval
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(worker, random.choices(names, weights)[0], scheduled_at)
+    elapsed = time.perf_counter() - start
+    return latencies, statuses, elapsed
+
+
+def print_report(latencies, statuses, elapsed, backend_stats):
+    total = sum(len(v) for v in latencies.values())
+    print('\nCompleted {} requests in {:.2f} s, {:.1f} req/s\n'.format(total, elapsed, total / elapsed))
+    row = '{:<14} {:>8} {:>9} {:>9} {:>9} {:>9} {:>10} {:>10}  {}'
+    print(row.format('plugin', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'db writes', 'points', 'statuses'))
+    writes = Counter()
+    points = Counter()
+    for (backend, kind, dbname), cnt in backend_stats.calls.items():
+        if backend == 'influxdb' and kind == 'write':
+            writes[DB_PLUGIN.get(dbname, dbname)] += cnt
+            points[DB_PLUGIN.get(dbname, dbname)] += backend_stats.points[(backend, kind, dbname)]
+    for name in sorted(latencies):
+        values = sorted(latencies[name])
+        print(row.format(
+            name, len(values), '{:.1f}'.format(len(values) / elapsed),
+            '{:.1f}'.format(percentile(values, 50) * 1000),
+            '{:.1f}'.format(percentile(values, 95) * 1000),
+            '{:.1f}'.format(percentile(values, 99) * 1000),
+            writes[name], points[name],
+            ' '.join('{}={}'.format(k, v) for k, v in sorted(statuses[name].items(), key=str))))
+    print('\nBackend calls:')
+    for (backend, kind, name), cnt in sorted(backend_stats.calls.items()):
+        print('  {:<9} {:<7} {:<16} {:>8}'.format(backend, kind, name, cnt))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test iotendpoints plugins against fake backends.')
+    parser.add_argument('--rate', type=float, default=50, help='Target requests per second')
+    parser.add_argument('--duration', type=float, default=10, help='Test duration in seconds')
+    parser.add_argument('--concurrency', type=int, default=32, help='Max concurrent requests')
+    parser.add_argument('--mix', default='digita=1,everynet=1,sentilo=1,ruuvistation=1,espeasy=1',
+                        help='Comma separated plugin=weight pairs')
+    parser.add_argument('--devices', type=int, default=100, help='Number of simulated devices per plugin')
+    parser.add_argument('--influxdb-latency', type=float, default=0.0, help='Fake InfluxDB latency in seconds')
+    parser.add_argument('--orion-latency', type=float, default=0.0, help='Fake Orion latency in seconds')
+    parser.add_argument('--celery', choices=['eager', 'memory'], default='eager',
+                        help='Run tasks eagerly in the request or only enqueue them to in-memory broker')
+    parser.add_argument('--timeout', type=float, default=30, help='HTTP client timeout in seconds')
+    parser.add_argument('--target', help='Load test already running server, e.g. http://127.0.0.1:8000')
+    args = parser.parse_args()
+
+    backend_stats = BackendStats()
+    influxdb_server = start_fake_server(FakeInfluxDBHandler, backend_stats, args.influxdb_latency)
+    orion_server = start_fake_server(FakeOrionHandler, backend_stats, args.orion_latency)
+
+    media_root = None
+    if args.target:
+        target = urllib.parse.urlparse(args.target)
+        host, port = target.hostname, target.port or 80
+        paths = {name: '/{}'.format(os.environ.get(key, 'loadtest/{}'.format(name)))
+                 for name, key in PLUGIN_URL_SETTINGS.items()}
+        print('Start the server under test with:')
+        print('  INFLUXDB_HOST=127.0.0.1 INFLUXDB_PORT={} ORION_URL_ROOT=http://127.0.0.1:{}/v2 {}'.format(
+            influxdb_server.server_address[1], orion_server.server_address[1],
+            ' '.join('{}={}'.format(key, paths[name][1:]) for name, key in PLUGIN_URL_SETTINGS.items())))
+        input('Press enter when the server is running...')
+    else:
+        application, paths, media_root = setup_django(args, influxdb_server, orion_server)
+        server = make_server('127.0.0.1', 0, application,
+                             server_class=ThreadingWSGIServer, handler_class=QuietWSGIRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address
+
+    try:
+        latencies, statuses, elapsed = run_load(args, host, port, paths)
+        print_report(latencies, statuses, elapsed, backend_stats)
+    finally:
+        if media_root is not None:
+            shutil.rmtree(media_root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()